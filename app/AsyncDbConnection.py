@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import redis.asyncio
+
+from functools import wraps
+from DbConnectionSingleton import DbConnectionSingleton, ConversationStateConflict
+from DbConnectionSingleton import SET_CONVERSATION_STATE_LUA, read_retry_delay
+from DbConnectionSingleton import DEL_STORAGE_LUA, PURGE_STORAGE_BATCH_LUA, EMPTY_EXPIRED_LUA
+from DbConnectionSingleton import STORAGE_PAGE_LUA, DUE_ITEMS_PAGE_LUA, ITEM_DETAILS_LUA
+from DbConnectionSingleton import ITEM_DETAILS_BATCH_SIZE
+from DbConnectionSingleton import CLAIM_NOTIFICATIONS_LUA, NOTIFY_QUEUE_KEY
+
+
+def idempotent_read(method):
+    @wraps(method)
+    async def retrying_method(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return await method(self, *args, **kwargs)
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                if (attempt >= self._read_retries):
+                    raise
+                delay = read_retry_delay(attempt)
+                logging.warning("Database read '{}' failed ({}): retrying in {:.2f}s"
+                                .format(method.__name__, e, delay))
+                await asyncio.sleep(delay)
+                attempt += 1
+    return retrying_method
+
+
+class AsyncDbConnection:
+
+    # Coroutine counterpart of the DbConnectionSingleton methods used by the asyncio handlers:
+    # it shares the connection settings, the parsing helpers and the inventory cache with it
+
+    def __init__(self, db: DbConnectionSingleton):
+        self._db = db
+        settings = db.get_connection_settings()
+        self._read_retries = settings["read_retries"]
+        connection_kwargs = {"db": db.get_db_name(),
+                             "password": db.get_db_pass(),
+                             "socket_timeout": settings["socket_timeout"],
+                             "health_check_interval": settings["health_check_interval"],
+                             "decode_responses": True}
+        if (db.get_db_socket() is not None):
+            connection_kwargs["connection_class"] = redis.asyncio.UnixDomainSocketConnection
+            connection_kwargs["path"] = db.get_db_socket()
+        else:
+            connection_kwargs["host"] = db.get_db_host()
+            connection_kwargs["port"] = db.get_db_port()
+            connection_kwargs["socket_connect_timeout"] = settings["connect_timeout"]
+        # Like the sync pool, a handler waits for a free connection rather than failing
+        # when all of them are in use
+        self._db_pool = redis.asyncio.BlockingConnectionPool(
+            max_connections=settings["max_connections"], timeout=settings["pool_timeout"],
+            **connection_kwargs)
+        self._db_instance = redis.asyncio.Redis(connection_pool=self._db_pool)
+        self._register_scripts()
+
+    def _register_scripts(self):
+        self._set_conversation_state_script = \
+            self._db_instance.register_script(SET_CONVERSATION_STATE_LUA)
+        self._del_storage_script = self._db_instance.register_script(DEL_STORAGE_LUA)
+        self._purge_storage_batch_script = \
+            self._db_instance.register_script(PURGE_STORAGE_BATCH_LUA)
+        self._empty_expired_script = self._db_instance.register_script(EMPTY_EXPIRED_LUA)
+        self._storage_page_script = self._db_instance.register_script(STORAGE_PAGE_LUA)
+        self._due_items_page_script = self._db_instance.register_script(DUE_ITEMS_PAGE_LUA)
+        self._item_details_script = self._db_instance.register_script(ITEM_DETAILS_LUA)
+        self._claim_notifications_script = \
+            self._db_instance.register_script(CLAIM_NOTIFICATIONS_LUA)
+
+    async def close(self):
+        await self._db_instance.close(close_connection_pool=True)
+
+    def get_current_day(self):
+        return self._db.get_current_day()
+
+    async def iter_pods(self, batch_size=100):
+        async for pod in self._db_instance.sscan_iter("global:pods", count=batch_size):
+            yield pod
+
+    async def claim_due_notifications(self, batch_size):
+        now = self._db.get_timestamp()
+        due_pods = await self._db_instance.zrangebyscore(NOTIFY_QUEUE_KEY, "-inf", now,
+                                                         start=0, num=batch_size, withscores=True)
+        if (len(due_pods) == 0):
+            return []
+        pipe = self._db_instance.pipeline(transaction=False)
+        for pod, _ in due_pods:
+            pipe.hmget(pod + ":notify_settings", "Time", "Timezone")
+        return await self._claim_notifications_script(
+            keys=[NOTIFY_QUEUE_KEY],
+            args=self._db._get_notification_claims(due_pods, await pipe.execute(), now))
+
+    async def iter_due_notifications(self, batch_size):
+        while True:
+            claimed_pods = await self.claim_due_notifications(batch_size)
+            if (len(claimed_pods) == 0):
+                return
+            for pod in claimed_pods:
+                yield pod
+
+    @idempotent_read
+    async def get_conversation_state(self, chatid):
+        cmd_name, cmd_arg, version = await self._db_instance.hmget(chatid + ":global_command",
+                                                                   "Name", "Arg", "Version")
+        return {"name": cmd_name if cmd_name is not None else "none",
+                "arg": cmd_arg if cmd_arg is not None else "none",
+                "version": int(version) if version is not None else 0}
+
+    async def save_callbacks(self, callbacks):
+        if (len(callbacks) == 0):
+            return
+        pipe = self._db_instance.pipeline(transaction=False)
+        pipe.mset({"global:callback:" + token: callback_data for token, callback_data in callbacks.items()})
+        for token in callbacks:
+            pipe.expire("global:callback:" + token, self._db._callback_ttl)
+        await pipe.execute()
+
+    @idempotent_read
+    async def get_callback(self, token):
+        return await self._db_instance.get("global:callback:" + token)
+
+    async def set_conversation_state(self, chatid, cmd_name, cmd_arg, version=None):
+        expected_version = version if version is not None else -1
+        new_version = await self._set_conversation_state_script(
+            keys=[chatid + ":global_command"],
+            args=[cmd_name, cmd_arg, expected_version, self._db._conversation_ttl])
+        if (new_version < 0):
+            raise ConversationStateConflict("The chat was updated by another action in the "
+                                            "meantime, please try again")
+        return new_version
+
+    async def get_storage_list_page(self, chatid, page, page_size):
+        start = page * page_size
+        return await self._db._inventory_cache.get_or_load_async(
+            chatid, None, lambda: self._load_storage_list_page(chatid, start, start + page_size - 1),
+            page=(start, page_size))
+
+    @idempotent_read
+    async def _load_storage_list_page(self, chatid, start, stop):
+        pipe = self._db_instance.pipeline(transaction=False)
+        pipe.llen(chatid + ":storage_list")
+        pipe.lrange(chatid + ":storage_list", start, stop)
+        storage_count, storage_list = await pipe.execute()
+        return (storage_count, storage_list)
+
+    async def get_storage_page(self, chatid, storage, page, page_size):
+        start = page * page_size
+        return await self._db._inventory_cache.get_or_load_async(
+            chatid, storage,
+            lambda: self._load_storage_page(chatid, storage, start, start + page_size - 1),
+            page=(start, page_size))
+
+    @idempotent_read
+    async def _load_storage_page(self, chatid, storage, start, stop):
+        return self._db._parse_storage_page(storage, await self._storage_page_script(
+            keys=[chatid + ":" + storage + ":item_list"],
+            args=[chatid + ":" + storage + ":", start, stop]))
+
+    @idempotent_read
+    async def get_item_list_len(self, chatid, storage):
+        return await self._db_instance.llen(chatid + ":" + storage + ":item_list")
+
+    async def get_item(self, chatid, storage, item_name):
+        item_dict = self._db._inventory_cache.find_item(chatid, storage, item_name)
+        if (item_dict is not None):
+            return item_dict
+        return (await self._db._inventory_cache.get_or_load_async(
+            chatid, storage, lambda: self._get_item_details(chatid, [(storage, item_name)]),
+            page=item_name))[0]
+
+    @idempotent_read
+    async def _get_item_details(self, chatid, storage_item_pairs):
+        item_details = []
+        for start in range(0, len(storage_item_pairs), ITEM_DETAILS_BATCH_SIZE):
+            batch_pairs = storage_item_pairs[start:start + ITEM_DETAILS_BATCH_SIZE]
+            item_details.extend(self._db._parse_item_details(batch_pairs, await self._item_details_script(
+                args=self._db._get_item_details_args(chatid, batch_pairs))))
+        return item_details
+
+    @idempotent_read
+    async def _get_indexed_items(self, chatid, max_expiry_day):
+        indexed_members = await self._db_instance.zrangebyscore(
+            chatid + ":expiry_index", "-inf", max_expiry_day)
+        return self._db._split_index_members(indexed_members)
+
+    async def get_item_expired_list(self, chatid, storage):
+        current_day = self.get_current_day()
+        storage_item_pairs = [(storage_name, item_name) for storage_name, item_name
+                              in await self._get_indexed_items(chatid, current_day - 1)
+                              if storage_name == storage]
+        return self._db._select_due_items(await self._get_item_details(chatid, storage_item_pairs),
+                                          current_day, 1)
+
+    @idempotent_read
+    async def get_item_expiring_or_bad_page(self, chatid, page, page_size):
+        current_day = self.get_current_day()
+        return self._db._parse_due_items_page(current_day, await self._due_items_page_script(
+            keys=[chatid + ":expiry_index"],
+            args=self._db._get_due_items_page_args(chatid, current_day, page, page_size)))
+
+    async def del_storage(self, chatid, storage):
+        deleted_count, pending_count = await self._del_storage_script(
+            keys=self._db._get_storage_deletion_keys(chatid, storage),
+            args=self._db._get_storage_deletion_args(chatid, storage))
+        self._db._inventory_cache.invalidate(chatid)
+        self._db._inventory_cache.invalidate(chatid, storage)
+        return deleted_count, pending_count
+
+    async def purge_deleted_storage(self, chatid, storage):
+        pending_count = 1
+        while (pending_count > 0):
+            deleted_count, pending_count = await self._purge_storage_batch_script(
+                keys=self._db._get_storage_deletion_keys(chatid, storage),
+                args=self._db._get_storage_deletion_args(chatid, storage))
+            if (deleted_count > 0):
+                yield pending_count
+
+    async def del_item(self, chatid, storage, item_name):
+        pipe = self._db_instance.pipeline()
+        pipe.delete(chatid + ":" + storage + ":" + item_name)
+        pipe.hdel(self._db._get_packed_items_key(chatid, storage), item_name)
+        pipe.zrem(chatid + ":expiry_index", storage + "@" + item_name)
+        pipe.zrem(chatid + ":name_index", self._db._get_name_index_member(storage, item_name))
+        pipe.lrem(chatid + ":" + storage + ":item_list", 1, item_name)
+        await pipe.execute()
+        self._db._inventory_cache.invalidate(chatid, storage)
+
+    async def empty_expired(self, chatid, storage):
+        emptied_count = await self._empty_expired_script(
+            keys=[chatid + ":expiry_index"],
+            args=self._db._get_empty_expired_args(chatid, storage))
+        self._db._inventory_cache.invalidate(chatid, storage)
+        return emptied_count
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import threading
+
+from os import environ
+from functools import partial
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor, wait
+from telegram import Update
+from telegram.ext import CallbackContext
+from FoodPodBot import FoodPodBot, STORAGE_PURGE_PROGRESS_TEXT, STORAGE_PURGE_DONE_TEXT
+from FoodPodBot import STORAGE_PURGE_PROGRESS_INTERVAL, EXPIRED_BUTTON_TEXT
+from CallbackCodec import ACTION_STORAGES, ACTION_STORAGE, ACTION_NEW_STORAGE, ACTION_NEW_ITEM
+from CallbackCodec import ACTION_ITEM, ACTION_MODIFY_ITEM, ACTION_EXPIRED, ACTION_EMPTY_EXPIRED
+from CallbackCodec import ACTION_DEL_STORAGE, ACTION_DEL_STORAGE_CONFIRM, ACTION_DEL_ITEM
+from CallbackCodec import ACTION_DEL_ITEM_CONFIRM, ACTION_CHECK, ACTION_CLOSE, ACTION_NONE
+from AsyncDbConnection import AsyncDbConnection
+from TelegramSecretsSingleton import TelegramSecretsSingleton
+from DbConnectionSingleton import DbConnectionSingleton
+
+
+class AsyncFoodPodBot(FoodPodBot):
+
+    # The browsing handlers and the daily job run as coroutines on a dedicated event loop,
+    # so the dispatcher threads are released as soon as an update is scheduled; the other
+    # handlers are inherited and keep running synchronously
+
+    def __init__(self, secrets: TelegramSecretsSingleton, db: DbConnectionSingleton):
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever,
+                                             name="AsyncEngine", daemon=True)
+        self._loop_thread.start()
+        # The Telegram API client is blocking: its calls are handed over to a bounded pool
+        self._telegram_executor = ThreadPoolExecutor(
+            max_workers=int(environ.get("ASYNC_TELEGRAM_WORKERS", 8)),
+            thread_name_prefix="AsyncTelegram")
+        self._async_db_connection = AsyncDbConnection(db)
+        super().__init__(secrets, db)
+        self._async_button_handlers = {
+            ACTION_STORAGES: self._async_button_storages,
+            ACTION_STORAGE: self._async_button_storage,
+            ACTION_NEW_STORAGE: self._async_button_new_storage,
+            ACTION_NEW_ITEM: self._async_button_new_item,
+            ACTION_ITEM: self._async_button_item,
+            ACTION_MODIFY_ITEM: self._async_button_modify_item,
+            ACTION_EXPIRED: self._async_button_expired,
+            ACTION_EMPTY_EXPIRED: self._async_button_empty_expired,
+            ACTION_DEL_STORAGE: self._async_button_del_storage,
+            ACTION_DEL_STORAGE_CONFIRM: self._async_button_del_storage_confirm,
+            ACTION_DEL_ITEM: self._async_button_del_item,
+            ACTION_DEL_ITEM_CONFIRM: self._async_button_del_item_confirm,
+            ACTION_CHECK: self._async_button_check,
+            ACTION_CLOSE: self._async_button_close,
+            ACTION_NONE: self._async_button_none
+        }
+
+    def _schedule(self, coroutine, update, context):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        future.add_done_callback(partial(self._report_async_error, update, context))
+        return future
+
+    def _schedule_update(self, coroutine, update, context):
+        future = self._schedule(coroutine, update, context)
+        if (self._cluster is not None):
+            # The updates of a shard are processed in order, so the next one waits for this
+            wait([future])
+
+    def _report_async_error(self, update, context, future):
+        error = future.exception()
+        if (error is not None):
+            context.error = error
+            self._telegram_executor.submit(self._callback_error, update, context)
+
+    async def _telegram(self, method, *args, **kwargs):
+        return await self._loop.run_in_executor(self._telegram_executor,
+                                                partial(method, *args, **kwargs))
+
+    async def _show(self, query, text, keyboard_markup=None, parse_mode=None):
+        await self._async_db_connection.save_callbacks(self._callback_codec.pack(keyboard_markup))
+        digest = self._render_cache.get_digest(text, keyboard_markup, parse_mode)
+        if (type(query) is Update):
+            message = await self._telegram(query.message.reply_text, text,
+                                           reply_markup=keyboard_markup, parse_mode=parse_mode)
+            self._render_cache.remember(message.chat.id, message.message_id, digest)
+            return
+        edited = await self._render_cache.edit_async(
+            query.message.chat.id, query.message.message_id, digest,
+            lambda: self._telegram(query.bot.edit_message_text, text,
+                                   message_id=query.message.message_id,
+                                   chat_id=query.message.chat.id,
+                                   reply_markup=keyboard_markup, parse_mode=parse_mode))
+        if (not edited):
+            await self._telegram(self._answer_button, query)
+
+    def _callback_items(self, update, context):
+        _chatid = str(update.message.chat.id)
+        self._schedule_update(self._async_list_storage(update, _chatid), update, context)
+
+    def _callback_check(self, update, context):
+        self._schedule_update(self._async_check(update), update, context)
+
+    def _callback_inline_button(self, update, context):
+        self._schedule_update(self._async_inline_button(update, context), update, context)
+
+    def _callback_notify_expiry(self, context: CallbackContext):
+        if (not self._runs_scheduled_jobs()):
+            return
+        asyncio.run_coroutine_threadsafe(
+            self._expiry_notifier.start_async(context.bot,
+                                              self._async_db_connection.iter_due_notifications(
+                                                  self._expiry_notifier.get_batch_size()),
+                                              self._async_build_expiry_report),
+            self._loop)
+
+    async def _async_build_expiry_report(self, pod):
+        item_count, bad_items = await self._async_db_connection.get_item_expiring_or_bad_page(
+            pod, 0, self._page_size)
+        report = self._compose_expiry_report(pod, bad_items, item_count)
+        if (report is not None):
+            await self._async_db_connection.save_callbacks(self._callback_codec.pack(report[1]))
+        return report
+
+    async def _async_inline_button(self, update, context):
+        _query = update.callback_query
+        _chatid = str(_query.message.chat.id)
+        _db = self._async_db_connection
+        callback_data = _query.data
+        if (self._callback_codec.is_token(callback_data)):
+            callback_data = await _db.get_callback(callback_data)
+        pressed_button = self._callback_codec.parse(callback_data)
+        logging.debug("Inline button callback: {}".format(pressed_button))
+        button_handler = self._async_button_handlers.get(pressed_button[0]) if pressed_button is not None else None
+        if (button_handler is None):
+            await self._telegram(_query.answer, text=EXPIRED_BUTTON_TEXT)
+            return
+        conversation_state = await _db.get_conversation_state(_chatid)
+        cmd_name, cmd_arg = await button_handler(_query, update, context, _chatid, *pressed_button[1])
+        await _db.set_conversation_state(_chatid, cmd_name, cmd_arg, conversation_state["version"])
+
+    async def _async_button_storages(self, query, update, context, chatid, page="0"):
+        await self._async_list_storage(query, chatid, int(page))
+        return ("none", "none")
+
+    async def _async_button_storage(self, query, update, context, chatid, storage, page="0"):
+        await self._async_list_items(query, chatid, storage, int(page))
+        return ("none", "none")
+
+    async def _async_button_new_storage(self, query, update, context, chatid):
+        view, state = self._prompt_new_storage()
+        await self._show(query, *view)
+        return state
+
+    async def _async_button_new_item(self, query, update, context, chatid, storage):
+        view, state = self._prompt_new_item(storage)
+        await self._show(query, *view)
+        return state
+
+    async def _async_button_item(self, query, update, context, chatid, storage, item_name, origin):
+        item_dict = await self._async_db_connection.get_item(chatid, storage, item_name)
+        await self._show(query, *self._view_item(storage, item_name, item_dict, origin))
+        return ("none", "none")
+
+    async def _async_button_modify_item(self, query, update, context, chatid, storage, item_name):
+        view, state = self._prompt_quantity(storage, item_name)
+        await self._show(query, *view)
+        return state
+
+    async def _async_button_expired(self, query, update, context, chatid, storage):
+        item_list = await self._async_db_connection.get_item_expired_list(chatid, storage)
+        await self._show(query, *self._view_expired_items(storage, item_list))
+        return ("none", "none")
+
+    async def _async_button_empty_expired(self, query, update, context, chatid, storage):
+        await self._async_db_connection.empty_expired(chatid, storage)
+        await self._async_list_items(query, chatid, storage)
+        return ("none", "none")
+
+    async def _async_button_del_storage(self, query, update, context, chatid, storage):
+        item_count = await self._async_db_connection.get_item_list_len(chatid, storage)
+        await self._show(query, *self._view_del_storage_dialog(storage, item_count))
+        return ("none", "none")
+
+    async def _async_button_del_storage_confirm(self, query, update, context, chatid, storage):
+        deleted_count, pending_count = await self._async_db_connection.del_storage(chatid, storage)
+        await self._show(query, *self._view_storage_deleted(storage, pending_count))
+        if (pending_count > 0):
+            self._schedule(self._async_purge_storage(query, chatid, storage,
+                                                     deleted_count + pending_count),
+                           update, context)
+        return ("none", "none")
+
+    async def _async_button_del_item(self, query, update, context, chatid, storage, item_name, origin):
+        await self._show(query, *self._view_del_item_dialog(storage, item_name, origin))
+        return ("none", "none")
+
+    async def _async_button_del_item_confirm(self, query, update, context, chatid, storage, item_name):
+        await self._async_db_connection.del_item(chatid, storage, item_name)
+        await self._show(query, *self._view_item_deleted(storage, item_name))
+        return ("none", "none")
+
+    async def _async_button_check(self, query, update, context, chatid, page="0"):
+        await self._async_check(query, int(page))
+        return ("none", "none")
+
+    async def _async_button_close(self, query, update, context, chatid):
+        await self._show(query, *self._view_close())
+        return ("none", "none")
+
+    async def _async_button_none(self, query, update, context, chatid):
+        return ("none", "none")
+
+    async def _async_load_page(self, load_page, page):
+        count, page_list = await load_page(page)
+        fallback_page, page_count = self._get_page_fallback(count, page)
+        if (fallback_page != page):
+            page = fallback_page
+            count, page_list = await load_page(page)
+        return count, page_list, page, page_count
+
+    async def _async_check(self, query, page=0):
+        _chatid = str(query.message.chat.id)
+        item_count, item_list, page, page_count = await self._async_load_page(
+            lambda page: self._async_db_connection.get_item_expiring_or_bad_page(
+                _chatid, page, self._page_size),
+            page)
+        await self._show(query, *self._view_expiring_items(item_count, item_list, page, page_count))
+
+    async def _async_list_storage(self, query, chatid, page=0):
+        storage_count, storage_list, page, page_count = await self._async_load_page(
+            lambda page: self._async_db_connection.get_storage_list_page(chatid, page, self._page_size),
+            page)
+        await self._show(query, *self._view_storage_list(storage_count, storage_list, page, page_count))
+
+    async def _async_list_items(self, query, chatid, storage, page=0):
+        item_count, item_list, page, page_count = await self._async_load_page(
+            lambda page: self._async_db_connection.get_storage_page(chatid, storage, page,
+                                                                    self._page_size),
+            page)
+        await self._show(query, *self._view_storage_items(storage, item_count, item_list, page, page_count))
+
+    async def _async_purge_storage(self, query, chatid, storage, item_count):
+        last_progress_at = monotonic()
+        async for pending_count in self._async_db_connection.purge_deleted_storage(chatid, storage):
+            if (pending_count > 0 and monotonic() - last_progress_at >= STORAGE_PURGE_PROGRESS_INTERVAL):
+                await self._show(query, STORAGE_PURGE_PROGRESS_TEXT.format(storage, pending_count))
+                last_progress_at = monotonic()
+        await self._show(query, STORAGE_PURGE_DONE_TEXT.format(storage, item_count))
+
+    def halt(self):
+        super().halt()
+        asyncio.run_coroutine_threadsafe(self._async_db_connection.close(),
+                                         self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._telegram_executor.shutdown()
@@ -0,0 +1,78 @@
+from base64 import urlsafe_b64encode
+from hashlib import blake2b
+from telegram import InlineKeyboardButton
+
+# Telegram rejects buttons carrying more callback data than this
+CALLBACK_DATA_MAX_BYTES = 64
+CALLBACK_TOKEN_PREFIX = "~"
+# Actions of the inline buttons, followed by their arguments in the callback data
+ACTION_STORAGES = "l"
+ACTION_STORAGE = "s"
+ACTION_NEW_STORAGE = "ns"
+ACTION_NEW_ITEM = "ni"
+ACTION_ITEM = "i"
+ACTION_MODIFY_ITEM = "m"
+ACTION_EXPIRED = "x"
+ACTION_EMPTY_EXPIRED = "dx"
+ACTION_DEL_STORAGE = "ds"
+ACTION_DEL_STORAGE_CONFIRM = "dsy"
+ACTION_DEL_ITEM = "di"
+ACTION_DEL_ITEM_CONFIRM = "diy"
+ACTION_CHECK = "c"
+ACTION_CLOSE = "q"
+ACTION_NONE = "e"
+# Where an item was selected from, for its Back button
+ORIGIN_STORAGE = "s"
+ORIGIN_EXPIRED = "x"
+ORIGIN_CHECK = "c"
+
+
+class CallbackCodec:
+
+    # Packs the action of a button and its arguments in the callback data; the few which
+    # do not fit in Telegram's limit are saved in Redis for a while, behind a short token
+
+    def __init__(self, db):
+        self._db_connection = db
+
+    def join(self, action, *args):
+        return ":".join((action,) + args)
+
+    def encode(self, action, *args):
+        return self._shorten(self.join(action, *args))
+
+    def _shorten(self, callback_data):
+        if (len(callback_data.encode()) <= CALLBACK_DATA_MAX_BYTES):
+            return callback_data
+        # The same button always gets the same token, so rendering it again only renews it
+        return CALLBACK_TOKEN_PREFIX + urlsafe_b64encode(
+            blake2b(callback_data.encode(), digest_size=9).digest()).decode()
+
+    def pack(self, keyboard_markup):
+        # Replaces the callback data which does not fit in the buttons with tokens, returning
+        # the callback data to save behind them, so that they are all saved at once
+        callbacks = {}
+        if (keyboard_markup is None):
+            return callbacks
+        for button_row in keyboard_markup.inline_keyboard:
+            for index, button in enumerate(button_row):
+                callback_data = self._shorten(button.callback_data)
+                if (callback_data != button.callback_data):
+                    callbacks[callback_data] = button.callback_data
+                    button_row[index] = InlineKeyboardButton(button.text, callback_data=callback_data)
+        return callbacks
+
+    def is_token(self, callback_data):
+        return callback_data.startswith(CALLBACK_TOKEN_PREFIX)
+
+    def decode(self, callback_data):
+        if (self.is_token(callback_data)):
+            callback_data = self._db_connection.get_callback(callback_data)
+        return self.parse(callback_data)
+
+    def parse(self, callback_data):
+        # Returns the action and its arguments, or None if the token expired
+        if (callback_data is None):
+            return None
+        action, *args = callback_data.split(":")
+        return (action, args)
@@ -0,0 +1,167 @@
+import json
+import logging
+import socket
+import threading
+import zlib
+
+from math import ceil
+from os import environ, getpid
+from random import shuffle
+
+LEADER_LEASE = "leader"
+UPDATE_SHARD_LEASE = "update_shard:{}"
+
+
+class ClusterCoordinator:
+
+    # Lets several bot instances run side by side: the updates are spread over Redis streams,
+    # sharded by chat, and every shard is consumed in order by the one instance holding its
+    # lease, so the updates of a chat are never processed concurrently; the instance holding
+    # the leader lease runs the scheduled jobs
+
+    def __init__(self, db, process_update):
+        self._db_connection = db
+        self._process_update = process_update
+        self._instance_id = "{}-{}".format(socket.gethostname(), getpid())
+        self._shard_count = int(environ.get("UPDATE_SHARDS", 8))
+        self._lease_duration = int(environ.get("LEASE_DURATION", 15))
+        self._read_count = int(environ.get("UPDATE_READ_COUNT", 10))
+        self._stream_max_length = int(environ.get("UPDATE_STREAM_MAX_LENGTH", 10000))
+        # Blocking reads must return well before the connection times out
+        self._read_block = int(min(1, db.get_connection_settings()["socket_timeout"] / 2) * 1000)
+        self._is_leader = False
+        self._shard_threads = {}
+        self._leaving_shards = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._manager_thread = None
+
+    def get_instance_id(self):
+        return self._instance_id
+
+    def is_leader(self):
+        return self._is_leader
+
+    def get_shard(self, chat_id):
+        return zlib.crc32(str(chat_id).encode()) % self._shard_count
+
+    def publish(self, update_json, chat_id):
+        self._db_connection.publish_update(self.get_shard(chat_id), json.dumps(update_json),
+                                           self._stream_max_length)
+
+    def start(self):
+        self._manager_thread = threading.Thread(target=self._manage, name="ClusterCoordinator",
+                                                daemon=True)
+        self._manager_thread.start()
+        logging.info("Instance '{}' joined the cluster".format(self._instance_id))
+
+    def stop(self):
+        self._stop_event.set()
+        self._manager_thread.join()
+        with self._lock:
+            shard_threads = list(self._shard_threads.values())
+        for shard_thread in shard_threads:
+            shard_thread.join()
+        # Hand everything over to the other instances at once, without waiting for expiry
+        if (self._is_leader):
+            self._db_connection.release_lease(LEADER_LEASE, self._instance_id)
+            self._is_leader = False
+        self._db_connection.unregister_instance(self._instance_id)
+
+    def _manage(self):
+        # The leases are renewed three times within their duration
+        while True:
+            try:
+                self._renew_leases()
+            except Exception as e:
+                logging.error("Unable to renew the leases of instance '{}': {}"
+                              .format(self._instance_id, e))
+            if (self._stop_event.wait(self._lease_duration / 3)):
+                return
+
+    def _renew_leases(self):
+        instance_count = self._db_connection.register_instance(self._instance_id, self._lease_duration)
+        was_leader = self._is_leader
+        self._is_leader = self._db_connection.acquire_lease(LEADER_LEASE, self._instance_id,
+                                                            self._lease_duration)
+        if (self._is_leader != was_leader):
+            logging.info("Instance '{}' {} the leader".format(
+                self._instance_id, "is now" if self._is_leader else "is no longer"))
+        with self._lock:
+            held_shards = [shard for shard in self._shard_threads if shard not in self._leaving_shards]
+        for shard in list(held_shards):
+            if (not self._db_connection.acquire_lease(UPDATE_SHARD_LEASE.format(shard),
+                                                      self._instance_id, self._lease_duration)):
+                logging.warning("Instance '{}' lost the lease of update shard {}"
+                                .format(self._instance_id, shard))
+                self._leave_shard(shard)
+                held_shards.remove(shard)
+        # Each instance takes its fair share of the shards, leaving the rest to the others
+        fair_share = ceil(self._shard_count / max(instance_count, 1))
+        for shard in held_shards[fair_share:]:
+            self._leave_shard(shard)
+        held_count = min(len(held_shards), fair_share)
+        with self._lock:
+            free_shards = [shard for shard in range(self._shard_count) if shard not in self._shard_threads]
+        shuffle(free_shards)
+        for shard in free_shards:
+            if (held_count >= fair_share):
+                break
+            if (self._db_connection.acquire_lease(UPDATE_SHARD_LEASE.format(shard),
+                                                  self._instance_id, self._lease_duration)):
+                self._join_shard(shard)
+                held_count += 1
+
+    def _join_shard(self, shard):
+        self._db_connection.create_update_stream(shard)
+        shard_thread = threading.Thread(target=self._consume, args=(shard,),
+                                        name="UpdateShard-{}".format(shard), daemon=True)
+        with self._lock:
+            self._shard_threads[shard] = shard_thread
+        shard_thread.start()
+        logging.info("Instance '{}' is processing update shard {}".format(self._instance_id, shard))
+
+    def _leave_shard(self, shard):
+        # The consumer stops after the update in progress, then releases the lease
+        with self._lock:
+            self._leaving_shards.add(shard)
+
+    def _is_consuming(self, shard):
+        return not self._stop_event.is_set() and shard not in self._leaving_shards
+
+    def _consume(self, shard):
+        # The consumer is named after the shard, so that the next owner of the lease resumes
+        # from the updates read and never acknowledged by the previous one
+        consumer = "shard-{}".format(shard)
+        pending = True
+        try:
+            while (self._is_consuming(shard)):
+                try:
+                    entries = self._db_connection.read_updates(shard, consumer, pending,
+                                                               self._read_count, self._read_block)
+                    if (pending and len(entries) == 0):
+                        pending = False
+                    for entry_id, update_json in entries:
+                        if (not self._is_consuming(shard)):
+                            break
+                        if (update_json is not None):
+                            self._process(shard, update_json)
+                        self._db_connection.ack_update(shard, entry_id)
+                except Exception as e:
+                    logging.error("Unable to consume update shard {}: {}".format(shard, e))
+                    pending = True
+                    self._stop_event.wait(1)
+        finally:
+            # The shard is forgotten only once released, so it is not taken again meanwhile
+            try:
+                self._db_connection.release_lease(UPDATE_SHARD_LEASE.format(shard), self._instance_id)
+            finally:
+                with self._lock:
+                    del self._shard_threads[shard]
+                    self._leaving_shards.discard(shard)
+
+    def _process(self, shard, update_json):
+        try:
+            self._process_update(json.loads(update_json))
+        except Exception as e:
+            logging.error("Unable to process an update of shard {}: {}".format(shard, e))
@@ -1,11 +1,341 @@
 import logging
 import redis
+import string
+import zlib
 
 from os import environ
 from copy import copy
-from datetime import date, datetime, time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from functools import wraps
+from random import uniform
+from time import sleep
 import pytz
 
+from InventoryCache import InventoryCache
+from MonitoredConnectionPool import MonitoredConnectionPool
+from MetricsSingleton import MetricsSingleton
+
+EPOCH_DATE = date(1970, 1, 1)
+DEFAULT_ITEM_EXPIRY = "2000-12-31"
+# Items in stock expiring within this many days are due, as well as the expired ones
+DUE_WITHIN_DAYS = 2
+READ_RETRY_BASE_DELAY = 0.1
+NOTIFY_QUEUE_KEY = "global:notify_queue"
+INSTANCES_KEY = "global:instances"
+# In the compact schema the items of a storage are the fields of a single hash, holding
+# quantity and expiry day packed together, rather than a hash each
+PACKED_ITEMS_KEY = "item_list:packed"
+ITEM_SCHEMAS = ["legacy", "compact"]
+ITEM_DETAILS_BATCH_SIZE = 500
+UPDATE_STREAM_GROUP = "workers"
+# Item names are searched ignoring the case of ASCII letters, the same as Lua's string.lower
+NAME_INDEX_FOLD = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# Compare-and-set of the conversation state: the write only happens if nobody else
+# saved a new state since it was loaded; a negative expected version skips the check
+SET_CONVERSATION_STATE_LUA = """
+local version = tonumber(redis.call('HGET', KEYS[1], 'Version') or '0')
+local expected_version = tonumber(ARGV[3])
+if expected_version >= 0 and version ~= expected_version then
+    return -1
+end
+redis.call('HSET', KEYS[1], 'Name', ARGV[1], 'Arg', ARGV[2], 'Version', version + 1)
+if tonumber(ARGV[4]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+end
+return version + 1
+"""
+
+# Reads quantity and expiry of an item from either schema, as the items are converted one
+# storage at a time, and the instances still running the legacy one write in it
+ITEM_FIELDS_LUA = """
+local function get_item_fields(item_key_prefix, item_name)
+    local packed = redis.call('HGET', item_key_prefix .. 'item_list:packed', item_name)
+    if packed then
+        local separator = string.find(packed, ':', 1, true)
+        return {string.sub(packed, 1, separator - 1), string.sub(packed, separator + 1)}
+    end
+    return redis.call('HMGET', item_key_prefix .. item_name, 'Quantity', 'Expire')
+end
+"""
+
+# Creates or overwrites an item together with its list entry and index entries, in the
+# given schema, dropping it from the other one; returns the expiry day the item was
+# indexed with before, if any
+# KEYS: item hash, item list, expiry index, name index, packed items hash
+# ARGV: item name, quantity, expiry day, expiry index member, name index member, schema
+SAVE_ITEM_LUA = """
+local previous_day = redis.call('ZSCORE', KEYS[3], ARGV[4])
+if redis.call('EXISTS', KEYS[1]) == 0 and redis.call('HEXISTS', KEYS[5], ARGV[1]) == 0 then
+    redis.call('LPUSH', KEYS[2], ARGV[1])
+end
+redis.call('ZADD', KEYS[4], 0, ARGV[5])
+if ARGV[6] == 'compact' then
+    redis.call('HSET', KEYS[5], ARGV[1], ARGV[2] .. ':' .. ARGV[3])
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('HSET', KEYS[1], 'Quantity', ARGV[2], 'Expire', ARGV[3])
+    redis.call('HDEL', KEYS[5], ARGV[1])
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('ZADD', KEYS[3], ARGV[3], ARGV[4])
+else
+    redis.call('ZREM', KEYS[3], ARGV[4])
+end
+return previous_day
+"""
+
+# Renames an item, or moves it to another storage, keeping its schema; returns 0 if the
+# item does not exist, -1 if the destination is taken yet
+# KEYS: item hash, item list, new item hash, new item list, expiry index, name index,
+# packed items hash, new packed items hash
+# ARGV: item name, new item name, expiry index member, new expiry index member,
+# name index member, new name index member
+MOVE_ITEM_LUA = """
+local packed = redis.call('HGET', KEYS[7], ARGV[1])
+if not packed and redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if redis.call('EXISTS', KEYS[3]) == 1 or redis.call('HEXISTS', KEYS[8], ARGV[2]) == 1 then
+    return -1
+end
+if packed then
+    redis.call('HDEL', KEYS[7], ARGV[1])
+    redis.call('HSET', KEYS[8], ARGV[2], packed)
+else
+    redis.call('RENAME', KEYS[1], KEYS[3])
+end
+redis.call('LREM', KEYS[2], 1, ARGV[1])
+redis.call('LPUSH', KEYS[4], ARGV[2])
+local expiry_day = redis.call('ZSCORE', KEYS[5], ARGV[3])
+if expiry_day then
+    redis.call('ZREM', KEYS[5], ARGV[3])
+    redis.call('ZADD', KEYS[5], expiry_day, ARGV[4])
+end
+redis.call('ZREM', KEYS[6], ARGV[5])
+redis.call('ZADD', KEYS[6], 0, ARGV[6])
+return 1
+"""
+
+# Deletes a batch of items from the head of a detached item list, together with their
+# hashes and index entries; returns the deleted and the remaining item counts
+# KEYS: storage list, item list, detached item list, expiry index, name index
+# ARGV: storage name, item hash key prefix, batch size
+PURGE_STORAGE_BATCH_LUA = """
+local item_list = redis.call('LRANGE', KEYS[3], 0, tonumber(ARGV[3]) - 1)
+for _, item in ipairs(item_list) do
+    redis.call('UNLINK', ARGV[2] .. item)
+    redis.call('HDEL', ARGV[2] .. 'item_list:packed', item)
+    redis.call('ZREM', KEYS[4], ARGV[1] .. '@' .. item)
+    redis.call('ZREM', KEYS[5], string.lower(item) .. '@' .. ARGV[1] .. '@' .. item)
+end
+redis.call('LTRIM', KEYS[3], #item_list, -1)
+return {#item_list, redis.call('LLEN', KEYS[3])}
+"""
+
+# Removes the storage from the pod and detaches its item list, so that the first batch
+# of items (or all of them, for small storages) is deleted in the same atomic step
+DEL_STORAGE_LUA = """
+redis.call('LREM', KEYS[1], 1, ARGV[1])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    if redis.call('EXISTS', KEYS[3]) == 1 then
+        for _, item in ipairs(redis.call('LRANGE', KEYS[2], 0, -1)) do
+            redis.call('RPUSH', KEYS[3], item)
+        end
+        redis.call('UNLINK', KEYS[2])
+    else
+        redis.call('RENAME', KEYS[2], KEYS[3])
+    end
+end
+""" + PURGE_STORAGE_BATCH_LUA
+
+# Sets to zero the quantity of the items expired up to the given day in a storage,
+# dropping them from the expiry index; returns how many items were emptied
+# KEYS: expiry index
+# ARGV: storage name, item hash key prefix, last expired day
+EMPTY_EXPIRED_LUA = """
+local prefix = ARGV[1] .. '@'
+local count = 0
+for _, member in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])) do
+    if string.sub(member, 1, #prefix) == prefix then
+        local item_name = string.sub(member, #prefix + 1)
+        local packed = redis.call('HGET', ARGV[2] .. 'item_list:packed', item_name)
+        if packed then
+            local separator = string.find(packed, ':', 1, true)
+            redis.call('HSET', ARGV[2] .. 'item_list:packed', item_name, '0' .. string.sub(packed, separator))
+        else
+            redis.call('HSET', ARGV[2] .. item_name, 'Quantity', 0)
+        end
+        redis.call('ZREM', KEYS[1], member)
+        count = count + 1
+    end
+end
+return count
+"""
+
+# Finds the items whose name starts with the given prefix, in alphabetical order, with their
+# hashes and the count of all the matches; returns the count followed by storage, name,
+# quantity and expiry of every item
+# KEYS: name index
+# ARGV: pod key prefix, first member, last member, count
+FIND_ITEMS_LUA = ITEM_FIELDS_LUA + """
+local page = {redis.call('ZLEXCOUNT', KEYS[1], ARGV[2], ARGV[3])}
+for _, member in ipairs(redis.call('ZRANGEBYLEX', KEYS[1], ARGV[2], ARGV[3], 'LIMIT', 0, ARGV[4])) do
+    local name_end = string.find(member, '@', 1, true)
+    local storage_end = string.find(member, '@', name_end + 1, true)
+    local storage = string.sub(member, name_end + 1, storage_end - 1)
+    local item_name = string.sub(member, storage_end + 1)
+    local fields = get_item_fields(ARGV[1] .. storage .. ':', item_name)
+    table.insert(page, storage)
+    table.insert(page, item_name)
+    table.insert(page, fields[1])
+    table.insert(page, fields[2])
+end
+return page
+"""
+
+# Claims the pods due for their notification, moving each one to its next notification
+# time, unless another run did it in the meantime; returns the claimed pods
+# KEYS: notification queue
+# ARGV: pod, due time, next time, for every pod
+CLAIM_NOTIFICATIONS_LUA = """
+local claimed = {}
+for index = 1, #ARGV, 3 do
+    if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[index])) == tonumber(ARGV[index + 1]) then
+        redis.call('ZADD', KEYS[1], ARGV[index + 2], ARGV[index])
+        table.insert(claimed, ARGV[index])
+    end
+end
+return claimed
+"""
+
+# Takes a lease, or extends it if already held by the same owner; returns 1 on success
+# KEYS: lease
+# ARGV: owner, duration in milliseconds
+ACQUIRE_LEASE_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+elseif not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Gives a lease up, unless it was taken over by another owner in the meantime
+# KEYS: lease
+# ARGV: owner
+RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Reads a window of a storage together with its item hashes, and the length of the
+# whole list; returns the length followed by name, quantity and expiry of every item
+# KEYS: item list
+# ARGV: item hash key prefix, first index, last index
+STORAGE_PAGE_LUA = ITEM_FIELDS_LUA + """
+local page = {redis.call('LLEN', KEYS[1])}
+for _, item_name in ipairs(redis.call('LRANGE', KEYS[1], ARGV[2], ARGV[3])) do
+    local fields = get_item_fields(ARGV[1], item_name)
+    table.insert(page, item_name)
+    table.insert(page, fields[1])
+    table.insert(page, fields[2])
+end
+return page
+"""
+
+# Reads a window of the items indexed up to the given day, oldest expiry first, with their
+# hashes and the count of all the indexed items up to that day; returns the count followed
+# by storage, name, quantity and expiry of every item
+# KEYS: expiry index
+# ARGV: pod key prefix, last day, offset, count
+DUE_ITEMS_PAGE_LUA = ITEM_FIELDS_LUA + """
+local page = {redis.call('ZCOUNT', KEYS[1], '-inf', ARGV[2])}
+for _, member in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[2],
+                                   'LIMIT', ARGV[3], ARGV[4])) do
+    local separator = string.find(member, '@', 1, true)
+    local storage = string.sub(member, 1, separator - 1)
+    local item_name = string.sub(member, separator + 1)
+    local fields = get_item_fields(ARGV[1] .. storage .. ':', item_name)
+    table.insert(page, storage)
+    table.insert(page, item_name)
+    table.insert(page, fields[1])
+    table.insert(page, fields[2])
+end
+return page
+"""
+
+# Reads quantity and expiry of the given items; returns them in the same order
+# ARGV: pod key prefix, storage and name of every item
+ITEM_DETAILS_LUA = ITEM_FIELDS_LUA + """
+local details = {}
+for index = 2, #ARGV, 2 do
+    local fields = get_item_fields(ARGV[1] .. ARGV[index] .. ':', ARGV[index + 1])
+    table.insert(details, fields[1])
+    table.insert(details, fields[2])
+end
+return details
+"""
+
+# Rewrites a batch of the items of a storage in the given schema, leaving the broken ones
+# to the inventory repair; returns how many items were converted
+# KEYS: packed items hash
+# ARGV: item hash key prefix, schema, item names
+CONVERT_ITEMS_LUA = """
+local count = 0
+for index = 3, #ARGV do
+    local item_key = ARGV[1] .. ARGV[index]
+    if ARGV[2] == 'compact' then
+        local fields = redis.call('HMGET', item_key, 'Quantity', 'Expire')
+        if fields[1] and fields[2] then
+            redis.call('HSET', KEYS[1], ARGV[index], fields[1] .. ':' .. fields[2])
+            redis.call('DEL', item_key)
+            count = count + 1
+        end
+    else
+        local packed = redis.call('HGET', KEYS[1], ARGV[index])
+        if packed then
+            local separator = string.find(packed, ':', 1, true)
+            redis.call('HSET', item_key, 'Quantity', string.sub(packed, 1, separator - 1),
+                       'Expire', string.sub(packed, separator + 1))
+            redis.call('HDEL', KEYS[1], ARGV[index])
+            count = count + 1
+        end
+    end
+end
+return count
+"""
+
+
+def read_retry_delay(attempt):
+    # Exponential backoff with full jitter, so the retries of many workers do not line up
+    return uniform(0, READ_RETRY_BASE_DELAY * 2 ** attempt)
+
+
+def idempotent_read(method):
+    # Reads can be safely sent again if the connection drops, e.g. while Redis restarts
+    @wraps(method)
+    def retrying_method(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                if (attempt >= self._db_read_retries):
+                    raise
+                delay = read_retry_delay(attempt)
+                logging.warning("Database read '{}' failed ({}): retrying in {:.2f}s"
+                                .format(method.__name__, e, delay))
+                sleep(delay)
+                attempt += 1
+    return retrying_method
+
 
 class DbConnectionSingleton:
 
@@ -22,7 +352,22 @@ class DbConnectionSingleton:
             raise Exception("This class is a singleton, and an instance exists yet!")
         else:
             DbConnectionSingleton.__instance = self
+            self._metrics = MetricsSingleton.getInstance()
             self._db_connect()
+            self._register_scripts()
+            self._inventory_cache = InventoryCache()
+            self._conversation_ttl = int(environ.get("CONVERSATION_TTL", 86400))
+            self._callback_ttl = int(environ.get("CALLBACK_TTL", 604800))
+            self._del_storage_batch_size = int(environ.get("DEL_STORAGE_BATCH_SIZE", 500))
+            self._import_batch_size = int(environ.get("IMPORT_BATCH_SIZE", 500))
+            self._notify_time = environ.get("NOTIFY_TIME", "08:00")
+            self._validate_input_time(self._notify_time)
+            self._notify_spread = int(environ.get("NOTIFY_SPREAD", 3600))
+            self._item_schema = environ.get("ITEM_SCHEMA", "legacy")
+            if (self._item_schema not in ITEM_SCHEMAS):
+                raise Exception("Wrong ITEM_SCHEMA! It must be one of: {}".format(", ".join(ITEM_SCHEMAS)))
+            if (self._metrics.is_enabled()):
+                self._metrics.instrument_db(self)
 
     def _db_connect(self):
         try:
@@ -41,11 +386,82 @@ class DbConnectionSingleton:
             self._timezone = pytz.timezone("Europe/Rome")
 
         finally:
-            self._db_instance = redis.Redis(host=self._db_host,
-                                            port=self._db_port,
-                                            db=self._db_name,
-                                            password=self._db_pass,
-                                            decode_responses=True)
+            self._db_socket = environ.get("REDIS_SOCKET")
+            self._db_max_connections = int(environ.get("REDIS_MAX_CONNECTIONS", 32))
+            self._db_pool_timeout = float(environ.get("REDIS_POOL_TIMEOUT", 10))
+            self._db_socket_timeout = float(environ.get("REDIS_SOCKET_TIMEOUT", 5))
+            self._db_connect_timeout = float(environ.get("REDIS_CONNECT_TIMEOUT", 5))
+            self._db_health_check_interval = int(environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30))
+            self._db_read_retries = int(environ.get("REDIS_READ_RETRIES", 3))
+            connection_kwargs = {"db": self._db_name,
+                                 "password": self._db_pass,
+                                 "socket_timeout": self._db_socket_timeout,
+                                 "health_check_interval": self._db_health_check_interval,
+                                 "decode_responses": True}
+            if (self._db_socket is not None):
+                # Co-located Redis: skip the TCP stack entirely
+                connection_kwargs["connection_class"] = redis.UnixDomainSocketConnection
+                connection_kwargs["path"] = self._db_socket
+            else:
+                connection_kwargs["host"] = self._db_host
+                connection_kwargs["port"] = self._db_port
+                connection_kwargs["socket_connect_timeout"] = self._db_connect_timeout
+            if (self._metrics.is_enabled()):
+                connection_kwargs["connection_class"] = self._metrics.instrument_connection_class(
+                    connection_kwargs.get("connection_class", redis.Connection))
+            self._db_pool = MonitoredConnectionPool(max_connections=self._db_max_connections,
+                                                    timeout=self._db_pool_timeout,
+                                                    **connection_kwargs)
+            self._db_instance = redis.Redis(connection_pool=self._db_pool)
+
+    def _register_scripts(self):
+        self._scripts = []
+        self._set_conversation_state_script = \
+            self._register_script(SET_CONVERSATION_STATE_LUA)
+        self._save_item_script = self._register_script(SAVE_ITEM_LUA)
+        self._move_item_script = self._register_script(MOVE_ITEM_LUA)
+        self._del_storage_script = self._register_script(DEL_STORAGE_LUA)
+        self._purge_storage_batch_script = \
+            self._register_script(PURGE_STORAGE_BATCH_LUA)
+        self._empty_expired_script = self._register_script(EMPTY_EXPIRED_LUA)
+        self._storage_page_script = self._register_script(STORAGE_PAGE_LUA)
+        self._due_items_page_script = self._register_script(DUE_ITEMS_PAGE_LUA)
+        self._claim_notifications_script = \
+            self._register_script(CLAIM_NOTIFICATIONS_LUA)
+        self._find_items_script = self._register_script(FIND_ITEMS_LUA)
+        self._acquire_lease_script = self._register_script(ACQUIRE_LEASE_LUA)
+        self._release_lease_script = self._register_script(RELEASE_LEASE_LUA)
+        self._item_details_script = self._register_script(ITEM_DETAILS_LUA)
+        self._convert_items_script = self._register_script(CONVERT_ITEMS_LUA)
+
+    def _register_script(self, lua):
+        script = self._db_instance.register_script(lua)
+        self._scripts.append(script)
+        return script
+
+    @idempotent_read
+    def warm_up(self, connection_count):
+        # Opens the first connections before any update arrives, failing fast if the database
+        # is unreachable, and loads the scripts so that even their first calls find them
+        connections = []
+        try:
+            # All of them are held at once, so that the pool creates a new one every time
+            for _ in range(min(connection_count, self._db_max_connections)):
+                connections.append(self._db_pool.get_connection("PING"))
+                connections[-1].send_command("PING")
+                connections[-1].read_response()
+        finally:
+            for connection in connections:
+                self._db_pool.release(connection)
+        pipe = self._db_instance.pipeline(transaction=False)
+        for script in self._scripts:
+            pipe.script_load(script.script)
+        pipe.execute()
+        return len(connections)
+
+    @idempotent_read
+    def ping(self):
+        return self._db_instance.ping()
 
     def get_db_host(self):
         return copy(self._db_host)
@@ -59,9 +475,25 @@ class DbConnectionSingleton:
     def get_db_pass(self):
         return copy(self._db_pass)
 
+    def get_db_socket(self):
+        return copy(self._db_socket)
+
+    def get_connection_settings(self):
+        return {"max_connections": self._db_max_connections,
+                "pool_timeout": self._db_pool_timeout,
+                "socket_timeout": self._db_socket_timeout,
+                "connect_timeout": self._db_connect_timeout,
+                "health_check_interval": self._db_health_check_interval,
+                "read_retries": self._db_read_retries}
+
+    def get_pool_stats(self):
+        return self._db_pool.get_stats()
+
     def get_info(self):
         try:
             res = self._db_instance.info(section='Server')
+            res["foodpod_inventory_cache"] = self.get_cache_stats()
+            res["foodpod_connection_pool"] = self.get_pool_stats()
         except redis.exceptions.ConnectionError:
             res = "🚨 Error contacting the database backend"
             logging.error("Error contacting the database backend: ConnectionError at {}:{}"
@@ -69,24 +501,76 @@ class DbConnectionSingleton:
         finally:
             return res
 
+    def get_cache_stats(self):
+        return self._inventory_cache.get_stats()
+
+    def get_item_schema(self):
+        return self._item_schema
+
+    def get_memory_usage(self):
+        # Returns the bytes used by the keys of every pod, as estimated by Redis, and their
+        # count; the keyspace is scanned once for all the pods, measuring the keys in batches
+        memory_usage = {pod: {"bytes": 0, "keys": 0} for pod in self.iter_pods()}
+        key_pods = []
+        pipe = self._db_instance.pipeline(transaction=False)
+        for key in self._db_instance.scan_iter(count=500):
+            pod = self._get_key_pod(key)
+            if (pod in memory_usage):
+                pipe.memory_usage(key)
+                key_pods.append(pod)
+                if (len(pipe) >= 500):
+                    self._add_memory_usage(memory_usage, key_pods, pipe.execute())
+        self._add_memory_usage(memory_usage, key_pods, pipe.execute())
+        return memory_usage
+
+    def _add_memory_usage(self, memory_usage, key_pods, key_sizes):
+        # The keys deleted since the scan have no size
+        for pod, key_size in zip(key_pods, key_sizes):
+            if (key_size is not None):
+                memory_usage[pod]["bytes"] += key_size
+                memory_usage[pod]["keys"] += 1
+        key_pods.clear()
+
+    def _get_key_pod(self, key):
+        return key.split(":", 1)[0]
+
+    def _scan_pod_keys(self, pods):
+        # Groups the keys of the given pods, walking the keyspace once
+        pod_keys = {pod: [] for pod in pods}
+        for key in self._db_instance.scan_iter(count=500):
+            pod = self._get_key_pod(key)
+            if (pod in pod_keys):
+                pod_keys[pod].append(key)
+        return pod_keys
+
+    @idempotent_read
     def is_pod_registered(self, chatid):
-        # TODO: Check why lpos method is not available for a redis.Redis instance
-        global_pods = self.get_pods()
-        for registered_id in global_pods:
-            if registered_id == chatid:
-                return True
-        return False
+        return bool(self._db_instance.sismember("global:pods", chatid))
 
     def _validate_input_text(self, user_input):
         if (len(user_input) > 20 or ':' in user_input or '@' in user_input):
             raise Exception("Wrong input! You must enter at most 20 characters, avoiding ':' and '@'")
 
     def _validate_input_date(self, user_input):
+        self._parse_input_date(user_input)
+
+    def _parse_input_date(self, user_input):
+        # Returns the epoch day the date is saved with, so that it is validated only once
         try:
-            datetime.strptime(user_input, "%Y-%m-%d").date()
+            return self._parse_date(user_input)
         except ValueError:
             raise Exception("Wrong input! You must enter a date in the format YYYY-MM-DD")
 
+    def _validate_input_time(self, user_input):
+        try:
+            datetime.strptime(user_input, "%H:%M")
+        except ValueError:
+            raise Exception("Wrong input! You must enter a time in the format HH:MM")
+
+    def _validate_input_timezone(self, user_input):
+        if (user_input not in pytz.all_timezones_set):
+            raise Exception("Wrong input! You must enter a timezone name, like Europe/Rome")
+
     def _validate_input_quantity(self, user_input):
         try:
             int(user_input)
@@ -94,111 +578,813 @@ class DbConnectionSingleton:
             raise Exception("Wrong input! You must enter an integer")
 
     def add_pod(self, chatid):
-        self._db_instance.lpush("global:pods", chatid)
+        # Returns False when the pod was registered yet, also under concurrent calls
+        if (self._db_instance.sadd("global:pods", chatid) == 0):
+            return False
+        self.schedule_notification(chatid)
+        return True
 
+    @idempotent_read
     def get_pods(self):
-        return self._db_instance.lrange("global:pods", 0, -1)
+        return self._db_instance.smembers("global:pods")
 
-    def set_global_cmd_name(self, chatid, cmd_name):
-        self._db_instance.hset(chatid+":global_command", "Name", cmd_name)
+    def iter_pods(self, batch_size=100):
+        # Cursor based: the IDs are fetched in batches, and a pod may be returned twice
+        # if the set is resized while the iteration is in progress
+        return self._db_instance.sscan_iter("global:pods", count=batch_size)
 
-    def set_global_cmd_arg(self, chatid, cmd_arg):
-        self._db_instance.hset(chatid+":global_command", "Arg", cmd_arg)
+    def migrate_pod_registry(self):
+        # One-shot conversion of the pods registry from a list into a set
+        def _convert_pods_list(pipe):
+            if (pipe.type("global:pods") != "list"):
+                return
+            pod_list = pipe.lrange("global:pods", 0, -1)
+            registered_pods = set()
+            for pod in pod_list:
+                if (pod in registered_pods):
+                    logging.warning("Food Pod '{}' was registered more than once: merging duplicates"
+                                    .format(pod))
+                registered_pods.add(pod)
+            pipe.multi()
+            pipe.delete("global:pods")
+            if (len(registered_pods) > 0):
+                pipe.sadd("global:pods", *registered_pods)
+            logging.info("Migrated {} Food Pods ({} duplicates dropped) into the pods registry set"
+                         .format(len(registered_pods), len(pod_list) - len(registered_pods)))
+        self._db_instance.transaction(_convert_pods_list, "global:pods")
 
-    def get_global_cmd_name(self, chatid):
-        return self._db_instance.hget(chatid+":global_command", "Name")
+    @idempotent_read
+    def get_conversation_state(self, chatid):
+        cmd_name, cmd_arg, version = self._db_instance.hmget(chatid + ":global_command",
+                                                             "Name", "Arg", "Version")
+        # An expired or missing state is the same as having no action in progress
+        return {"name": cmd_name if cmd_name is not None else "none",
+                "arg": cmd_arg if cmd_arg is not None else "none",
+                "version": int(version) if version is not None else 0}
 
-    def get_global_cmd_arg(self, chatid):
-        return self._db_instance.hget(chatid+":global_command", "Arg")
+    def set_conversation_state(self, chatid, cmd_name, cmd_arg, version=None):
+        # Without a version the state is overwritten, whatever its current value
+        expected_version = version if version is not None else -1
+        new_version = self._set_conversation_state_script(
+            keys=[chatid + ":global_command"],
+            args=[cmd_name, cmd_arg, expected_version, self._conversation_ttl])
+        if (new_version < 0):
+            raise ConversationStateConflict("The chat was updated by another action in the "
+                                            "meantime, please try again")
+        return new_version
+
+    def save_callbacks(self, callbacks):
+        # All the tokens of a keyboard in one round trip, if any
+        if (len(callbacks) == 0):
+            return
+        pipe = self._db_instance.pipeline(transaction=False)
+        pipe.mset({"global:callback:" + token: callback_data for token, callback_data in callbacks.items()})
+        for token in callbacks:
+            pipe.expire("global:callback:" + token, self._callback_ttl)
+        pipe.execute()
+
+    @idempotent_read
+    def get_callback(self, token):
+        return self._db_instance.get("global:callback:" + token)
 
     def add_storage(self, chatid, name):
+        # A storage with the same name may still be under deletion: its items must be gone
+        # before the new one can be filled
+        for _ in self.purge_deleted_storage(chatid, name):
+            pass
         self._db_instance.lpush(chatid + ":storage_list", name)
+        self._inventory_cache.invalidate(chatid)
 
     def get_storage_list(self, chatid):
+        return self._inventory_cache.get_or_load(
+            chatid, None, lambda: self._load_storage_list(chatid))
+
+    @idempotent_read
+    def _load_storage_list(self, chatid):
         return self._db_instance.lrange(chatid + ":storage_list", 0, -1)
 
+    def get_storage_list_page(self, chatid, page, page_size):
+        # Returns the count of all the storages, and the names in the requested page
+        start = page * page_size
+        return self._inventory_cache.get_or_load(
+            chatid, None, lambda: self._load_storage_list_page(chatid, start, start + page_size - 1),
+            page=(start, page_size))
+
+    @idempotent_read
+    def _load_storage_list_page(self, chatid, start, stop):
+        pipe = self._db_instance.pipeline(transaction=False)
+        pipe.llen(chatid + ":storage_list")
+        pipe.lrange(chatid + ":storage_list", start, stop)
+        storage_count, storage_list = pipe.execute()
+        return (storage_count, storage_list)
+
+    def _get_storage_deletion_keys(self, chatid, storage):
+        return [chatid + ":storage_list",
+                chatid + ":" + storage + ":item_list",
+                chatid + ":" + storage + ":item_list:deleting",
+                chatid + ":expiry_index",
+                chatid + ":name_index"]
+
+    def _get_storage_deletion_args(self, chatid, storage):
+        return [storage, chatid + ":" + storage + ":", self._del_storage_batch_size]
+
     def del_storage(self, chatid, storage):
-        for item in self.get_item_list(chatid, storage):
-            self._db_instance.delete(chatid + ":" + storage + ":" + item)
-        self._db_instance.delete(chatid + ":" + storage + ":item_list")
-        self._db_instance.lrem(chatid + ":storage_list", 1, storage)
+        # Returns the count of deleted items, and of the ones left to purge_deleted_storage
+        deleted_count, pending_count = self._del_storage_script(
+            keys=self._get_storage_deletion_keys(chatid, storage),
+            args=self._get_storage_deletion_args(chatid, storage))
+        self._inventory_cache.invalidate(chatid)
+        self._inventory_cache.invalidate(chatid, storage)
+        return deleted_count, pending_count
+
+    def purge_deleted_storage(self, chatid, storage):
+        # Yields the count of items still to be deleted after each batch
+        pending_count = 1
+        while (pending_count > 0):
+            deleted_count, pending_count = self._purge_storage_batch_script(
+                keys=self._get_storage_deletion_keys(chatid, storage),
+                args=self._get_storage_deletion_args(chatid, storage))
+            if (deleted_count > 0):
+                yield pending_count
+
+    def add_item(self, chatid, storage, item_name, quantity=0, expiry=DEFAULT_ITEM_EXPIRY):
+        self.set_item(chatid, storage, item_name, quantity, expiry)
+
+    def set_item(self, chatid, storage, item_name, quantity, expiry):
+        # The item is created if missing, so it is never left without its list entry; returns
+        # True if the item has just become due
+        previous_day = self._queue_save_item(self._db_instance, chatid, storage, item_name,
+                                             quantity, expiry)
+        self._inventory_cache.invalidate(chatid, storage)
+        return self._has_become_due(int(previous_day) if previous_day is not None else None,
+                                    self._get_indexed_day(quantity, expiry))
 
-    def add_item(self, chatid, storage, item_name):
-        self._db_instance.lpush(chatid + ":" + storage + ":item_list", item_name)
-        self.set_item_quantity(chatid, storage, item_name, 0)
-        self.set_item_expiry(chatid, storage, item_name, "2000-12-31")
+    def _queue_save_item(self, client, chatid, storage, item_name, quantity, expiry):
+        return self._save_item_script(
+            keys=[chatid + ":" + storage + ":" + item_name,
+                  chatid + ":" + storage + ":item_list",
+                  chatid + ":expiry_index",
+                  chatid + ":name_index",
+                  self._get_packed_items_key(chatid, storage)],
+            args=[item_name, quantity, self._parse_expiry(expiry), storage + "@" + item_name,
+                  self._get_name_index_member(storage, item_name), self._item_schema],
+            client=client)
+
+    def import_items(self, chatid, rows):
+        # Saves the (storage, item, quantity, expiry) rows in pipelined batches, consuming them
+        # lazily, so the memory in use does not depend on their number; the missing storages
+        # are created on the way
+        storage_list = set(self.get_storage_list(chatid))
+        counts = {"items": 0, "new_storages": 0}
+        batch_storages = set()
+        pipe = self._db_instance.pipeline(transaction=False)
+        for storage, item_name, quantity, expiry in rows:
+            if (storage not in storage_list):
+                self.add_storage(chatid, storage)
+                storage_list.add(storage)
+                counts["new_storages"] += 1
+            self._queue_save_item(pipe, chatid, storage, item_name, quantity, expiry)
+            batch_storages.add(storage)
+            counts["items"] += 1
+            if (len(pipe) >= self._import_batch_size):
+                self._save_import_batch(pipe, chatid, batch_storages)
+        self._save_import_batch(pipe, chatid, batch_storages)
+        return counts
+
+    def _save_import_batch(self, pipe, chatid, batch_storages):
+        pipe.execute()
+        for storage in batch_storages:
+            self._inventory_cache.invalidate(chatid, storage)
+        batch_storages.clear()
+
+    def iter_inventory(self, chatid, batch_size=500):
+        # Yields every item of the pod, reading each storage one window at a time
+        for storage in self.get_storage_list(chatid):
+            start = 0
+            item_count = 1
+            while (start < item_count):
+                item_count, item_list = self._load_storage_page(chatid, storage, start,
+                                                                start + batch_size - 1)
+                for item_dict in item_list:
+                    yield item_dict
+                start += batch_size
+
+    def move_item(self, chatid, storage, item_name, new_storage, new_item_name=None):
+        if (new_item_name is None):
+            new_item_name = item_name
+        if (new_storage not in self.get_storage_list(chatid)):
+            raise Exception("The storage '{}' does not exist".format(new_storage))
+        moved = self._move_item_script(
+            keys=[chatid + ":" + storage + ":" + item_name,
+                  chatid + ":" + storage + ":item_list",
+                  chatid + ":" + new_storage + ":" + new_item_name,
+                  chatid + ":" + new_storage + ":item_list",
+                  chatid + ":expiry_index",
+                  chatid + ":name_index",
+                  self._get_packed_items_key(chatid, storage),
+                  self._get_packed_items_key(chatid, new_storage)],
+            args=[item_name, new_item_name, storage + "@" + item_name,
+                  new_storage + "@" + new_item_name,
+                  self._get_name_index_member(storage, item_name),
+                  self._get_name_index_member(new_storage, new_item_name)])
+        self._inventory_cache.invalidate(chatid, storage)
+        self._inventory_cache.invalidate(chatid, new_storage)
+        if (moved == 0):
+            raise Exception("The item '{}' does not exist in the storage '{}'".format(item_name, storage))
+        if (moved < 0):
+            raise Exception("The item '{}' exists yet in the storage '{}'".format(new_item_name, new_storage))
 
     def del_item(self, chatid, storage, item_name):
-        self._db_instance.delete(chatid + ":" + storage + ":" + item_name)
-        self._db_instance.lrem(chatid + ":" + storage + ":item_list", 1, item_name)
+        pipe = self._db_instance.pipeline()
+        pipe.unlink(chatid + ":" + storage + ":" + item_name)
+        pipe.hdel(self._get_packed_items_key(chatid, storage), item_name)
+        pipe.zrem(chatid + ":expiry_index", storage + "@" + item_name)
+        pipe.zrem(chatid + ":name_index", self._get_name_index_member(storage, item_name))
+        pipe.lrem(chatid + ":" + storage + ":item_list", 1, item_name)
+        pipe.execute()
+        self._inventory_cache.invalidate(chatid, storage)
+
+    def get_item(self, chatid, storage, item_name):
+        # An item is usually selected from a page of its storage, which is cached already;
+        # otherwise it is cached alone
+        item_dict = self._inventory_cache.find_item(chatid, storage, item_name)
+        if (item_dict is not None):
+            return item_dict
+        return self._inventory_cache.get_or_load(
+            chatid, storage, lambda: self._get_item_details(chatid, [(storage, item_name)]),
+            page=item_name)[0]
 
     def get_item_quantity(self, chatid, storage, item_name):
-        return int(self._db_instance.hget(chatid + ":" + storage + ":" + item_name, "Quantity"))
+        return self.get_item(chatid, storage, item_name)["quantity"]
 
     def get_item_expiry(self, chatid, storage, item_name):
-        return datetime.strptime(self._db_instance.hget(chatid+":"+storage+":"+item_name, "Expire"),
-                                 "%Y-%m-%d").date()
+        return self.day_to_date(self.get_item(chatid, storage, item_name)["expiry"])
+
+    def _get_packed_items_key(self, chatid, storage):
+        return chatid + ":" + storage + ":" + PACKED_ITEMS_KEY
+
+    def _get_item_keys(self, chatid, storage, item_name):
+        # The keys an item may be saved in, whatever the schema
+        return [chatid + ":" + storage + ":" + item_name, self._get_packed_items_key(chatid, storage)]
 
-    def set_item_quantity(self, chatid, storage, item_name, quantity):
-        self._db_instance.hset(chatid + ":" + storage + ":" + item_name, "Quantity", quantity)
+    def _pack_item_fields(self, quantity, expiry_day):
+        return "{}:{}".format(quantity, expiry_day)
 
-    def set_item_expiry(self, chatid, storage, item_name, expiry):
-        self._db_instance.hset(chatid + ":" + storage + ":" + item_name, "Expire", expiry)
+    def _unpack_item_fields(self, packed):
+        return tuple(packed.split(":", 1))
 
-    def get_item_list(self, chatid, storage):
-        return self._db_instance.lrange(chatid + ":" + storage + ":item_list", 0, -1)
+    def _queue_item_fields(self, pipe, chatid, storage, item_name, quantity, expiry_day):
+        # Saves the item in the configured schema, dropping it from the other one
+        item_key, packed_items_key = self._get_item_keys(chatid, storage, item_name)
+        if (self._item_schema == "compact"):
+            pipe.hset(packed_items_key, item_name, self._pack_item_fields(quantity, expiry_day))
+            pipe.unlink(item_key)
+        else:
+            pipe.hset(item_key, mapping={"Quantity": quantity, "Expire": expiry_day})
+            pipe.hdel(packed_items_key, item_name)
+
+    def _date_to_day(self, day_date):
+        return (day_date - EPOCH_DATE).days
+
+    def day_to_date(self, day):
+        if (day is None):
+            return None
+        return EPOCH_DATE + timedelta(days=day)
+
+    def _parse_expiry(self, expiry):
+        # Expiry dates are saved as days since the epoch, so that they are compared with
+        # integer arithmetic; the dates saved by older versions are still read, and are
+        # replaced by the next write of their item; they are parsed the same as the input,
+        # which does not require the month and the day to be zero padded
+        try:
+            return int(expiry)
+        except ValueError:
+            return self._parse_date(expiry)
+
+    def _parse_date(self, text):
+        return self._date_to_day(datetime.strptime(text, "%Y-%m-%d").date())
+
+    def _get_indexed_day(self, quantity, expiry):
+        # The day an item is indexed with, or None if it is not in stock
+        if (quantity is None or int(quantity) <= 0 or expiry is None):
+            return None
+        return self._parse_expiry(expiry)
 
+    def _has_become_due(self, previous_indexed_day, indexed_day):
+        # Due items are read from the index up to a day depending on the current one, so no
+        # rollover pass is needed: items become due just by the passing of the days
+        last_due_day = self.get_current_day() + DUE_WITHIN_DAYS
+        return (indexed_day is not None and indexed_day <= last_due_day
+                and (previous_indexed_day is None or previous_indexed_day > last_due_day))
+
+    @idempotent_read
+    def _get_indexed_items(self, chatid, max_expiry_day):
+        indexed_members = self._db_instance.zrangebyscore(chatid + ":expiry_index", "-inf",
+                                                          max_expiry_day)
+        return self._split_index_members(indexed_members)
+
+    def _get_name_index_member(self, storage, item_name):
+        # The folded name comes first, so the members are sorted and searched by it
+        return item_name.translate(NAME_INDEX_FOLD) + "@" + storage + "@" + item_name
+
+    def find_items(self, chatid, prefix, limit):
+        # Returns the count of the items whose name starts with the prefix, and the first ones
+        # in alphabetical order; the last Unicode code point sorts after any name
+        folded_prefix = prefix.translate(NAME_INDEX_FOLD)
+        return self._load_found_items(chatid, ["[" + folded_prefix, "[" + folded_prefix + chr(0x10FFFF)],
+                                      limit)
+
+    @idempotent_read
+    def _load_found_items(self, chatid, lex_range, limit):
+        page = self._find_items_script(keys=[chatid + ":name_index"],
+                                       args=[chatid + ":"] + lex_range + [limit])
+        return (page[0], self._parse_indexed_items(page))
+
+    def _split_index_members(self, indexed_members):
+        return [tuple(member.split("@", 1)) for member in indexed_members]
+
+    @idempotent_read
     def get_item_list_len(self, chatid, storage):
         return self._db_instance.llen(chatid + ":" + storage + ":item_list")
 
     def get_current_date(self):
         return date.today()
 
-    def get_notify_time(self):
-        # The job_queue timers will use the offset from TZ env var!
-        _notify_time = time(8, 0, 0)
-        _notify_date = self.get_current_date()
-        _notify_at = datetime(year=_notify_date.year,
-                              month=_notify_date.month,
-                              day=_notify_date.day,
-                              hour=_notify_time.hour,
-                              minute=_notify_time.minute,
-                              second=_notify_time.second,
-                              tzinfo=self._timezone)
-        return _notify_at
+    def get_current_day(self):
+        return self._date_to_day(self.get_current_date())
+
+    def get_timestamp(self):
+        return int(datetime.now(pytz.utc).timestamp())
+
+    def _parse_notify_settings(self, chatid, fields):
+        # Pods without a time of their own are spread over the NOTIFY_SPREAD seconds
+        # following the default one, so they are not all notified at once
+        notify_time, timezone = fields
+        settings = {"time": notify_time, "timezone": timezone, "offset": 0}
+        if (notify_time is None):
+            settings["time"] = self._notify_time
+            if (self._notify_spread > 0):
+                settings["offset"] = zlib.crc32(chatid.encode()) % self._notify_spread
+        if (timezone is None):
+            settings["timezone"] = self._timezone.zone
+        return settings
+
+    def _get_next_notify_at(self, settings, after):
+        # Timestamp of the first notification time strictly later than the given one
+        timezone = pytz.timezone(settings["timezone"])
+        notify_time = datetime.strptime(settings["time"], "%H:%M").time()
+        local_date = datetime.fromtimestamp(after, timezone).date()
+        for days in range(-1, 3):
+            notify_at = timezone.localize(datetime.combine(local_date + timedelta(days=days),
+                                                           notify_time))
+            notify_at = int(notify_at.timestamp()) + settings["offset"]
+            if (notify_at > after):
+                return notify_at
+
+    @idempotent_read
+    def get_notify_settings(self, chatid):
+        # Returns the notification time and timezone of a pod, and when it is notified next
+        pipe = self._db_instance.pipeline(transaction=False)
+        pipe.hmget(chatid + ":notify_settings", "Time", "Timezone")
+        pipe.zscore(NOTIFY_QUEUE_KEY, chatid)
+        fields, notify_at = pipe.execute()
+        settings = self._parse_notify_settings(chatid, fields)
+        timezone = pytz.timezone(settings["timezone"])
+        notify_time = (datetime.strptime(settings["time"], "%H:%M") +
+                       timedelta(seconds=settings["offset"])).time()
+        return {"time": notify_time.strftime("%H:%M"),
+                "timezone": settings["timezone"],
+                "next": datetime.fromtimestamp(notify_at, timezone) if notify_at is not None else None}
+
+    def set_notify_settings(self, chatid, notify_time, timezone=None):
+        self._validate_input_time(notify_time)
+        fields = {"Time": notify_time}
+        if (timezone is not None):
+            self._validate_input_timezone(timezone)
+            fields["Timezone"] = timezone
+        self._db_instance.hset(chatid + ":notify_settings", mapping=fields)
+        self.schedule_notification(chatid, replace=True)
+
+    def schedule_notification(self, chatid, notify_at=None, replace=False):
+        # The queue holds every pod by the timestamp of its next notification; unless
+        # replacing it, a pod already queued keeps its time
+        if (notify_at is None):
+            fields = self._db_instance.hmget(chatid + ":notify_settings", "Time", "Timezone")
+            notify_at = self._get_next_notify_at(self._parse_notify_settings(chatid, fields),
+                                                 self.get_timestamp())
+        self._db_instance.zadd(NOTIFY_QUEUE_KEY, {chatid: notify_at}, nx=not replace)
+
+    def _get_notification_claims(self, due_pods, settings_fields, now):
+        # A pod missed while the bot was down is notified once, then from now on as usual
+        claims = []
+        for (pod, due_at), fields in zip(due_pods, settings_fields):
+            claims.extend([pod, int(due_at),
+                           self._get_next_notify_at(self._parse_notify_settings(pod, fields), now)])
+        return claims
+
+    def claim_due_notifications(self, batch_size):
+        # The pods are moved forward before being notified: one interrupted by a restart
+        # is skipped until its next time, rather than being notified twice
+        now = self.get_timestamp()
+        due_pods = self._db_instance.zrangebyscore(NOTIFY_QUEUE_KEY, "-inf", now,
+                                                   start=0, num=batch_size, withscores=True)
+        if (len(due_pods) == 0):
+            return []
+        pipe = self._db_instance.pipeline(transaction=False)
+        for pod, _ in due_pods:
+            pipe.hmget(pod + ":notify_settings", "Time", "Timezone")
+        return self._claim_notifications_script(
+            keys=[NOTIFY_QUEUE_KEY],
+            args=self._get_notification_claims(due_pods, pipe.execute(), now))
+
+    def iter_due_notifications(self, batch_size):
+        # Claims one batch at a time, until no pod is due anymore
+        while True:
+            claimed_pods = self.claim_due_notifications(batch_size)
+            if (len(claimed_pods) == 0):
+                return
+            for pod in claimed_pods:
+                yield pod
+
+    def migrate_notify_queue(self):
+        # One-shot scheduling of the pods registered before the notification queue
+        if (self._db_instance.sismember("global:migrations", "notify_queue")):
+            return
+        scheduled_pods = 0
+        for pod in self.iter_pods():
+            self.schedule_notification(pod)
+            scheduled_pods += 1
+        logging.info("Scheduled the notification of {} Food Pods".format(scheduled_pods))
+        self._db_instance.sadd("global:migrations", "notify_queue")
+
+    def acquire_lease(self, lease, owner, duration):
+        # The duration is in seconds; the same call also extends a lease already held
+        return self._acquire_lease_script(keys=["global:lease:" + lease],
+                                          args=[owner, int(duration * 1000)]) == 1
+
+    def release_lease(self, lease, owner):
+        return self._release_lease_script(keys=["global:lease:" + lease], args=[owner]) == 1
+
+    def register_instance(self, instance_id, duration):
+        # Returns how many instances are alive, including this one
+        now = self.get_timestamp()
+        pipe = self._db_instance.pipeline()
+        pipe.zadd(INSTANCES_KEY, {instance_id: now + duration})
+        pipe.zremrangebyscore(INSTANCES_KEY, "-inf", now)
+        pipe.zcard(INSTANCES_KEY)
+        return pipe.execute()[-1]
+
+    def unregister_instance(self, instance_id):
+        self._db_instance.zrem(INSTANCES_KEY, instance_id)
+
+    def _get_update_stream(self, shard):
+        return "global:updates:" + str(shard)
+
+    def create_update_stream(self, shard):
+        try:
+            self._db_instance.xgroup_create(self._get_update_stream(shard), UPDATE_STREAM_GROUP,
+                                            id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if ("BUSYGROUP" not in str(e)):
+                raise
+
+    def publish_update(self, shard, update_json, max_length):
+        self._db_instance.xadd(self._get_update_stream(shard), {"update": update_json},
+                               maxlen=max_length, approximate=True)
+
+    def read_updates(self, shard, consumer, pending, count, block):
+        # Either the updates read by the consumer before and never acknowledged, or new ones,
+        # waiting for them up to the given milliseconds; returns (entry ID, update) pairs
+        streams = self._db_instance.xreadgroup(UPDATE_STREAM_GROUP, consumer,
+                                               {self._get_update_stream(shard): "0" if pending else ">"},
+                                               count=count, block=None if pending else block)
+        if (len(streams) == 0):
+            return []
+        # The entries trimmed from the stream while pending are left without their fields
+        return [(entry_id, fields["update"] if fields else None) for entry_id, fields in streams[0][1]]
+
+    def ack_update(self, shard, entry_id):
+        # Processed updates are of no further use
+        pipe = self._db_instance.pipeline()
+        pipe.xack(self._get_update_stream(shard), UPDATE_STREAM_GROUP, entry_id)
+        pipe.xdel(self._get_update_stream(shard), entry_id)
+        pipe.execute()
+
+    def _parse_item_fields(self, storage, item_name, fields):
+        quantity, expiry = fields
+        return {"item_name": item_name,
+                "storage": storage,
+                "quantity": int(quantity) if quantity is not None else 0,
+                "expiry": self._parse_expiry(expiry) if expiry is not None else None}
+
+    def _get_item_details_args(self, chatid, storage_item_pairs):
+        return [chatid + ":"] + [name for storage_item_pair in storage_item_pairs
+                                 for name in storage_item_pair]
+
+    def _parse_item_details(self, storage_item_pairs, details):
+        # Quantity and expiry of every item, one after the other
+        return [self._parse_item_fields(storage, item_name, details[index * 2:index * 2 + 2])
+                for index, (storage, item_name) in enumerate(storage_item_pairs)]
+
+    @idempotent_read
+    def _get_item_details(self, chatid, storage_item_pairs):
+        # One round trip for every batch of items, whatever the schema they are saved in
+        item_details = []
+        for start in range(0, len(storage_item_pairs), ITEM_DETAILS_BATCH_SIZE):
+            batch_pairs = storage_item_pairs[start:start + ITEM_DETAILS_BATCH_SIZE]
+            item_details.extend(self._parse_item_details(batch_pairs, self._item_details_script(
+                args=self._get_item_details_args(chatid, batch_pairs))))
+        return item_details
+
+    def get_storage_page(self, chatid, storage, page, page_size):
+        # Returns the count of all the items in the storage, and the items in the requested page
+        start = page * page_size
+        return self._inventory_cache.get_or_load(
+            chatid, storage,
+            lambda: self._load_storage_page(chatid, storage, start, start + page_size - 1),
+            page=(start, page_size))
+
+    @idempotent_read
+    def _load_storage_page(self, chatid, storage, start, stop):
+        # A single round trip, whatever the size of the storage
+        return self._parse_storage_page(storage, self._storage_page_script(
+            keys=[chatid + ":" + storage + ":item_list"],
+            args=[chatid + ":" + storage + ":", start, stop]))
+
+    def _parse_storage_page(self, storage, page):
+        return (page[0], [self._parse_item_fields(storage, page[index], page[index + 1:index + 3])
+                          for index in range(1, len(page), 3)])
+
+    def get_pod_snapshot(self, chatid):
+        # Three round trips: the storage list, all the item lists, then all the item hashes
+        storage_list = self.get_storage_list(chatid)
+        storage_item_pairs = []
+        for storage, item_list in zip(storage_list, self._load_item_lists(chatid, storage_list)):
+            storage_item_pairs.extend((storage, item_name) for item_name in item_list)
+        snapshot = {storage: [] for storage in storage_list}
+        for item_dict in self._get_item_details(chatid, storage_item_pairs):
+            snapshot[item_dict["storage"]].append(item_dict)
+        return snapshot
+
+    @idempotent_read
+    def _load_item_lists(self, chatid, storage_list):
+        pipe = self._db_instance.pipeline(transaction=False)
+        for storage in storage_list:
+            pipe.lrange(chatid + ":" + storage + ":item_list", 0, -1)
+        return pipe.execute()
+
+    def _select_due_items(self, item_list, current_day, min_days_expired):
+        # The whole batch is classified in one pass over the epoch days of its items
+        max_expiry_day = current_day - min_days_expired
+        due_items_list = [item_dict for item_dict in item_list
+                          if item_dict["quantity"] > 0 and item_dict["expiry"] is not None
+                          and item_dict["expiry"] <= max_expiry_day]
+        for item_dict in due_items_list:
+            item_dict["days_expired"] = current_day - item_dict["expiry"]
+        return sorted(due_items_list, key=lambda k: k["days_expired"], reverse=True)
 
     def get_item_expired_list(self, chatid, storage):
-        item_list = self._db_instance.lrange(chatid + ":" + storage + ":item_list", 0, -1)
-        current_date = self.get_current_date()
-        expired_items_list = []
-        for item_name in item_list:
-            item_expiry_date = self.get_item_expiry(chatid, storage, item_name)
-            item_quantity = int(self.get_item_quantity(chatid, storage, item_name))
-            if (item_quantity > 0 and current_date > item_expiry_date):
-                days_expired_delta = (current_date - item_expiry_date).days
-                expired_items_list.append({"item_name": item_name,
-                                           "storage": storage,
-                                           "days_expired": int(days_expired_delta)})
-        return sorted(expired_items_list, key=lambda k: k["days_expired"], reverse=True)
-
-    def get_item_expiring_or_bad_list(self, chatid):
-        current_date = self.get_current_date()
-        storage_list = self._db_instance.lrange(chatid + ":storage_list", 0, -1)
-        expired_items_list = []
-        for storage_name in storage_list:
-            item_list = self._db_instance.lrange(chatid+":"+storage_name+":item_list", 0, -1)
-            for item_name in item_list:
-                item_expiry_date = self.get_item_expiry(chatid, storage_name, item_name)
-                item_quantity = self.get_item_quantity(chatid, storage_name, item_name)
-                days_expired_delta = (current_date - item_expiry_date).days
-                if (item_quantity > 0 and days_expired_delta >= -2):
-                    expired_items_list.append({"item_name": item_name,
-                                               "storage": storage_name,
-                                               "days_expired": int(days_expired_delta)})
-        return sorted(expired_items_list, key=lambda k: k["days_expired"], reverse=True)
+        current_day = self.get_current_day()
+        storage_item_pairs = [(storage_name, item_name) for storage_name, item_name
+                              in self._get_indexed_items(chatid, current_day - 1)
+                              if storage_name == storage]
+        return self._select_due_items(self._get_item_details(chatid, storage_item_pairs),
+                                      current_day, 1)
+
+    def get_item_expiring_or_bad_page(self, chatid, page, page_size):
+        # Returns the count of the indexed items due within two days, and the ones in the
+        # requested page; the index is ordered by expiry, so is every page
+        current_day = self.get_current_day()
+        return self._parse_due_items_page(current_day, self._load_due_items_page(
+            chatid, self._get_due_items_page_args(chatid, current_day, page, page_size)))
+
+    @idempotent_read
+    def _load_due_items_page(self, chatid, args):
+        return self._due_items_page_script(keys=[chatid + ":expiry_index"], args=args)
+
+    def _get_due_items_page_args(self, chatid, current_day, page, page_size):
+        return [chatid + ":", current_day + DUE_WITHIN_DAYS, page * page_size, page_size]
+
+    def _parse_due_items_page(self, current_day, page):
+        return (page[0], self._select_due_items(self._parse_indexed_items(page), current_day,
+                                                -DUE_WITHIN_DAYS))
+
+    def _parse_indexed_items(self, page):
+        # Storage, name, quantity and expiry of every item, after the count of the matches
+        return [self._parse_item_fields(page[index], page[index + 1], page[index + 2:index + 4])
+                for index in range(1, len(page), 4)]
+
+    def migrate_expiry_index(self):
+        # One-shot backfill of the expiry index from the item hashes of every pod
+        if (self._db_instance.sismember("global:migrations", "expiry_index")):
+            return
+        for pod in self.iter_pods():
+            indexed_items = {}
+            for storage_items in self.get_pod_snapshot(pod).values():
+                for item_dict in storage_items:
+                    if (item_dict["quantity"] > 0 and item_dict["expiry"] is not None):
+                        indexed_items[item_dict["storage"] + "@" + item_dict["item_name"]] = \
+                            item_dict["expiry"]
+            pipe = self._db_instance.pipeline()
+            pipe.delete(pod + ":expiry_index")
+            if (len(indexed_items) > 0):
+                pipe.zadd(pod + ":expiry_index", indexed_items)
+            pipe.execute()
+            logging.info("Indexed {} items by expiry date for Food Pod '{}'"
+                         .format(len(indexed_items), pod))
+        self._db_instance.sadd("global:migrations", "expiry_index")
+
+    def migrate_name_index(self):
+        # One-shot backfill of the name index from the item lists of every pod
+        if (self._db_instance.sismember("global:migrations", "name_index")):
+            return
+        for pod in self.iter_pods():
+            storage_list = self._load_storage_list(pod)
+            name_members = {self._get_name_index_member(storage, item_name): 0
+                            for storage, item_list in zip(storage_list,
+                                                          self._load_item_lists(pod, storage_list))
+                            for item_name in item_list}
+            pipe = self._db_instance.pipeline()
+            pipe.delete(pod + ":name_index")
+            if (len(name_members) > 0):
+                pipe.zadd(pod + ":name_index", name_members)
+            pipe.execute()
+            logging.info("Indexed {} items by name for Food Pod '{}'"
+                         .format(len(name_members), pod))
+        self._db_instance.sadd("global:migrations", "name_index")
+
+    def migrate_item_schema(self):
+        # Converts the items of every pod to the configured schema, one batch at a time; in
+        # the meantime they are read from either schema
+        migration = "item_schema:" + self._item_schema
+        if (self._db_instance.sismember("global:migrations", migration)):
+            return
+        for pod in self.iter_pods():
+            converted_count = 0
+            storage_list = self._load_storage_list(pod)
+            for storage, item_list in zip(storage_list, self._load_item_lists(pod, storage_list)):
+                for start in range(0, len(item_list), ITEM_DETAILS_BATCH_SIZE):
+                    converted_count += self._convert_items_script(
+                        keys=[self._get_packed_items_key(pod, storage)],
+                        args=[pod + ":" + storage + ":", self._item_schema]
+                        + item_list[start:start + ITEM_DETAILS_BATCH_SIZE])
+            logging.info("Converted {} items to the {} schema for Food Pod '{}'"
+                         .format(converted_count, self._item_schema, pod))
+        pipe = self._db_instance.pipeline()
+        pipe.srem("global:migrations", *["item_schema:" + item_schema for item_schema in ITEM_SCHEMAS])
+        pipe.sadd("global:migrations", migration)
+        pipe.execute()
+
+    def repair_inventory(self, chatid, pod_keys=None):
+        # Finds and fixes in bulk what interrupted writes may have left behind, returning
+        # how many problems of each kind were repaired; the keys of the pod are scanned for,
+        # unless given
+        if (pod_keys is None):
+            pod_keys = self._db_instance.scan_iter(match=chatid + ":*", count=500)
+        item_list_keys = {}
+        item_pairs = []
+        packed_items_keys = {}
+        deleted_storages = 0
+        for key in pod_keys:
+            key_parts = key.split(":")
+            if (len(key_parts) == 4 and key.endswith(":item_list:deleting")):
+                for _ in self.purge_deleted_storage(chatid, key_parts[1]):
+                    pass
+                deleted_storages += 1
+            elif (len(key_parts) == 4 and key.endswith(":" + PACKED_ITEMS_KEY)):
+                packed_items_keys[key_parts[1]] = key
+            elif (len(key_parts) == 3 and key_parts[2] == "item_list"):
+                item_list_keys[key_parts[1]] = key
+            elif (len(key_parts) == 3):
+                item_pairs.append((key_parts[1], key_parts[2]))
+        storage_list_key = chatid + ":storage_list"
+        expiry_index_key = chatid + ":expiry_index"
+        name_index_key = chatid + ":name_index"
+        repairs = {}
+
+        def _repair(pipe):
+            reader = self._db_instance.pipeline(transaction=False)
+            reader.lrange(storage_list_key, 0, -1)
+            for item_list_key in item_list_keys.values():
+                reader.lrange(item_list_key, 0, -1)
+            for packed_items_key in packed_items_keys.values():
+                reader.hgetall(packed_items_key)
+            for storage, item_name in item_pairs:
+                reader.hmget(chatid + ":" + storage + ":" + item_name, "Quantity", "Expire")
+            reader.zrange(expiry_index_key, 0, -1, withscores=True)
+            reader.zrange(name_index_key, 0, -1)
+            results = reader.execute()
+            storage_list = results[0]
+            packed_start = len(item_list_keys) + 1
+            item_start = packed_start + len(packed_items_keys)
+            item_lists = dict(zip(item_list_keys, results[1:packed_start]))
+            packed_items = dict(zip(packed_items_keys, results[packed_start:item_start]))
+            item_fields = dict(zip(item_pairs, results[item_start:-2]))
+            indexed_items = dict(results[-2])
+            named_items = set(results[-1])
+            # The packed fields take precedence over the item hashes, as in the scripts
+            legacy_pairs = set(item_pairs)
+            packed_pairs = set()
+            for storage, packed_fields in packed_items.items():
+                for item_name, packed in packed_fields.items():
+                    item_fields[(storage, item_name)] = self._unpack_item_fields(packed)
+                    packed_pairs.add((storage, item_name))
+            scanned_pairs = legacy_pairs | packed_pairs
+            repairs.update({"deleted_storages": deleted_storages, "unlisted_storages": 0,
+                            "duplicate_items": 0, "missing_items": 0, "unlisted_items": 0,
+                            "broken_items": 0, "legacy_expiry": 0, "item_schema": 0,
+                            "expiry_index": 0, "name_index": 0})
+            pipe.multi()
+            listed_pairs = set()
+            for storage, item_list in item_lists.items():
+                # Storages are never emptied of their list without being removed first
+                if (storage not in storage_list):
+                    pipe.lpush(storage_list_key, storage)
+                    repairs["unlisted_storages"] += 1
+                for item_name, count in Counter(item_list).items():
+                    listed_pairs.add((storage, item_name))
+                    if (count > 1):
+                        pipe.lrem(item_list_keys[storage], 1 - count, item_name)
+                        repairs["duplicate_items"] += 1
+                    if ((storage, item_name) not in item_fields):
+                        item_fields[(storage, item_name)] = (None, None)
+                        repairs["missing_items"] += 1
+            expected_index = {}
+            expected_names = set()
+            for (storage, item_name), (quantity, expiry) in item_fields.items():
+                if ((storage, item_name) not in listed_pairs):
+                    # The hashes of a deleted storage may be gone since the scan
+                    if (quantity is not None or expiry is not None):
+                        item_key, packed_items_key = self._get_item_keys(chatid, storage, item_name)
+                        pipe.unlink(item_key)
+                        pipe.hdel(packed_items_key, item_name)
+                        repairs["unlisted_items"] += 1
+                    continue
+                try:
+                    item_dict = self._parse_item_fields(storage, item_name, (quantity, expiry))
+                    if (quantity is None or expiry is None):
+                        raise ValueError
+                except ValueError:
+                    # Also covers the list entries left without their hash
+                    item_dict = self._parse_item_fields(storage, item_name, (0, DEFAULT_ITEM_EXPIRY))
+                    self._queue_item_fields(pipe, chatid, storage, item_name, 0, item_dict["expiry"])
+                    if ((storage, item_name) in scanned_pairs):
+                        repairs["broken_items"] += 1
+                else:
+                    is_legacy_expiry = expiry != str(item_dict["expiry"])
+                    # Also converts the items left in the other schema, or saved in both
+                    is_other_schema = (storage, item_name) in (
+                        legacy_pairs if self._item_schema == "compact" else packed_pairs)
+                    if (is_legacy_expiry):
+                        repairs["legacy_expiry"] += 1
+                    elif (is_other_schema):
+                        repairs["item_schema"] += 1
+                    if (is_legacy_expiry or is_other_schema):
+                        self._queue_item_fields(pipe, chatid, storage, item_name,
+                                                item_dict["quantity"], item_dict["expiry"])
+                expected_names.add(self._get_name_index_member(storage, item_name))
+                if (item_dict["quantity"] > 0):
+                    expected_index[storage + "@" + item_name] = item_dict["expiry"]
+            for index_member in indexed_items:
+                if (index_member not in expected_index):
+                    pipe.zrem(expiry_index_key, index_member)
+                    repairs["expiry_index"] += 1
+            for index_member, expiry_day in expected_index.items():
+                if (indexed_items.get(index_member) != expiry_day):
+                    pipe.zadd(expiry_index_key, {index_member: expiry_day})
+                    repairs["expiry_index"] += 1
+            for name_member in named_items - expected_names:
+                pipe.zrem(name_index_key, name_member)
+                repairs["name_index"] += 1
+            for name_member in expected_names - named_items:
+                pipe.zadd(name_index_key, {name_member: 0})
+                repairs["name_index"] += 1
+        self._db_instance.transaction(_repair, storage_list_key, expiry_index_key, name_index_key,
+                                      *item_list_keys.values(),
+                                      *[self._get_packed_items_key(chatid, storage)
+                                        for storage in set(item_list_keys) | set(packed_items_keys)],
+                                      *[chatid + ":" + storage + ":" + item_name
+                                        for storage, item_name in item_pairs])
+        self._inventory_cache.invalidate_pod(chatid)
+        return repairs
+
+    def repair_inventories(self):
+        # A scan for each pod would walk the whole keyspace every time
+        for pod, pod_keys in self._scan_pod_keys(self.iter_pods()).items():
+            repairs = self.repair_inventory(pod, pod_keys)
+            if (sum(repairs.values()) > 0):
+                logging.warning("Repaired the inventory of Food Pod '{}': {}".format(pod, repairs))
+
+    def _get_empty_expired_args(self, chatid, storage):
+        return [storage, chatid + ":" + storage + ":", self.get_current_day() - 1]
 
     def empty_expired(self, chatid, storage):
-        expired_item_list = self.get_item_expired_list(chatid, storage)
-        for expired_item_dict in expired_item_list:
-            expired_item_name = expired_item_dict["item_name"]
-            self.set_item_quantity(chatid, storage, expired_item_name, 0)
+        emptied_count = self._empty_expired_script(
+            keys=[chatid + ":expiry_index"], args=self._get_empty_expired_args(chatid, storage))
+        self._inventory_cache.invalidate(chatid, storage)
+        return emptied_count
+
+
+class ConversationStateConflict(Exception):
+    # Raised if the conversation state changed after it was loaded
+    pass
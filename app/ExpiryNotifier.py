@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import threading
+
+from collections import OrderedDict
+from os import environ
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from telegram.error import RetryAfter, TimedOut, NetworkError
+
+
+class ExpiryNotifier:
+
+    def __init__(self, db, build_report):
+        self._db_connection = db
+        self._build_report = build_report
+        self._workers = int(environ.get("NOTIFY_WORKERS", 4))
+        self._max_retries = int(environ.get("NOTIFY_MAX_RETRIES", 3))
+        self._batch_size = int(environ.get("NOTIFY_BATCH_SIZE", 20))
+        self._rate_limiter = RateLimiter(float(environ.get("NOTIFY_GLOBAL_RATE", 25)),
+                                         float(environ.get("NOTIFY_CHAT_INTERVAL", 1)))
+        self._run_lock = threading.Lock()
+
+    def get_batch_size(self):
+        return self._batch_size
+
+    def start(self, bot):
+        # Run in the background, so the job queue thread is released immediately; the pods
+        # due in the meantime are picked up by the next run
+        if (not self._run_lock.acquire(blocking=False)):
+            logging.debug("The expiry notification run is still in progress: skipping this one")
+            return
+        threading.Thread(target=self._run_locked, args=(bot,),
+                         name="ExpiryNotifier", daemon=True).start()
+
+    def _run_locked(self, bot):
+        try:
+            self.run(bot)
+        finally:
+            self._run_lock.release()
+
+    def run(self, bot):
+        summary = {"sent": 0, "skipped": 0, "failed": 0}
+        started_at = monotonic()
+        retries = []
+        with ThreadPoolExecutor(max_workers=self._workers,
+                                thread_name_prefix="ExpiryReport") as executor:
+            futures = {}
+            # The due pods are claimed in small batches, keeping a bounded number of reports
+            # in flight; reports are sent in completion order, while the pool keeps computing
+            # the others
+            for pod in self._db_connection.iter_due_notifications(self._batch_size):
+                futures[executor.submit(self._build_report, pod)] = pod
+                if (len(futures) >= self._workers * 2):
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._deliver(bot, futures.pop(future), future, summary, retries)
+            for future in as_completed(futures):
+                self._deliver(bot, futures[future], future, summary, retries)
+        self._send_retries(bot, summary, retries, wait=True)
+        return self._complete_run(summary, started_at)
+
+    async def start_async(self, bot, pods, build_report):
+        if (not self._run_lock.acquire(blocking=False)):
+            logging.debug("The expiry notification run is still in progress: skipping this one")
+            return
+        try:
+            return await self.run_async(bot, pods, build_report)
+        finally:
+            self._run_lock.release()
+
+    async def run_async(self, bot, pods, build_report):
+        # Coroutine counterpart of run: the reports are computed concurrently on the event loop,
+        # while the rate limited sends are handed over to a thread
+        summary = {"sent": 0, "skipped": 0, "failed": 0}
+        started_at = monotonic()
+        loop = asyncio.get_running_loop()
+        retries = []
+        tasks = {}
+        async for pod in pods:
+            tasks[asyncio.ensure_future(build_report(pod))] = pod
+            if (len(tasks) >= self._workers * 2):
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    await loop.run_in_executor(None, self._deliver, bot, tasks.pop(task), task,
+                                               summary, retries)
+        if (len(tasks) > 0):
+            done, _ = await asyncio.wait(tasks)
+            for task in done:
+                await loop.run_in_executor(None, self._deliver, bot, tasks[task], task, summary,
+                                           retries)
+        await loop.run_in_executor(None, self._send_retries, bot, summary, retries, True)
+        return self._complete_run(summary, started_at)
+
+    def _complete_run(self, summary, started_at):
+        summary["elapsed"] = round(monotonic() - started_at, 3)
+        # The runs are frequent, and most of them find no pod due
+        log_level = logging.DEBUG
+        if (summary["sent"] + summary["skipped"] + summary["failed"] > 0):
+            log_level = logging.INFO
+        logging.log(log_level, "Expiry notification run completed: {} sent, {} skipped, {} failed in {}s"
+                    .format(summary["sent"], summary["skipped"], summary["failed"],
+                            summary["elapsed"]))
+        return summary
+
+    def _deliver(self, bot, pod, future, summary, retries):
+        try:
+            report = future.result()
+        except Exception as e:
+            logging.error("Unable to compute the expiry report for Food Pod '{}': {}"
+                          .format(pod, e))
+            summary["failed"] += 1
+            return
+        if (report is None):
+            summary["skipped"] += 1
+        else:
+            self._send(bot, pod, report, 0, summary, retries)
+        self._send_retries(bot, summary, retries)
+
+    def _send(self, bot, chatid, report, attempt, summary, retries):
+        reply_text, keyboard_markup = report
+        while (attempt <= self._max_retries):
+            self._rate_limiter.wait(chatid)
+            try:
+                bot.send_message(chat_id=chatid,
+                                 text=reply_text,
+                                 reply_markup=keyboard_markup,
+                                 parse_mode="markdown")
+                summary["sent"] += 1
+                return
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so every send is held back
+                logging.warning("Flood control hit while notifying Food Pod '{}': retrying in {}s"
+                                .format(chatid, e.retry_after))
+                self._rate_limiter.pause(e.retry_after)
+            except (TimedOut, NetworkError) as e:
+                logging.warning("Network error while notifying Food Pod '{}': {}"
+                                .format(chatid, e))
+                if (attempt < self._max_retries):
+                    # The pod is sent again later, rather than holding back the others meanwhile
+                    retries.append((monotonic() + 2 ** attempt, chatid, report, attempt + 1))
+                    return
+            except Exception as e:
+                logging.error("Unable to notify Food Pod '{}': {}".format(chatid, e))
+                summary["failed"] += 1
+                return
+            attempt += 1
+        logging.error("Giving up on notifying Food Pod '{}' after {} attempts"
+                      .format(chatid, self._max_retries + 1))
+        summary["failed"] += 1
+
+    def _send_retries(self, bot, summary, retries, wait=False):
+        # Sends the reports whose retry is due; at the end of a run, waits for all of them
+        while (len(retries) > 0):
+            retry = min(retries, key=lambda retry: retry[0])
+            delay = retry[0] - monotonic()
+            if (delay > 0):
+                if (not wait):
+                    return
+                sleep(delay)
+            retries.remove(retry)
+            self._send(bot, *retry[1:], summary, retries)
+
+
+class RateLimiter:
+
+    def __init__(self, global_rate, chat_interval):
+        self._global_interval = 1 / global_rate
+        self._chat_interval = chat_interval
+        self._next_slot = 0
+        # The slots are handed out in increasing order, so are the chat slots kept here
+        self._next_chat_slot = OrderedDict()
+        self._lock = threading.Lock()
+
+    def wait(self, chatid):
+        with self._lock:
+            now = monotonic()
+            # The chats whose slot is past are free to send again, and need not be remembered
+            while (len(self._next_chat_slot) > 0 and next(iter(self._next_chat_slot.values())) <= now):
+                self._next_chat_slot.popitem(last=False)
+            slot = max(now, self._next_slot, self._next_chat_slot.get(chatid, 0))
+            self._next_slot = slot + self._global_interval
+            self._next_chat_slot[chatid] = slot + self._chat_interval
+            self._next_chat_slot.move_to_end(chatid)
+        if (slot > now):
+            sleep(slot - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._next_slot = max(self._next_slot, monotonic() + seconds)
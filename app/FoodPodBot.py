@@ -1,11 +1,38 @@
 import logging
+import signal
+import threading
 
+from os import environ
+from time import monotonic
+from secrets import token_urlsafe
+from tempfile import TemporaryFile
+from concurrent.futures import ThreadPoolExecutor
 from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler
 from telegram.ext import Updater, Filters, CallbackContext
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update, CallbackQuery
-from telegram.error import BadRequest
+from telegram import Update
+from telegram.error import BadRequest, NetworkError
+from redis.exceptions import ConnectionError as DbConnectionError, TimeoutError as DbTimeoutError
 from TelegramSecretsSingleton import TelegramSecretsSingleton
 from DbConnectionSingleton import DbConnectionSingleton
+from ExpiryNotifier import ExpiryNotifier
+from KeyboardRenderer import KeyboardRenderer
+from MessageRenderCache import MessageRenderCache
+from CallbackCodec import CallbackCodec, ACTION_STORAGES, ACTION_STORAGE, ACTION_NEW_STORAGE
+from CallbackCodec import ACTION_NEW_ITEM, ACTION_ITEM, ACTION_MODIFY_ITEM, ACTION_EXPIRED
+from CallbackCodec import ACTION_EMPTY_EXPIRED, ACTION_DEL_STORAGE, ACTION_DEL_STORAGE_CONFIRM
+from CallbackCodec import ACTION_DEL_ITEM, ACTION_DEL_ITEM_CONFIRM, ACTION_CHECK, ACTION_CLOSE
+from CallbackCodec import ACTION_NONE
+from InventoryFile import InventoryFile, INVENTORY_FORMATS
+from MetricsSingleton import MetricsSingleton
+from HealthProbe import HealthProbe
+
+STORAGE_PURGE_PROGRESS_TEXT = "Deleting storage {}: {} items left..."
+STORAGE_PURGE_DONE_TEXT = "Deleted storage {} and its {} items"
+STORAGE_PURGE_PROGRESS_INTERVAL = 2
+# Largest file the Bot API lets bots download
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+EXPIRED_BUTTON_TEXT = "⌛️ This menu has expired, open it again with /items or /check"
+MEMORY_REPORT_PODS = 20
 
 
 class FoodPodBot:
@@ -16,15 +43,76 @@ class FoodPodBot:
         self._dispatcher = self._updater.dispatcher
         self._job_queue = self._updater.job_queue
         self._auth_users = secrets.get_auth_users_list()
+        self._webhook_secret = secrets.get_webhook_secret()
+        self._webhook_listener = None
+        self._metrics_exporter = None
+        self._stop_event = threading.Event()
         self._db_connection = db
-        # Add daily recurring job for the report notification
-        self._job_queue.run_daily(self._callback_notify_expiry,
-                                  time=self._db_connection.get_notify_time())
+        self._callback_codec = CallbackCodec(db)
+        self._renderer = KeyboardRenderer(self._callback_codec)
+        self._render_cache = MessageRenderCache()
+        self._button_handlers = {
+            ACTION_STORAGES: self._button_storages,
+            ACTION_STORAGE: self._button_storage,
+            ACTION_NEW_STORAGE: self._button_new_storage,
+            ACTION_NEW_ITEM: self._button_new_item,
+            ACTION_ITEM: self._button_item,
+            ACTION_MODIFY_ITEM: self._button_modify_item,
+            ACTION_EXPIRED: self._button_expired,
+            ACTION_EMPTY_EXPIRED: self._button_empty_expired,
+            ACTION_DEL_STORAGE: self._button_del_storage,
+            ACTION_DEL_STORAGE_CONFIRM: self._button_del_storage_confirm,
+            ACTION_DEL_ITEM: self._button_del_item,
+            ACTION_DEL_ITEM_CONFIRM: self._button_del_item_confirm,
+            ACTION_CHECK: self._button_check,
+            ACTION_CLOSE: self._button_close,
+            ACTION_NONE: self._button_none
+        }
+        self._inventory_file = InventoryFile(db)
+        # Files are transferred outside of the threads handling the updates, as it may take a while
+        self._transfer_executor = ThreadPoolExecutor(max_workers=int(environ.get("TRANSFER_WORKERS", 2)),
+                                                     thread_name_prefix="InventoryTransfer")
+        self._page_size = int(environ.get("PAGE_SIZE", 20))
+        self._due_alerts = environ.get("DUE_ALERTS", "false") == "true"
+        self._cluster = None
+        if (environ.get("INSTANCE_MODE", "single") == "multi"):
+            # The modules of the optional features are only imported when enabled, to keep
+            # the startup short
+            from ClusterCoordinator import ClusterCoordinator
+            self._cluster = ClusterCoordinator(db, self._dispatch_update)
+        self._expiry_notifier = ExpiryNotifier(db, self._build_expiry_report)
+        # Add recurring job notifying the pods whose report is due, each at its own time;
+        # the first run catches up with the ones missed while the bot was down
+        self._job_queue.run_repeating(self._callback_notify_expiry,
+                                      interval=int(environ.get("NOTIFY_POLL_INTERVAL", 60)),
+                                      first=1)
+        self._health_probe = None
+        if (environ.get("PROBE_FILE", "/tmp/foodpod.ready") != ""):
+            self._health_probe = HealthProbe(db, environ.get("PROBE_FILE", "/tmp/foodpod.ready"))
+            probe_interval = int(environ.get("PROBE_INTERVAL", 30))
+            self._job_queue.run_repeating(self._callback_renew_probe, interval=probe_interval,
+                                          first=probe_interval)
         # Add handlers and jobs to the dispatcher
         start_handler = CommandHandler('start', self._callback_start)
         self._dispatcher.add_handler(start_handler)
         info_handler = CommandHandler('server_info', self._callback_info)
         self._dispatcher.add_handler(info_handler)
+        metrics_handler = CommandHandler('metrics', self._callback_metrics)
+        self._dispatcher.add_handler(metrics_handler)
+        repair_handler = CommandHandler('repair_inventory', self._callback_repair)
+        self._dispatcher.add_handler(repair_handler)
+        memory_report_handler = CommandHandler('memory_report', self._callback_memory_report)
+        self._dispatcher.add_handler(memory_report_handler)
+        notify_time_handler = CommandHandler('notify_time', self._callback_notify_time)
+        self._dispatcher.add_handler(notify_time_handler)
+        export_handler = CommandHandler('export', self._callback_export)
+        self._dispatcher.add_handler(export_handler)
+        import_handler = CommandHandler('import', self._callback_import)
+        self._dispatcher.add_handler(import_handler)
+        document_handler = MessageHandler(Filters.document, self._callback_document)
+        self._dispatcher.add_handler(document_handler)
+        find_handler = CommandHandler('find', self._callback_find)
+        self._dispatcher.add_handler(find_handler)
         items_handler = CommandHandler('items', self._callback_items)
         self._dispatcher.add_handler(items_handler)
         stop_handler = CommandHandler('stop', self._callback_stop)
@@ -42,6 +130,10 @@ class FoodPodBot:
         self._dispatcher.add_handler(string_handler)
         # Handler to print error messages
         self._dispatcher.add_error_handler(self._callback_error)
+        self._metrics = MetricsSingleton.getInstance()
+        if (self._metrics.is_enabled()):
+            self._metrics.instrument_dispatcher(self._dispatcher)
+            self._metrics.instrument_bot(self._updater.bot)
 
     def _callback_start(self, update, context):
         _username = update.message.from_user.username
@@ -58,15 +150,16 @@ class FoodPodBot:
 
     def _callback_stop(self, update, context):
         _chatid = str(update.message.chat.id)
-        cmd_name = self._db_connection.get_global_cmd_name(_chatid)
+        conversation_state = self._db_connection.get_conversation_state(_chatid)
+        cmd_name = conversation_state["name"]
         if (cmd_name == "none"):
             update.message.reply_text("There's no action in progress to cancel")
         else:
             _username = update.message.from_user.username
             logging.info("The user {} [{}] has cancelled the operation '{}'"
                          .format(_username, _chatid, cmd_name))
-            self._db_connection.set_global_cmd_name(_chatid, "none")
-            self._db_connection.set_global_cmd_arg(_chatid, "none")
+            self._db_connection.set_conversation_state(_chatid, "none", "none",
+                                                       conversation_state["version"])
             update.message.reply_text("Operation cancelled")
 
     def _callback_info(self, update, context):
@@ -75,8 +168,143 @@ class FoodPodBot:
         logging.info("The user {} [{}] has called the server_info function"
                      .format(_username, _chatid))
         if _chatid in self._auth_users:
+            server_info = self._db_connection.get_info()
+            if (isinstance(server_info, dict)):
+                server_info["foodpod_render_cache"] = self._render_cache.get_stats()
+            context.bot.send_message(chat_id=_chatid, text=server_info)
+
+    def _callback_metrics(self, update, context):
+        _username = update.message.from_user.username
+        _chatid = str(update.message.chat.id)
+        logging.info("The user {} [{}] has called the metrics function"
+                     .format(_username, _chatid))
+        if _chatid in self._auth_users:
+            if (self._metrics.is_enabled()):
+                reply_text = self._metrics.render_summary()
+            else:
+                reply_text = "📈 Metrics are disabled, set METRICS_ENABLED=\"true\" to collect them"
+            context.bot.send_message(chat_id=_chatid, text=reply_text)
+
+    def _callback_repair(self, update, context):
+        _username = update.message.from_user.username
+        _chatid = str(update.message.chat.id)
+        logging.info("The user {} [{}] has called the repair_inventory function"
+                     .format(_username, _chatid))
+        if _chatid in self._auth_users:
+            repairs = self._db_connection.repair_inventory(_chatid)
             context.bot.send_message(chat_id=_chatid,
-                                     text=self._db_connection.get_info())
+                                     text="🔧 Inventory checked, repaired problems: {}"
+                                     .format(repairs))
+
+    def _callback_memory_report(self, update, context):
+        _username = update.message.from_user.username
+        _chatid = str(update.message.chat.id)
+        logging.info("The user {} [{}] has called the memory_report function"
+                     .format(_username, _chatid))
+        if _chatid in self._auth_users:
+            # Every key of every pod is measured, away from the dispatcher threads
+            self._transfer(self._send_memory_report, update, context)
+
+    def _send_memory_report(self, update, context):
+        _chatid = str(update.message.chat.id)
+        pod_usages = list(self._db_connection.get_memory_usage().items())
+        pod_usages.sort(key=lambda pod_usage: pod_usage[1]["bytes"], reverse=True)
+        reply_text = "🧮 Memory used by {} Food Pods ({} item schema): {} bytes in {} keys".format(
+            len(pod_usages), self._db_connection.get_item_schema(),
+            sum(usage["bytes"] for _, usage in pod_usages), sum(usage["keys"] for _, usage in pod_usages))
+        for pod, usage in pod_usages[:MEMORY_REPORT_PODS]:
+            reply_text += "\n{}: {} bytes in {} keys".format(pod, usage["bytes"], usage["keys"])
+        context.bot.send_message(chat_id=_chatid, text=reply_text)
+
+    def _callback_notify_time(self, update, context):
+        _chatid = str(update.message.chat.id)
+        if (not self._db_connection.is_pod_registered(_chatid)):
+            update.message.reply_text("🚧 This chat is not registered as a Food Pod")
+            return
+        if (len(context.args) > 0):
+            self._db_connection.set_notify_settings(_chatid, context.args[0],
+                                                    context.args[1] if len(context.args) > 1 else None)
+        settings = self._db_connection.get_notify_settings(_chatid)
+        reply_text = "🔔 The daily report is sent at {} ({})".format(settings["time"], settings["timezone"])
+        if (settings["next"] is not None):
+            reply_text += ", next on {}".format(settings["next"].strftime("%Y-%m-%d %H:%M"))
+        update.message.reply_text(reply_text + "\nUse /notify_time HH:MM [timezone] to change it")
+
+    def _transfer(self, transfer, update, context, *args):
+        def _run_transfer():
+            try:
+                transfer(update, context, *args)
+            except Exception as e:
+                context.error = e
+                self._callback_error(update, context)
+        self._transfer_executor.submit(_run_transfer)
+
+    def _callback_export(self, update, context):
+        _chatid = str(update.message.chat.id)
+        if (not self._db_connection.is_pod_registered(_chatid)):
+            update.message.reply_text("🚧 This chat is not registered as a Food Pod")
+            return
+        file_format = context.args[0].lower() if len(context.args) > 0 else "csv"
+        if (file_format not in INVENTORY_FORMATS):
+            raise Exception("Wrong input! The export format must be one of: {}"
+                            .format(", ".join(INVENTORY_FORMATS)))
+        self._transfer(self._export_inventory, update, context, file_format)
+
+    def _export_inventory(self, update, context, file_format):
+        _chatid = str(update.message.chat.id)
+        # The rows are spooled to disk as they are read, rather than kept in memory
+        with TemporaryFile() as export_file:
+            item_count = self._inventory_file.write(export_file, file_format,
+                                                    self._db_connection.iter_inventory(_chatid))
+            export_file.seek(0)
+            context.bot.send_document(chat_id=_chatid, document=export_file,
+                                      filename="foodpod_inventory.{}".format(file_format),
+                                      caption="📤 Exported {} items".format(item_count))
+        logging.info("Exported {} items from Food Pod '{}' as {}".format(item_count, _chatid, file_format))
+
+    def _callback_import(self, update, context):
+        _chatid = str(update.message.chat.id)
+        if (not self._db_connection.is_pod_registered(_chatid)):
+            update.message.reply_text("🚧 This chat is not registered as a Food Pod")
+            return
+        conversation_state = self._db_connection.get_conversation_state(_chatid)
+        self._db_connection.set_conversation_state(_chatid, "import_file", "none",
+                                                   conversation_state["version"])
+        update.message.reply_text("Send the inventory as a CSV or JSON Lines document, with the "
+                                  "columns storage, item, quantity and expiry; use /stop to abort")
+
+    def _callback_document(self, update, context):
+        _chatid = str(update.message.chat.id)
+        conversation_state = self._db_connection.get_conversation_state(_chatid)
+        if (conversation_state["name"] != "import_file"):
+            update.message.reply_text("🚧 Use /import before sending an inventory file")
+            return
+        document = update.message.document
+        file_format = self._inventory_file.get_format(document.file_name)
+        if (file_format is None):
+            raise Exception("Wrong input! The inventory file name must end with .csv or .jsonl")
+        if (document.file_size is not None and document.file_size > IMPORT_MAX_FILE_SIZE):
+            raise Exception("Wrong input! The inventory file must be smaller than {} MB"
+                            .format(IMPORT_MAX_FILE_SIZE // (1024 * 1024)))
+        self._db_connection.set_conversation_state(_chatid, "none", "none",
+                                                   conversation_state["version"])
+        self._transfer(self._import_inventory, update, context, document, file_format)
+
+    def _import_inventory(self, update, context, document, file_format):
+        _chatid = str(update.message.chat.id)
+        summary = {"skipped": 0, "errors": []}
+        with TemporaryFile() as import_file:
+            context.bot.get_file(document.file_id).download(out=import_file)
+            import_file.seek(0)
+            counts = self._db_connection.import_items(
+                _chatid, self._inventory_file.read(import_file, file_format, summary))
+        reply_text = "📥 Imported {} items, creating {} storages; {} rows skipped".format(
+            counts["items"], counts["new_storages"], summary["skipped"])
+        if (len(summary["errors"]) > 0):
+            reply_text += "\n" + "\n".join(summary["errors"])
+        update.message.reply_text(reply_text)
+        logging.info("Imported {} items into Food Pod '{}', {} rows skipped"
+                     .format(counts["items"], _chatid, summary["skipped"]))
 
     def _callback_unknown(self, update, context):
         _chatid = str(update.message.chat.id)
@@ -90,9 +318,10 @@ class FoodPodBot:
         try:
             _chatid = str(update.message.chat.id)
             if (_chatid is not None):
-                context.bot.send_message(chat_id=_chatid,
-                                         text="🚨 The following error occurred: {}"
-                                         .format(str(context.error)))
+                error_text = "🚨 The following error occurred: {}".format(str(context.error))
+                if (isinstance(context.error, (DbConnectionError, DbTimeoutError))):
+                    error_text = "🚨 The database is unreachable at the moment, please try again shortly"
+                context.bot.send_message(chat_id=_chatid, text=error_text)
         except AttributeError:
             logging.warning("Could not send the error notification to the user: unable to get the chat ID")
         finally:
@@ -100,10 +329,8 @@ class FoodPodBot:
                           .format(update, context.error))
 
     def _register_new_pod(self, chatid, bot):
-        if (not self._db_connection.is_pod_registered(chatid)):
-            self._db_connection.add_pod(chatid)
-            self._db_connection.set_global_cmd_name(chatid, "none")
-            self._db_connection.set_global_cmd_arg(chatid, "none")
+        if (self._db_connection.add_pod(chatid)):
+            self._db_connection.set_conversation_state(chatid, "none", "none")
             bot.send_message(chat_id=chatid,
                              text="🔧 You have registered this chat as a new 'Food Pod'; " +
                              "use the bot's commands to add food storages and assign items to them")
@@ -120,115 +347,120 @@ class FoodPodBot:
         logging.debug("The user {} [{}] called the items function"
                       .format(_username, _chatid))
 
+    def _callback_find(self, update, context):
+        _chatid = str(update.message.chat.id)
+        if (len(context.args) == 0):
+            update.message.reply_text("Write the beginning of the item name after the command, like /find mil")
+            return
+        prefix = " ".join(context.args)
+        self._db_connection._validate_input_text(prefix)
+        item_count, item_list = self._db_connection.find_items(_chatid, prefix, self._page_size)
+        keyboard_markup = self._renderer.render_found_items(item_list,
+                                                            self._db_connection.get_current_day())
+        reply_text = "🔎 Items starting with '{}'\n({} items".format(prefix, item_count)
+        if (item_count > len(item_list)):
+            reply_text += ", showing the first {}; write more of the name to narrow it down" \
+                .format(len(item_list))
+        self._save_callbacks(keyboard_markup)
+        update.message.reply_text(reply_text + ")", reply_markup=keyboard_markup)
+
     def _callback_inline_button(self, update, context):
         _query = update.callback_query
-        selected_button_list = _query.data.split(':')
-        pressed_button = {
-            "foodpod_id": selected_button_list[0],
-            "button_type": selected_button_list[1],
-            "button_value": selected_button_list[2]
-        }
+        _chatid = str(_query.message.chat.id)
+        pressed_button = self._callback_codec.decode(_query.data)
         logging.debug("Inline button callback: {}".format(pressed_button))
-        cmd_name = pressed_button["button_value"]
-        cmd_arg = self._db_connection.get_global_cmd_arg(pressed_button["foodpod_id"])
-        if (pressed_button["button_type"] == "storage_button"):
-            self._list_items(_query,
-                             pressed_button["foodpod_id"],
-                             cmd_name)
-            cmd_arg = cmd_name
-        elif (pressed_button["button_type"] == "add_button"):
-            if (cmd_name == "new_storage"):
-                _query.edit_message_text(text="Write the new storage location name, use /stop to abort")
-                cmd_arg = "none"
-            if (cmd_name == "new_item"):
-                _query.edit_message_text(text="Write the new item name, use /stop to abort")
-        elif (pressed_button["button_type"] == "modify_item"):
-            item_string = pressed_button["button_value"].split('@')
-            storage_name = item_string[0]
-            item_name = item_string[1]
-            _query.edit_message_text(text="Write the quantity as an integer, use /stop to abort")
-            cmd_arg = cmd_name
-            cmd_name = "modify_item"
-        elif (pressed_button["button_type"] == "del_button"):
-            if (cmd_name == "del_storage"):
-                self._del_storage_dialog(_query, pressed_button["foodpod_id"], cmd_arg)
-            if ("del_item" in cmd_name):
-                item_name = cmd_name
-                storage_name = cmd_arg
-                if (cmd_arg == "item_check_button"):
-                    item_name = cmd_name.split("@")[1]
-                    storage_name = cmd_name.split("@")[2]
-                self._del_item_dialog(_query, pressed_button["foodpod_id"], storage_name, item_name)
-            if ("del_expired@" in cmd_name):
-                storage_name = cmd_name.split('@')[1]
-                self._db_connection.empty_expired(pressed_button["foodpod_id"], storage_name)
-                cmd_name = storage_name
-                cmd_arg = cmd_name
-                self._list_items(_query, pressed_button["foodpod_id"], cmd_name)
-        elif (pressed_button["button_type"] == "del_storage_confirm"):
-            self._db_connection.del_storage(pressed_button["foodpod_id"], cmd_arg)
-            _query.edit_message_text(text="Deleted storage {}".format(cmd_arg))
-            cmd_name = "none"
-            cmd_arg = "none"
-        elif (pressed_button["button_type"] == "del_item_confirm"):
-            item_string = pressed_button["button_value"].split('@')
-            storage_name = item_string[0]
-            item_name = item_string[1]
-            self._db_connection.del_item(pressed_button["foodpod_id"], storage_name, item_name)
-            _query.edit_message_text(text="Deleted item {} from storage {}".format(item_name, storage_name))
-            cmd_name = "none"
-            cmd_arg = "none"
-        elif (pressed_button["button_type"] == "expired_button"):
-            self._list_storage_expired_items(_query, pressed_button["foodpod_id"], cmd_name)
-        elif (pressed_button["button_type"] == "back_button"):
-            if (cmd_name == "back_bot"):
-                _query.edit_message_text(text="Back to the main bot's chat")
-                cmd_name = "none"
-                cmd_arg = "none"
-            if (cmd_name == "back_storage"):
-                cmd_name = cmd_arg
-                self._list_storage(_query, pressed_button["foodpod_id"])
-            if ("back_item_list@" in cmd_name):
-                cmd_name = pressed_button["button_value"].split('@')[1]
-                self._list_items(_query, pressed_button["foodpod_id"], cmd_name)
-            if ("back_item@" in cmd_name):
-                cmd_name = pressed_button["button_value"].split('@')[1]
-                self._show_item(_query, pressed_button["foodpod_id"], cmd_arg, cmd_name)
-        elif (pressed_button["button_type"] == "item_button"):
-            item_name = cmd_name
-            if ("item_expired@" in cmd_name):
-                item_name = cmd_name.split("@")[1]
-            self._show_item(_query,
-                            pressed_button["foodpod_id"],
-                            cmd_arg,
-                            item_name)
-        elif (pressed_button["button_type"] == "item_check_button"):
-            if (cmd_name == "show_list"):
-                self._callback_check(_query, context)
-            else:
-                item_name = cmd_name.split("@")[0]
-                storage_name = cmd_name.split("@")[1]
-                cmd_arg = "item_check_button"
-                self._db_connection.set_global_cmd_arg(pressed_button["foodpod_id"], cmd_arg)
-                self._show_item(_query,
-                                pressed_button["foodpod_id"],
-                                storage_name,
-                                item_name)
-        else:
-            logging.warning("Callback not caught inside _callback_inline_button function, due to unknown button type '{}'".format(pressed_button["button_type"]))
-        self._db_connection.set_global_cmd_name(pressed_button["foodpod_id"],
-                                                cmd_name)
-        self._db_connection.set_global_cmd_arg(pressed_button["foodpod_id"],
-                                               cmd_arg)
+        button_handler = self._button_handlers.get(pressed_button[0]) if pressed_button is not None else None
+        if (button_handler is None):
+            # Expired tokens and the buttons sent by older versions
+            _query.answer(text=EXPIRED_BUTTON_TEXT)
+            return
+        conversation_state = self._db_connection.get_conversation_state(_chatid)
+        cmd_name, cmd_arg = button_handler(_query, context, _chatid, *pressed_button[1])
+        self._db_connection.set_conversation_state(_chatid, cmd_name, cmd_arg,
+                                                   conversation_state["version"])
+
+    # Each button handler returns the conversation state to save, which only matters
+    # for the buttons asking for some text
+
+    def _button_storages(self, query, context, chatid, page="0"):
+        self._list_storage(query, chatid, int(page))
+        return ("none", "none")
+
+    def _button_storage(self, query, context, chatid, storage, page="0"):
+        self._list_items(query, chatid, storage, int(page))
+        return ("none", "none")
+
+    def _button_new_storage(self, query, context, chatid):
+        view, state = self._prompt_new_storage()
+        self._show_message(query, *view)
+        return state
+
+    def _button_new_item(self, query, context, chatid, storage):
+        view, state = self._prompt_new_item(storage)
+        self._show_message(query, *view)
+        return state
+
+    def _button_item(self, query, context, chatid, storage, item_name, origin):
+        self._show_item(query, chatid, storage, item_name, origin)
+        return ("none", "none")
+
+    def _button_modify_item(self, query, context, chatid, storage, item_name):
+        view, state = self._prompt_quantity(storage, item_name)
+        self._show_message(query, *view)
+        return state
+
+    def _button_expired(self, query, context, chatid, storage):
+        self._list_storage_expired_items(query, chatid, storage)
+        return ("none", "none")
+
+    def _button_empty_expired(self, query, context, chatid, storage):
+        self._db_connection.empty_expired(chatid, storage)
+        self._list_items(query, chatid, storage)
+        return ("none", "none")
+
+    def _button_del_storage(self, query, context, chatid, storage):
+        self._del_storage_dialog(query, chatid, storage)
+        return ("none", "none")
+
+    def _button_del_storage_confirm(self, query, context, chatid, storage):
+        deleted_count, pending_count = self._db_connection.del_storage(chatid, storage)
+        self._show_message(query, *self._view_storage_deleted(storage, pending_count))
+        if (pending_count > 0):
+            threading.Thread(target=self._purge_storage,
+                             args=(query, chatid, storage, deleted_count + pending_count),
+                             name="StoragePurge", daemon=True).start()
+        return ("none", "none")
+
+    def _button_del_item(self, query, context, chatid, storage, item_name, origin):
+        self._del_item_dialog(query, chatid, storage, item_name, origin)
+        return ("none", "none")
+
+    def _button_del_item_confirm(self, query, context, chatid, storage, item_name):
+        self._db_connection.del_item(chatid, storage, item_name)
+        self._show_message(query, *self._view_item_deleted(storage, item_name))
+        return ("none", "none")
+
+    def _button_check(self, query, context, chatid, page="0"):
+        self._callback_check(query, context, int(page))
+        return ("none", "none")
+
+    def _button_close(self, query, context, chatid):
+        self._show_message(query, *self._view_close())
+        return ("none", "none")
+
+    def _button_none(self, query, context, chatid):
+        return ("none", "none")
 
     def _callback_message(self, update, context):
         _chatid = str(update.message.chat.id)
         _user_input = update.message.text
         self._db_connection._validate_input_text(_user_input)
-        cmd_name = self._db_connection.get_global_cmd_name(_chatid)
-        cmd_arg = self._db_connection.get_global_cmd_arg(_chatid)
+        conversation_state = self._db_connection.get_conversation_state(_chatid)
+        cmd_name = conversation_state["name"]
+        cmd_arg = conversation_state["arg"]
         reply_text = None
         keyboard_markup = None
+        alert_text = None
         is_invalid_callback = False
         if (cmd_name == "new_storage"):
             storage_name = _user_input
@@ -246,247 +478,309 @@ class FoodPodBot:
         elif (cmd_name == "modify_item"):
             item_quantity = _user_input
             self._db_connection._validate_input_quantity(item_quantity)
-            item_string = cmd_arg.split('@')
-            storage_name = item_string[0]
-            item_name = item_string[1]
-            self._db_connection.set_item_quantity(_chatid, storage_name, item_name, int(item_quantity))
+            # The quantity is saved together with the expiry date, at the next step
             reply_text = "Write the expiration date in ISO format, use /stop to abort"
             cmd_name = "modify_item2"
+            cmd_arg = cmd_arg + "@" + str(int(item_quantity))
         elif (cmd_name == "modify_item2"):
             item_expiry = _user_input
             self._db_connection._validate_input_date(item_expiry)
             item_string = cmd_arg.split('@')
             storage_name = item_string[0]
             item_name = item_string[1]
-            self._db_connection.set_item_expiry(_chatid, storage_name, item_name, item_expiry)
+            item_quantity = int(item_string[2])
+            became_due = self._db_connection.set_item(_chatid, storage_name, item_name, item_quantity,
+                                                      item_expiry)
             reply_text = "Saved changes for item '{}'".format(item_name)
+            if (became_due and self._due_alerts):
+                # Without waiting for the next daily notification
+                alert_text = "🔔 Item '{}' in the storage '{}' expires on {}, use /check to see the items due" \
+                    .format(item_name, storage_name, item_expiry)
             cmd_name = "none"
             cmd_arg = "none"
         else:
             logging.warning("Callback not caught inside _callback_message function, due to unknown global command name '{}'".format(cmd_name))
             is_invalid_callback = True
         if (not is_invalid_callback):
-            self._db_connection.set_global_cmd_name(_chatid, cmd_name)
-            self._db_connection.set_global_cmd_arg(_chatid, cmd_arg)
+            self._db_connection.set_conversation_state(_chatid, cmd_name, cmd_arg,
+                                                       conversation_state["version"])
+            self._save_callbacks(keyboard_markup)
             update.message.reply_text(reply_text, reply_markup=keyboard_markup)
+            if (alert_text is not None):
+                update.message.reply_text(alert_text)
 
     def _callback_notify_expiry(self, context: CallbackContext):
-        foodpod_list = self._db_connection.get_pods()
-        for pod in foodpod_list:
-            bad_items = self._db_connection.get_item_expiring_or_bad_list(pod)
-            if (len(bad_items) > 0):
-                inline_keyboard = []
-                for item_dict in bad_items:
-                    name_fmt_str = "{} ({} days ago)"
-                    if (int(item_dict["days_expired"]) < 0):
-                        name_fmt_str = "{} (in {} days)"
-                    item_name = name_fmt_str.format(self._decorate_item_name(pod,
-                                                                             item_dict["storage"],
-                                                                             item_dict["item_name"]),
-                                                    abs(int(item_dict["days_expired"])))
-                    inline_button = [InlineKeyboardButton(item_name,
-                                                          callback_data=pod+":item_check_button:"+item_dict["item_name"]+"@"+item_dict["storage"])]
-                    inline_keyboard.append(inline_button)
-                inline_keyboard.append([])
-                inline_keyboard[-1].append(InlineKeyboardButton("⬅️  Back", callback_data=pod+":back_button:back_bot"))
-                keyboard_markup = InlineKeyboardMarkup(inline_keyboard)
-                reply_text = "🔔 *Status notification*\nThe following items have gone bad or are going to shortly"
-                context.bot.send_message(chat_id=pod,
-                                         text=reply_text,
-                                         reply_markup=keyboard_markup,
-                                         parse_mode="markdown")
-
-    def _callback_check(self, query, context):
+        if (self._runs_scheduled_jobs()):
+            self._expiry_notifier.start(context.bot)
+
+    def _callback_renew_probe(self, context: CallbackContext):
+        self._health_probe.renew()
+
+    def _runs_scheduled_jobs(self):
+        # With several instances, only the leader does
+        return self._cluster is None or self._cluster.is_leader()
+
+    def _build_expiry_report(self, pod):
+        item_count, bad_items = self._db_connection.get_item_expiring_or_bad_page(pod, 0, self._page_size)
+        report = self._compose_expiry_report(pod, bad_items, item_count)
+        if (report is not None):
+            self._save_callbacks(report[1])
+        return report
+
+    def _compose_expiry_report(self, pod, bad_items, item_count):
+        # Only the first page is sent, the others are reached with its buttons
+        if (len(bad_items) == 0):
+            return None
+        page_count = self._get_page_count(item_count)
+        keyboard_markup = self._renderer.render_expiring_items(bad_items,
+                                                               self._db_connection.get_current_day(),
+                                                               0, page_count)
+        reply_text = "🔔 *Status notification*\nThe following items have gone bad or are going to shortly\n{}" \
+            .format(self._renderer.render_page_caption(item_count, "items", 0, page_count))
+        return (reply_text, keyboard_markup)
+
+    def _get_page_count(self, count):
+        return max(1, -(-count // self._page_size))
+
+    def _get_page_fallback(self, count, page):
+        # A page left past the end by some deletion falls back to the last one
+        page_count = self._get_page_count(count)
+        return min(page, page_count - 1), page_count
+
+    def _load_page(self, load_page, page):
+        count, page_list = load_page(page)
+        fallback_page, page_count = self._get_page_fallback(count, page)
+        if (fallback_page != page):
+            page = fallback_page
+            count, page_list = load_page(page)
+        return count, page_list, page, page_count
+
+    def _callback_check(self, query, context, page=0):
         _chatid = str(query.message.chat.id)
-        _null_inline_button = [InlineKeyboardButton("~ Empty ~", callback_data=_chatid+":empty_button:none")]
-        inline_keyboard = [_null_inline_button]
-        item_list = self._db_connection.get_item_expiring_or_bad_list(_chatid)
-        if (len(item_list) > 0):
-            inline_keyboard.pop()
-            for item_dict in item_list:
-                name_fmt_str = "{} ({} days ago)"
-                if (int(item_dict["days_expired"]) < 0):
-                    name_fmt_str = "{} (in {} days)"
-                item_name = name_fmt_str.format(self._decorate_item_name(_chatid,
-                                                                         item_dict["storage"],
-                                                                         item_dict["item_name"]),
-                                                abs(int(item_dict["days_expired"])))
-                inline_button = [InlineKeyboardButton(item_name,
-                                                      callback_data=_chatid+":item_check_button:"+item_dict["item_name"]+"@"+item_dict["storage"])]
-                inline_keyboard.append(inline_button)
-        inline_keyboard.append([])
-        inline_keyboard[-1].append(InlineKeyboardButton("⬅️  Back", callback_data=_chatid+":back_button:back_bot"))
-        keyboard_markup = InlineKeyboardMarkup(inline_keyboard)
-        reply_text = "The following items are going to expire shortly or have already gone bad"
-        if (type(query) is Update):
-            query.message.reply_text(reply_text,
-                                     reply_markup=keyboard_markup)
-        elif (type(query is CallbackQuery)):
-            msg_id = query.message.message_id
-            chat_id = query.message.chat.id
-            query.bot.edit_message_text(reply_text,
-                                        message_id=msg_id, chat_id=chat_id,
-                                        reply_markup=keyboard_markup)
-
-    def _list_storage(self, query, chatid):
-        _null_inline_button = [InlineKeyboardButton("~ Empty ~", callback_data=chatid+":empty_button:none")]
-        inline_keyboard = [_null_inline_button]
-        storage_list = self._db_connection.get_storage_list(chatid)
-        if (len(storage_list) > 0):
-            inline_keyboard.pop()
-            for storage_location in storage_list:
-                inline_button = [InlineKeyboardButton(storage_location,
-                                                      callback_data=chatid+":storage_button:"+storage_location)]
-                inline_keyboard.append(inline_button)
-        inline_keyboard.append([])
-        inline_keyboard[-1].append(InlineKeyboardButton("🔄 Add", callback_data=chatid+":add_button:new_storage"))
-        inline_keyboard[-1].append(InlineKeyboardButton("⬅️  Back", callback_data=chatid+":back_button:back_bot"))
-        keyboard_markup = InlineKeyboardMarkup(inline_keyboard)
-        reply_text = "Select a storage location to list its contents"
-        if (type(query) is Update):
-            query.message.reply_text(reply_text,
-                                     reply_markup=keyboard_markup)
-        elif (type(query is CallbackQuery)):
-            msg_id = query.message.message_id
-            chat_id = query.message.chat.id
-            query.bot.edit_message_text(reply_text,
-                                        message_id=msg_id, chat_id=chat_id,
-                                        reply_markup=keyboard_markup)
-        else:
-            logging.warning("Unknown type '{}' for query argument in function _list_storage (pod ID: {})".format(type(query), chatid))
-
-    def _list_items(self, query, chatid, storage):
-        _null_inline_button = [InlineKeyboardButton("~ Empty ~", callback_data=chatid+":empty_button:none")]
-        inline_keyboard = [_null_inline_button]
-        item_list = self._db_connection.get_item_list(chatid, storage)
-        if (len(item_list) > 0):
-            inline_keyboard.pop()
-            for item_name in item_list:
-                button_label = self._decorate_item_name(chatid, storage, item_name)
-                inline_button = [InlineKeyboardButton(button_label,
-                                                      callback_data=chatid+":item_button:"+item_name)]
-                inline_keyboard.append(inline_button)
-        inline_keyboard.append([])
-        inline_keyboard[-1].append(InlineKeyboardButton("🔄 Add", callback_data=chatid+":add_button:new_item"))
-        inline_keyboard[-1].append(InlineKeyboardButton("⬅️  Back", callback_data=chatid+":back_button:back_storage"))
-        if (len(item_list) > 0):
-            inline_keyboard.append([InlineKeyboardButton("😵  Filter expired",
-                                                         callback_data=chatid+":expired_button:"+storage)])
-        inline_keyboard.append([InlineKeyboardButton("⤵️  Delete {}".format(storage),
-                                                     callback_data=chatid+":del_button:del_storage")])
-        keyboard_markup = InlineKeyboardMarkup(inline_keyboard)
-        msg_id = query.message.message_id
-        chat_id = query.message.chat.id
-        query.bot.edit_message_text("📦 Storage: *{}*\nSelect an item to list its properties"
-                                    .format(storage),
-                                    message_id=msg_id, chat_id=chat_id,
-                                    reply_markup=keyboard_markup,
-                                    parse_mode="markdown")
-
-    def _decorate_item_name(self, chatid, storage, item):
-        if (self._db_connection.get_item_quantity(chatid, storage, item) == 0):
-            return item + "❔"
-        else:
-            item_expiry = self._db_connection.get_item_expiry(chatid, storage, item)
-            current_date = self._db_connection.get_current_date()
-            expires_in = (item_expiry - current_date).days
-            if (expires_in < 0):
-                return item+"‼️ "
-            elif (expires_in == 0):
-                return item+"❗️"
-            elif (expires_in <= 2):
-                return item+"❕"
-            else:
-                return item
+        item_count, item_list, page, page_count = self._load_page(
+            lambda page: self._db_connection.get_item_expiring_or_bad_page(_chatid, page, self._page_size),
+            page)
+        self._show_message(query, *self._view_expiring_items(item_count, item_list, page, page_count))
+
+    def _list_storage(self, query, chatid, page=0):
+        storage_count, storage_list, page, page_count = self._load_page(
+            lambda page: self._db_connection.get_storage_list_page(chatid, page, self._page_size),
+            page)
+        self._show_message(query, *self._view_storage_list(storage_count, storage_list, page, page_count))
+
+    def _list_items(self, query, chatid, storage, page=0):
+        item_count, item_list, page, page_count = self._load_page(
+            lambda page: self._db_connection.get_storage_page(chatid, storage, page, self._page_size),
+            page)
+        self._show_message(query, *self._view_storage_items(storage, item_count, item_list, page, page_count))
 
     def _list_storage_expired_items(self, query, chatid, storage):
-        _null_inline_button = [InlineKeyboardButton("~ Empty ~", callback_data=chatid+":empty_button:none")]
-        inline_keyboard = [_null_inline_button]
         item_list = self._db_connection.get_item_expired_list(chatid, storage)
-        if (len(item_list) > 0):
-            inline_keyboard.pop()
-            for item_dict in item_list:
-                item_name = "{} ({} days ago)".format(item_dict["item_name"],
-                                                        item_dict["days_expired"])
-                inline_button = [InlineKeyboardButton(item_name,
-                                                      callback_data=chatid+":item_button:item_expired@"+item_dict["item_name"])]
-                inline_keyboard.append(inline_button)
-        inline_keyboard.append([])
-        inline_keyboard.append([InlineKeyboardButton("⬅️  Back",
-                                                     callback_data=chatid+":back_button:back_item_list@"+storage)])
-        if (len(item_list) > 0):
-            inline_keyboard.append([InlineKeyboardButton("🗑 Empty all expired",
-                                                         callback_data=chatid+":del_button:del_expired@"+storage)])
-        keyboard_markup = InlineKeyboardMarkup(inline_keyboard)
-        msg_id = query.message.message_id
-        chat_id = query.message.chat.id
-        query.bot.edit_message_text("😵 *Expired* (_{}_)\nSelect an item to list its properties"
-                                    .format(storage),
-                                    message_id=msg_id, chat_id=chat_id,
-                                    reply_markup=keyboard_markup,
-                                    parse_mode="markdown")
-
-    def _show_item(self, query, chatid, storage_name, item_name):
-        inline_keyboard = []
-        inline_keyboard.append([])
-        inline_keyboard[-1].append(InlineKeyboardButton("ℹ️  Modify", callback_data=chatid+":"+"modify_item"+":"+storage_name+"@"+item_name))
-        callback_button_value = query.data.split(':')[2]
-        if ("item_expired@" in callback_button_value):
-            inline_keyboard[-1].append(InlineKeyboardButton("⬅️  Back", callback_data=chatid+":expired_button:"+storage_name))
-        elif (self._db_connection.get_global_cmd_arg(chatid) == "item_check_button"):
-            inline_keyboard[-1].append(InlineKeyboardButton("⬅️  Back", callback_data=chatid+":item_check_button:show_list"))
-        else:
-            inline_keyboard[-1].append(InlineKeyboardButton("⬅️  Back", callback_data=chatid+":back_button:back_item_list@"+storage_name))
-        inline_keyboard.append([InlineKeyboardButton("⤵️  Delete {}".format(item_name),
-                                                     callback_data=chatid+":del_button:del_item@"+item_name+"@"+storage_name)])
-        keyboard_markup = InlineKeyboardMarkup(inline_keyboard)
-        msg_id = query.message.message_id
-        chat_id = query.message.chat.id
-        msg_text = "🍴 Item: *{}* ({})\n\n🔢 _Quantity_: `{}`\n📅 _Expires on_: `{}`".format(item_name.upper(), storage_name,
-                                                                      self._db_connection.get_item_quantity(chatid, storage_name, item_name),
-                                                                      self._db_connection.get_item_expiry(chatid, storage_name, item_name))
+        self._show_message(query, *self._view_expired_items(storage, item_list))
+
+    def _show_item(self, query, chatid, storage_name, item_name, origin):
+        item_dict = self._db_connection.get_item(chatid, storage_name, item_name)
+        self._show_message(query, *self._view_item(storage_name, item_name, item_dict, origin))
+
+    def _del_storage_dialog(self, query, chatid, storage):
+        self._show_message(query, *self._view_del_storage_dialog(
+            storage, self._db_connection.get_item_list_len(chatid, storage)))
+
+    def _purge_storage(self, query, chatid, storage, item_count):
+        # The items of a large storage are deleted in batches, without holding a worker
+        last_progress_at = monotonic()
         try:
-            query.bot.edit_message_text(msg_text,
-                                        message_id=msg_id, chat_id=chat_id,
-                                        reply_markup=keyboard_markup,
-                                        parse_mode="markdown")
+            for pending_count in self._db_connection.purge_deleted_storage(chatid, storage):
+                if (pending_count > 0 and monotonic() - last_progress_at >= STORAGE_PURGE_PROGRESS_INTERVAL):
+                    self._show_message(query, STORAGE_PURGE_PROGRESS_TEXT.format(storage, pending_count))
+                    last_progress_at = monotonic()
+            self._show_message(query, STORAGE_PURGE_DONE_TEXT.format(storage, item_count))
+        except Exception as e:
+            logging.error("Unable to complete the deletion of storage '{}' in Food Pod {}: {}"
+                          .format(storage, chatid, e))
+
+    def _del_item_dialog(self, query, chatid, storage, item_name, origin):
+        self._show_message(query, *self._view_del_item_dialog(storage, item_name, origin))
+
+    # The views are the (text, keyboard, parse mode) of a message, built alike by the sync
+    # and the asyncio handlers, which only read the inventory and send them differently
+
+    def _view_expiring_items(self, item_count, item_list, page, page_count):
+        keyboard_markup = self._renderer.render_expiring_items(item_list,
+                                                               self._db_connection.get_current_day(),
+                                                               page, page_count)
+        reply_text = "The following items are going to expire shortly or have already gone bad\n{}" \
+            .format(self._renderer.render_page_caption(item_count, "items", page, page_count))
+        return (reply_text, keyboard_markup, None)
+
+    def _view_storage_list(self, storage_count, storage_list, page, page_count):
+        keyboard_markup = self._renderer.render_storage_list(storage_list, page, page_count)
+        reply_text = "Select a storage location to list its contents\n{}" \
+            .format(self._renderer.render_page_caption(storage_count, "storages", page, page_count))
+        return (reply_text, keyboard_markup, None)
+
+    def _view_storage_items(self, storage, item_count, item_list, page, page_count):
+        keyboard_markup = self._renderer.render_storage_items(storage, item_list,
+                                                              self._db_connection.get_current_day(),
+                                                              page, page_count)
+        reply_text = "📦 Storage: *{}*\nSelect an item to list its properties\n{}" \
+            .format(storage, self._renderer.render_page_caption(item_count, "items", page, page_count))
+        return (reply_text, keyboard_markup, "markdown")
+
+    def _view_expired_items(self, storage, item_list):
+        keyboard_markup = self._renderer.render_expired_items(storage, item_list)
+        return ("😵 *Expired* (_{}_)\nSelect an item to list its properties".format(storage),
+                keyboard_markup, "markdown")
+
+    def _view_item(self, storage_name, item_name, item_dict, origin):
+        keyboard_markup = self._renderer.render_item(storage_name, item_name, origin)
+        msg_text = self._renderer.render_item_text(storage_name, item_name,
+                                                   item_dict["quantity"],
+                                                   self._db_connection.day_to_date(item_dict["expiry"]))
+        return (msg_text, keyboard_markup, "markdown")
+
+    def _view_del_storage_dialog(self, storage, item_count):
+        keyboard_markup = self._renderer.render_del_storage_dialog(storage)
+        return ("Are you sure you want to delete '{}' storage and its {} items?".format(storage, item_count),
+                keyboard_markup, None)
+
+    def _view_del_item_dialog(self, storage, item_name, origin):
+        keyboard_markup = self._renderer.render_del_item_dialog(storage, item_name, origin)
+        return ("Are you sure you want to delete '{}' item from '{}' storage?".format(item_name, storage),
+                keyboard_markup, None)
+
+    def _view_storage_deleted(self, storage, pending_count):
+        # The items left are purged in the background, which reports its progress
+        if (pending_count > 0):
+            return (STORAGE_PURGE_PROGRESS_TEXT.format(storage, pending_count), None, None)
+        return ("Deleted storage {}".format(storage), None, None)
+
+    def _view_item_deleted(self, storage, item_name):
+        return ("Deleted item {} from storage {}".format(item_name, storage), None, None)
+
+    def _view_close(self):
+        return ("Back to the main bot's chat", None, None)
+
+    # The prompts also return the conversation state waiting for the text
+
+    def _prompt_new_storage(self):
+        return (("Write the new storage location name, use /stop to abort", None, None),
+                ("new_storage", "none"))
+
+    def _prompt_new_item(self, storage):
+        return (("Write the new item name, use /stop to abort", None, None), ("new_item", storage))
+
+    def _prompt_quantity(self, storage, item_name):
+        return (("Write the quantity as an integer, use /stop to abort", None, None),
+                ("modify_item", storage + "@" + item_name))
+
+    def _show_message(self, query, text, keyboard_markup=None, parse_mode=None):
+        # Replies to a command, or edits the message of the pressed button unless it would
+        # show the same as it does already
+        self._save_callbacks(keyboard_markup)
+        digest = self._render_cache.get_digest(text, keyboard_markup, parse_mode)
+        if (type(query) is Update):
+            message = query.message.reply_text(text, reply_markup=keyboard_markup, parse_mode=parse_mode)
+            self._render_cache.remember(message.chat.id, message.message_id, digest)
+            return
+        edited = self._render_cache.edit(
+            query.message.chat.id, query.message.message_id, digest,
+            lambda: query.bot.edit_message_text(text, message_id=query.message.message_id,
+                                                chat_id=query.message.chat.id,
+                                                reply_markup=keyboard_markup, parse_mode=parse_mode))
+        if (not edited):
+            self._answer_button(query)
+
+    def _save_callbacks(self, keyboard_markup):
+        # The tokens of the whole keyboard are saved at once, before it is sent
+        self._db_connection.save_callbacks(self._callback_codec.pack(keyboard_markup))
+
+    def _answer_button(self, query):
+        # Only stops the button's loading animation, so it does not matter if it is too late
+        try:
+            query.answer()
         except BadRequest:
             pass
 
-    def _del_storage_dialog(self, query, chatid, storage):
-        inline_keyboard = []
-        inline_keyboard.append([])
-        inline_keyboard[-1].append(InlineKeyboardButton("YES", callback_data=chatid+":del_storage_confirm:"+storage))
-        inline_keyboard[-1].append(InlineKeyboardButton("NO", callback_data=chatid+":back_button:back_item_list@"+storage))
-        keyboard_markup = InlineKeyboardMarkup(inline_keyboard)
-        msg_id = query.message.message_id
-        chat_id = query.message.chat.id
-        query.bot.edit_message_text("Are you sure you want to delete '{}' storage and its {} items?"
-                                    .format(storage, self._db_connection.get_item_list_len(chatid, storage)),
-                                    message_id=msg_id, chat_id=chat_id,
-                                    reply_markup=keyboard_markup)
-
-    def _del_item_dialog(self, query, chatid, storage, item):
-        item_name = item
-        if (len(item.split('@')) > 1):
-            item_name = item.split('@')[1]
-        inline_keyboard = []
-        inline_keyboard.append([])
-        inline_keyboard[-1].append(InlineKeyboardButton("YES", callback_data=chatid+":del_item_confirm:"+storage+"@"+item_name))
-        inline_keyboard[-1].append(InlineKeyboardButton("NO", callback_data=chatid+":back_button:back_item@"+item_name))
-        keyboard_markup = InlineKeyboardMarkup(inline_keyboard)
-        msg_id = query.message.message_id
-        chat_id = query.message.chat.id
-        query.bot.edit_message_text("Are you sure you want to delete '{}' item from '{}' storage?"
-                                    .format(item_name, storage),
-                                    message_id=msg_id, chat_id=chat_id,
-                                    reply_markup=keyboard_markup)
+    def warm_up(self):
+        # Checks the token and opens the connection to the Bot API before the first update
+        try:
+            bot_user = self._updater.bot.get_me()
+            logging.info("Logged in to Telegram as @{}".format(bot_user.username))
+        except NetworkError as e:
+            logging.warning("Unable to reach Telegram at startup, the bot will keep trying: {}".format(e))
+
+    def _mark_ready(self):
+        if (self._health_probe is not None):
+            self._health_probe.mark_ready()
 
     def run(self):
-        self._updater.start_polling()
-        logging.info("Bot started, press CTRL+C to stop it")
-        self._updater.idle()
+        if (self._metrics.is_enabled()):
+            from MetricsExporter import MetricsExporter
+            self._metrics_exporter = MetricsExporter(self._metrics,
+                                                     listen=environ.get("METRICS_LISTEN", "127.0.0.1"),
+                                                     port=int(environ.get("METRICS_PORT", 9464)))
+            self._metrics_exporter.start()
+        if (self._cluster is not None and environ.get("BOT_MODE", "polling") != "webhook"):
+            # Telegram hands the updates to a single poller at a time
+            logging.error("Running several instances requires BOT_MODE=\"webhook\"")
+            return
+        if (environ.get("BOT_MODE", "polling") == "webhook"):
+            self._run_webhook()
+        else:
+            self._updater.start_polling()
+            self._mark_ready()
+            logging.info("Bot started, press CTRL+C to stop it")
+            self._updater.idle()
+
+    def _run_webhook(self):
+        from WebhookListener import WebhookListener
+        if (self._webhook_secret is None):
+            self._webhook_secret = token_urlsafe(32)
+        self._webhook_listener = WebhookListener(self._process_webhook_update,
+                                                 self._webhook_secret,
+                                                 listen=environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+                                                 port=int(environ.get("WEBHOOK_PORT", 8443)),
+                                                 url_path=environ.get("WEBHOOK_PATH", "/telegram"),
+                                                 queue_size=int(environ.get("WEBHOOK_QUEUE_SIZE", 100)),
+                                                 workers=int(environ.get("WEBHOOK_WORKERS", 4)))
+        if (self._cluster is not None):
+            self._cluster.start()
+        self._webhook_listener.start()
+        # Without a public URL, the webhook is expected to be registered by other means
+        webhook_url = environ.get("WEBHOOK_URL")
+        if (webhook_url is not None):
+            self._updater.bot.set_webhook(webhook_url,
+                                          max_connections=int(environ.get("WEBHOOK_WORKERS", 4)),
+                                          api_kwargs={"secret_token": self._webhook_secret})
+        self._job_queue.start()
+        self._mark_ready()
+        logging.info("Bot started in webhook mode, press CTRL+C to stop it")
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(stop_signal, lambda signum, frame: self._stop_event.set())
+        self._stop_event.wait()
+
+    def _process_webhook_update(self, update_json):
+        if (self._cluster is None):
+            self._dispatch_update(update_json)
+            return
+        # Handed over to the instance processing the chat, in the order they arrived
+        update = Update.de_json(update_json, self._updater.bot)
+        self._cluster.publish(update_json, update.effective_chat.id if update.effective_chat is not None else 0)
+
+    def _dispatch_update(self, update_json):
+        self._dispatcher.process_update(Update.de_json(update_json, self._updater.bot))
 
     def halt(self):
         logging.info("Tearing down the Bot service")
+        if (self._health_probe is not None):
+            self._health_probe.clear()
+        if (self._metrics_exporter is not None):
+            self._metrics_exporter.stop()
+        if (self._webhook_listener is not None):
+            self._webhook_listener.stop()
+            if (self._cluster is not None):
+                self._cluster.stop()
+            self._job_queue.stop()
+        self._transfer_executor.shutdown(wait=False)
         self._updater.stop()
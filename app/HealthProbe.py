@@ -0,0 +1,45 @@
+import logging
+
+from pathlib import Path
+
+
+class HealthProbe:
+
+    # Tells the container runtime how the bot is doing through a file: it is created once
+    # the bot handles updates, and its modification time is renewed as long as the bot and
+    # its database respond, so a stale file means the bot should be restarted
+
+    def __init__(self, db, path):
+        self._db_connection = db
+        self._path = Path(path)
+        self._is_ready = False
+
+    def get_path(self):
+        return str(self._path)
+
+    def mark_ready(self):
+        self._path.write_text(str(self._db_connection.get_timestamp()))
+        self._is_ready = True
+        logging.info("Bot ready, health probe file written to '{}'".format(self._path))
+
+    def renew(self):
+        if (not self._is_ready):
+            return False
+        try:
+            self._db_connection.ping()
+        except Exception as e:
+            logging.warning("Health check failed, the probe file is left to expire: {}".format(e))
+            return False
+        self._path.write_text(str(self._db_connection.get_timestamp()))
+        return True
+
+    def clear(self):
+        # The file is only removed by the process that wrote it, as a bot started to profile
+        # its startup may share the path with the one running
+        if (not self._is_ready):
+            return
+        self._is_ready = False
+        try:
+            self._path.unlink()
+        except FileNotFoundError:
+            pass
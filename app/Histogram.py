@@ -0,0 +1,42 @@
+import threading
+
+from bisect import bisect_left
+
+
+class Histogram:
+
+    # Counts the observations falling in each bucket, in the fashion of Prometheus histograms:
+    # a value goes in the first bucket whose upper bound is not lower than it
+
+    def __init__(self, buckets):
+        self._buckets = list(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        bucket_index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[bucket_index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative_counts = []
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip(self._buckets + [float("inf")], counts):
+            cumulative_count += bucket_count
+            cumulative_counts.append((upper_bound, cumulative_count))
+        return {"buckets": cumulative_counts, "sum": total, "count": count}
+
+    def get_quantile_bound(self, quantile):
+        # Upper bound of the bucket holding the requested quantile
+        snapshot = self.snapshot()
+        for upper_bound, cumulative_count in snapshot["buckets"]:
+            if (cumulative_count >= quantile * snapshot["count"]):
+                return upper_bound
+        return None
@@ -0,0 +1,136 @@
+import threading
+
+from collections import OrderedDict
+from os import environ
+from time import monotonic
+
+
+class InventoryCache:
+
+    def __init__(self):
+        self._ttl = float(environ.get("CACHE_TTL", 300))
+        self._max_bytes = int(environ.get("CACHE_MAX_BYTES", 8 * 1024 * 1024))
+        if (environ.get("INSTANCE_MODE", "single") == "multi"):
+            # The other instances write without invalidating it
+            self._max_bytes = 0
+        self._entries = OrderedDict()
+        self._storage_keys = {}
+        self._used_bytes = 0
+        self._invalidations = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def is_enabled(self):
+        return self._max_bytes > 0
+
+    def get_or_load(self, chatid, storage, loader, page=None):
+        # Entries are keyed by chat and storage; a None storage holds the storage list, a
+        # page holds a (total count, list window) pair instead of the whole list, and an
+        # item name holds that item alone
+        key = (chatid, storage, page)
+        is_hit, value, invalidations = self._lookup(key)
+        if (is_hit):
+            return value
+        return self._store_loaded(key, loader(), invalidations)
+
+    async def get_or_load_async(self, chatid, storage, loader, page=None):
+        # The same as get_or_load, for a coroutine function loading the value
+        key = (chatid, storage, page)
+        is_hit, value, invalidations = self._lookup(key)
+        if (is_hit):
+            return value
+        return self._store_loaded(key, await loader(), invalidations)
+
+    def find_item(self, chatid, storage, item_name):
+        # Looks for an item in whatever is cached of its storage, as the pages hold the
+        # items whole; returns None if it is not found
+        with self._lock:
+            now = monotonic()
+            for key in self._storage_keys.get((chatid, storage), ()):
+                expires_at, value, _ = self._entries[key]
+                if (expires_at <= now):
+                    continue
+                for element in (value[1] if isinstance(value, tuple) else value):
+                    if (isinstance(element, dict) and element.get("item_name") == item_name):
+                        self._entries.move_to_end(key)
+                        self._hits += 1
+                        return dict(element)
+        return None
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and entry[0] > monotonic()):
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return (True, self._copy_value(entry[1]), None)
+            if (entry is not None):
+                self._drop(key)
+            self._misses += 1
+            return (False, None, self._invalidations)
+
+    def _store_loaded(self, key, value, invalidations):
+        with self._lock:
+            # Do not store what was read while a write was invalidating the cache
+            if (self.is_enabled() and invalidations == self._invalidations):
+                self._store(key, value)
+        return self._copy_value(value)
+
+    def invalidate(self, chatid, storage=None):
+        # Drops the whole list together with all its pages
+        with self._lock:
+            self._invalidations += 1
+            for key in list(self._storage_keys.get((chatid, storage), ())):
+                self._drop(key)
+
+    def invalidate_pod(self, chatid):
+        with self._lock:
+            self._invalidations += 1
+            for key in [key for key in self._entries if key[0] == chatid]:
+                self._drop(key)
+
+    def get_stats(self):
+        with self._lock:
+            return {"hits": self._hits,
+                    "misses": self._misses,
+                    "entries": len(self._entries),
+                    "used_bytes": self._used_bytes,
+                    "max_bytes": self._max_bytes}
+
+    def _store(self, key, value):
+        if (key in self._entries):
+            self._drop(key)
+        size = self._estimate_size(value)
+        if (size > self._max_bytes):
+            return
+        self._entries[key] = (monotonic() + self._ttl, value, size)
+        self._storage_keys.setdefault(key[:2], set()).add(key)
+        self._used_bytes += size
+        # Evict the least recently used entries until the cache fits its memory cap
+        while (self._used_bytes > self._max_bytes):
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        self._used_bytes -= self._entries.pop(key)[2]
+        storage_keys = self._storage_keys[key[:2]]
+        storage_keys.discard(key)
+        if (len(storage_keys) == 0):
+            del self._storage_keys[key[:2]]
+
+    def _copy_value(self, value):
+        # Callers are free to modify what they get, without touching the cached copy
+        if (isinstance(value, tuple)):
+            return (value[0], self._copy_value(value[1]))
+        return [dict(element) if isinstance(element, dict) else element for element in value]
+
+    def _estimate_size(self, value):
+        if (isinstance(value, tuple)):
+            return 64 + self._estimate_size(value[1])
+        size = 64
+        for element in value:
+            if isinstance(element, dict):
+                size += 360 + sum(len(str(field)) for field in element.values())
+            else:
+                size += 56 + len(element)
+        return size
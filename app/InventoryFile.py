@@ -0,0 +1,85 @@
+import csv
+import io
+import json
+
+from DbConnectionSingleton import DEFAULT_ITEM_EXPIRY
+
+INVENTORY_FIELDS = ["storage", "item", "quantity", "expiry"]
+INVENTORY_FORMATS = ["csv", "jsonl"]
+MAX_REPORTED_ERRORS = 5
+
+
+class InventoryFile:
+
+    # Reads and writes a pod's inventory as CSV or JSON Lines, one row at a time, so the
+    # memory in use does not depend on the size of the file
+
+    def __init__(self, db):
+        self._db_connection = db
+
+    def get_format(self, file_name):
+        extension = (file_name or "").rsplit(".", 1)[-1].lower()
+        if (extension == "json"):
+            extension = "jsonl"
+        return extension if extension in INVENTORY_FORMATS else None
+
+    def write(self, binary_file, file_format, item_dicts):
+        text_file = io.TextIOWrapper(binary_file, encoding="utf-8", newline="")
+        item_count = 0
+        if (file_format == "csv"):
+            writer = csv.writer(text_file)
+            writer.writerow(INVENTORY_FIELDS)
+        for item_dict in item_dicts:
+            expiry_date = self._db_connection.day_to_date(item_dict["expiry"])
+            row = [item_dict["storage"], item_dict["item_name"], item_dict["quantity"],
+                   expiry_date.isoformat() if expiry_date is not None else ""]
+            if (file_format == "csv"):
+                writer.writerow(row)
+            else:
+                text_file.write(json.dumps(dict(zip(INVENTORY_FIELDS, row))) + "\n")
+            item_count += 1
+        # Hand the file back to the caller, which is still reading from it
+        text_file.flush()
+        text_file.detach()
+        return item_count
+
+    def read(self, binary_file, file_format, summary):
+        # Yields the valid rows as (storage, item, quantity, expiry day) tuples; the invalid ones
+        # are counted in the summary, together with the reasons of the first few
+        text_file = io.TextIOWrapper(binary_file, encoding="utf-8-sig", newline="")
+        try:
+            if (file_format == "csv"):
+                rows = enumerate(csv.DictReader(text_file), start=2)
+            else:
+                rows = ((line_number, line) for line_number, line in enumerate(text_file, start=1)
+                        if line.strip() != "")
+            for line_number, row in rows:
+                try:
+                    if (file_format != "csv"):
+                        row = json.loads(row)
+                        if (not isinstance(row, dict)):
+                            raise Exception("Wrong input! Each line must be a JSON object")
+                    yield self._parse_row(row)
+                except Exception as e:
+                    summary["skipped"] += 1
+                    if (len(summary["errors"]) < MAX_REPORTED_ERRORS):
+                        summary["errors"].append("line {}: {}".format(line_number, e))
+        finally:
+            text_file.detach()
+
+    def _parse_row(self, row):
+        # Every value is validated and converted here, so that no row can fail once queued
+        storage = str(row.get("storage") or "").strip()
+        item_name = str(row.get("item") or "").strip()
+        quantity = str(row.get("quantity") if row.get("quantity") is not None else "").strip()
+        expiry = str(row.get("expiry") or "").strip()
+        if (storage == "" or item_name == ""):
+            raise Exception("Wrong input! The storage and item names are required")
+        self._db_connection._validate_input_text(storage)
+        self._db_connection._validate_input_text(item_name)
+        if (quantity == ""):
+            quantity = "0"
+        self._db_connection._validate_input_quantity(quantity)
+        if (expiry == ""):
+            expiry = DEFAULT_ITEM_EXPIRY
+        return (storage, item_name, int(quantity), self._db_connection._parse_input_date(expiry))
@@ -0,0 +1,150 @@
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from CallbackCodec import ACTION_STORAGES, ACTION_STORAGE, ACTION_NEW_STORAGE, ACTION_NEW_ITEM
+from CallbackCodec import ACTION_ITEM, ACTION_MODIFY_ITEM, ACTION_EXPIRED, ACTION_EMPTY_EXPIRED
+from CallbackCodec import ACTION_DEL_STORAGE, ACTION_DEL_STORAGE_CONFIRM, ACTION_DEL_ITEM
+from CallbackCodec import ACTION_DEL_ITEM_CONFIRM, ACTION_CHECK, ACTION_CLOSE, ACTION_NONE
+from CallbackCodec import ORIGIN_STORAGE, ORIGIN_EXPIRED, ORIGIN_CHECK
+
+
+class KeyboardRenderer:
+
+    # Every method builds a whole keyboard from data prefetched in a single snapshot,
+    # without reading from or writing to the database; every button carries what its handler
+    # needs, even beyond Telegram's limit, until CallbackCodec packs the keyboard to send it
+
+    def __init__(self, callback_codec):
+        self._callback_codec = callback_codec
+
+    def render_storage_list(self, storage_list, page=0, page_count=1):
+        inline_keyboard = self._render_rows([
+            [self._button(storage_location, ACTION_STORAGE, storage_location)]
+            for storage_location in storage_list])
+        self._render_page_row(inline_keyboard, page, page_count, ACTION_STORAGES)
+        inline_keyboard.append([])
+        inline_keyboard[-1].append(self._button("🔄 Add", ACTION_NEW_STORAGE))
+        inline_keyboard[-1].append(self._button("⬅️  Back", ACTION_CLOSE))
+        return InlineKeyboardMarkup(inline_keyboard)
+
+    def render_storage_items(self, storage, item_list, current_day, page=0, page_count=1):
+        inline_keyboard = self._render_rows([
+            [self._button(self.decorate_item_name(item_dict, current_day),
+                          ACTION_ITEM, storage, item_dict["item_name"], ORIGIN_STORAGE)]
+            for item_dict in item_list])
+        self._render_page_row(inline_keyboard, page, page_count, ACTION_STORAGE, storage)
+        inline_keyboard.append([])
+        inline_keyboard[-1].append(self._button("🔄 Add", ACTION_NEW_ITEM, storage))
+        inline_keyboard[-1].append(self._button("⬅️  Back", ACTION_STORAGES))
+        if (len(item_list) > 0):
+            inline_keyboard.append([self._button("😵  Filter expired", ACTION_EXPIRED, storage)])
+        inline_keyboard.append([self._button("⤵️  Delete {}".format(storage), ACTION_DEL_STORAGE, storage)])
+        return InlineKeyboardMarkup(inline_keyboard)
+
+    def render_expiring_items(self, item_list, current_day, page=0, page_count=1):
+        inline_keyboard = []
+        for item_dict in item_list:
+            name_fmt_str = "{} ({} days ago)"
+            if (int(item_dict["days_expired"]) < 0):
+                name_fmt_str = "{} (in {} days)"
+            item_name = name_fmt_str.format(self.decorate_item_name(item_dict, current_day),
+                                            abs(int(item_dict["days_expired"])))
+            inline_keyboard.append([self._button(item_name, ACTION_ITEM, item_dict["storage"],
+                                                 item_dict["item_name"], ORIGIN_CHECK)])
+        inline_keyboard = self._render_rows(inline_keyboard)
+        self._render_page_row(inline_keyboard, page, page_count, ACTION_CHECK)
+        inline_keyboard.append([])
+        inline_keyboard[-1].append(self._button("⬅️  Back", ACTION_CLOSE))
+        return InlineKeyboardMarkup(inline_keyboard)
+
+    def render_expired_items(self, storage, item_list):
+        inline_keyboard = self._render_rows([
+            [self._button("{} ({} days ago)".format(item_dict["item_name"], item_dict["days_expired"]),
+                          ACTION_ITEM, storage, item_dict["item_name"], ORIGIN_EXPIRED)]
+            for item_dict in item_list])
+        inline_keyboard.append([])
+        inline_keyboard.append([self._button("⬅️  Back", ACTION_STORAGE, storage)])
+        if (len(item_list) > 0):
+            inline_keyboard.append([self._button("🗑 Empty all expired", ACTION_EMPTY_EXPIRED, storage)])
+        return InlineKeyboardMarkup(inline_keyboard)
+
+    def render_found_items(self, item_list, current_day):
+        # The items found are shown as if they were selected from their storage
+        inline_keyboard = self._render_rows([
+            [self._button("{} ({})".format(self.decorate_item_name(item_dict, current_day),
+                                           item_dict["storage"]),
+                          ACTION_ITEM, item_dict["storage"], item_dict["item_name"], ORIGIN_STORAGE)]
+            for item_dict in item_list])
+        inline_keyboard.append([])
+        inline_keyboard[-1].append(self._button("⬅️  Back", ACTION_CLOSE))
+        return InlineKeyboardMarkup(inline_keyboard)
+
+    def render_item(self, storage_name, item_name, origin):
+        if (origin == ORIGIN_EXPIRED):
+            back_button = self._button("⬅️  Back", ACTION_EXPIRED, storage_name)
+        elif (origin == ORIGIN_CHECK):
+            back_button = self._button("⬅️  Back", ACTION_CHECK)
+        else:
+            back_button = self._button("⬅️  Back", ACTION_STORAGE, storage_name)
+        inline_keyboard = []
+        inline_keyboard.append([])
+        inline_keyboard[-1].append(self._button("ℹ️  Modify", ACTION_MODIFY_ITEM, storage_name, item_name))
+        inline_keyboard[-1].append(back_button)
+        inline_keyboard.append([self._button("⤵️  Delete {}".format(item_name),
+                                             ACTION_DEL_ITEM, storage_name, item_name, origin)])
+        return InlineKeyboardMarkup(inline_keyboard)
+
+    def render_item_text(self, storage_name, item_name, quantity, expiry):
+        return "🍴 Item: *{}* ({})\n\n🔢 _Quantity_: `{}`\n📅 _Expires on_: `{}`".format(
+            item_name.upper(), storage_name, quantity, expiry)
+
+    def render_del_storage_dialog(self, storage):
+        inline_keyboard = []
+        inline_keyboard.append([])
+        inline_keyboard[-1].append(self._button("YES", ACTION_DEL_STORAGE_CONFIRM, storage))
+        inline_keyboard[-1].append(self._button("NO", ACTION_STORAGE, storage))
+        return InlineKeyboardMarkup(inline_keyboard)
+
+    def render_del_item_dialog(self, storage, item_name, origin):
+        inline_keyboard = []
+        inline_keyboard.append([])
+        inline_keyboard[-1].append(self._button("YES", ACTION_DEL_ITEM_CONFIRM, storage, item_name))
+        inline_keyboard[-1].append(self._button("NO", ACTION_ITEM, storage, item_name, origin))
+        return InlineKeyboardMarkup(inline_keyboard)
+
+    def decorate_item_name(self, item_dict, current_day):
+        item = item_dict["item_name"]
+        if (item_dict["quantity"] == 0):
+            return item + "❔"
+        else:
+            expires_in = item_dict["expiry"] - current_day
+            if (expires_in < 0):
+                return item+"‼️ "
+            elif (expires_in == 0):
+                return item+"❗️"
+            elif (expires_in <= 2):
+                return item+"❕"
+            else:
+                return item
+
+    def render_page_caption(self, count, unit, page, page_count):
+        if (page_count > 1):
+            return "({} {}, page {}/{})".format(count, unit, page + 1, page_count)
+        return "({} {})".format(count, unit)
+
+    def _render_page_row(self, inline_keyboard, page, page_count, action, *args):
+        # The buttons carry the view and the page to show, so moving to another page costs
+        # a single windowed read
+        if (page_count <= 1):
+            return
+        inline_keyboard.append([])
+        if (page > 0):
+            inline_keyboard[-1].append(self._button("◀️ Prev", action, *args, str(page - 1)))
+        if (page < page_count - 1):
+            inline_keyboard[-1].append(self._button("Next ▶️", action, *args, str(page + 1)))
+
+    def _render_rows(self, item_rows):
+        if (len(item_rows) == 0):
+            return [[self._button("~ Empty ~", ACTION_NONE)]]
+        return item_rows
+
+    def _button(self, text, action, *args):
+        return InlineKeyboardButton(text, callback_data=self._callback_codec.join(action, *args))
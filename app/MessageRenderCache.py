@@ -0,0 +1,119 @@
+import threading
+
+from collections import OrderedDict
+from os import environ
+from telegram.error import BadRequest
+
+
+class MessageRenderCache:
+
+    # Remembers a digest of what each message shows, so that edits which would not change
+    # it are skipped; the edits asked while another one of the same message is being sent
+    # are coalesced, and only the last of them follows it
+
+    def __init__(self):
+        self._max_entries = int(environ.get("RENDER_CACHE_SIZE", 1024))
+        if (environ.get("INSTANCE_MODE", "single") == "multi"):
+            # The messages of a chat are edited by another instance when its shard moves
+            self._max_entries = 0
+        self._rendered = OrderedDict()
+        self._sending = {}
+        self._skipped = 0
+        self._coalesced = 0
+        self._lock = threading.Lock()
+
+    def get_digest(self, text, keyboard_markup=None, parse_mode=None):
+        return hash((text, keyboard_markup.to_json() if keyboard_markup is not None else None,
+                     parse_mode))
+
+    def remember(self, chat_id, message_id, digest):
+        with self._lock:
+            self._store((chat_id, message_id), digest)
+
+    def edit(self, chat_id, message_id, digest, send):
+        # Returns False if the edit was skipped or handed over to the one being sent
+        key = (chat_id, message_id)
+        if (not self._begin(key, digest, send)):
+            return False
+        while True:
+            try:
+                send()
+            except BadRequest as e:
+                if (not self._is_not_modified(e)):
+                    self._abort(key)
+                    raise
+            except Exception:
+                self._abort(key)
+                raise
+            pending = self._complete(key, digest)
+            if (pending is None):
+                return True
+            digest, send = pending
+
+    async def edit_async(self, chat_id, message_id, digest, send):
+        # The same as edit, for a coroutine function sending the edit
+        key = (chat_id, message_id)
+        if (not self._begin(key, digest, send)):
+            return False
+        while True:
+            try:
+                await send()
+            except BadRequest as e:
+                if (not self._is_not_modified(e)):
+                    self._abort(key)
+                    raise
+            except Exception:
+                self._abort(key)
+                raise
+            pending = self._complete(key, digest)
+            if (pending is None):
+                return True
+            digest, send = pending
+
+    def get_stats(self):
+        with self._lock:
+            return {"entries": len(self._rendered),
+                    "max_entries": self._max_entries,
+                    "skipped": self._skipped,
+                    "coalesced": self._coalesced}
+
+    def _begin(self, key, digest, send):
+        with self._lock:
+            if (key in self._sending):
+                # Replaces any edit already waiting, which nobody is going to see
+                self._sending[key] = (digest, send)
+                self._coalesced += 1
+                return False
+            if (key in self._rendered and self._rendered[key] == digest):
+                self._rendered.move_to_end(key)
+                self._skipped += 1
+                return False
+            self._sending[key] = None
+            return True
+
+    def _complete(self, key, digest):
+        with self._lock:
+            self._store(key, digest)
+            pending = self._sending[key]
+            if (pending is None or pending[0] == digest):
+                del self._sending[key]
+                return None
+            self._sending[key] = None
+            return pending
+
+    def _abort(self, key):
+        # What the message shows is unknown after a failed edit
+        with self._lock:
+            self._rendered.pop(key, None)
+            del self._sending[key]
+
+    def _store(self, key, digest):
+        if (self._max_entries <= 0):
+            return
+        self._rendered[key] = digest
+        self._rendered.move_to_end(key)
+        while (len(self._rendered) > self._max_entries):
+            self._rendered.popitem(last=False)
+
+    def _is_not_modified(self, error):
+        return "message is not modified" in str(error).lower()
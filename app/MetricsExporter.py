@@ -0,0 +1,53 @@
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MetricsExporter:
+
+    # Serves the collected metrics in the Prometheus text format, meant to be scraped locally
+
+    def __init__(self, metrics, listen="127.0.0.1", port=9464, url_path="/metrics"):
+        self._metrics = metrics
+        self._url_path = url_path
+        self._server = ThreadingHTTPServer((listen, port), self._make_request_handler())
+        self._server.daemon_threads = True
+        self._server_thread = None
+
+    def get_port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._server_thread = threading.Thread(target=self._server.serve_forever,
+                                               name="MetricsExporter", daemon=True)
+        self._server_thread.start()
+        logging.info("Metrics exposed on {}:{}{}"
+                     .format(self._server.server_address[0], self.get_port(), self._url_path))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_request_handler(self):
+        exporter = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if (self.path != exporter._url_path):
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = exporter._metrics.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics exporter: " + format % args)
+
+        return MetricsRequestHandler
@@ -0,0 +1,198 @@
+import inspect
+import threading
+
+from os import environ
+from functools import wraps
+from time import perf_counter
+from Histogram import Histogram
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+COMMAND_COUNT_BUCKETS = [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+
+class MetricsSingleton:
+
+    # Collects the latency of the dispatcher handlers, of the database methods and of the
+    # Telegram API calls, and counts the Redis commands; when disabled nothing is wrapped,
+    # so the instrumented code runs untouched
+
+    __instance = None
+
+    @staticmethod
+    def getInstance():
+        if MetricsSingleton.__instance is None:
+            MetricsSingleton()
+        return MetricsSingleton.__instance
+
+    def __init__(self):
+        if MetricsSingleton.__instance is not None:
+            raise Exception("This class is a singleton, and an instance exists yet!")
+        else:
+            MetricsSingleton.__instance = self
+            self._enabled = environ.get("METRICS_ENABLED", "false") == "true"
+            self._lock = threading.Lock()
+            self._local = threading.local()
+            self._handler_latency = {}
+            self._db_latency = {}
+            self._telegram_latency = {}
+            self._redis_commands = {}
+            self._update_redis_commands = Histogram(COMMAND_COUNT_BUCKETS)
+
+    def is_enabled(self):
+        return self._enabled
+
+    def _get_histogram(self, histograms, name):
+        with self._lock:
+            if (name not in histograms):
+                histograms[name] = Histogram(LATENCY_BUCKETS)
+            return histograms[name]
+
+    def instrument_dispatcher(self, dispatcher):
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                handler.callback = self._time_handler(handler.callback)
+
+    def _time_handler(self, callback):
+        histogram = self._get_histogram(self._handler_latency,
+                                        callback.__name__.replace("_callback_", "", 1))
+
+        @wraps(callback)
+        def timed_callback(update, context):
+            self._local.redis_commands = 0
+            started_at = perf_counter()
+            try:
+                return callback(update, context)
+            finally:
+                histogram.observe(perf_counter() - started_at)
+                self._update_redis_commands.observe(self._local.redis_commands)
+                self._local.redis_commands = None
+        return timed_callback
+
+    def instrument_db(self, db):
+        # The generators are left alone, as their calls return before doing any work
+        for name, method in inspect.getmembers(db, inspect.ismethod):
+            if (name.startswith("_") or inspect.isgeneratorfunction(method)):
+                continue
+            setattr(db, name, self._time_method(self._get_histogram(self._db_latency, name), method))
+
+    def _time_method(self, histogram, method):
+        @wraps(method)
+        def timed_method(*args, **kwargs):
+            started_at = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - started_at)
+        return timed_method
+
+    def instrument_bot(self, bot):
+        metrics = self
+
+        class TimedRequest:
+
+            # Stands in for the bot's HTTP client, timing every API call by its endpoint
+
+            def __init__(self, request):
+                self._request = request
+
+            def __getattr__(self, name):
+                return getattr(self._request, name)
+
+            def post(self, url, *args, **kwargs):
+                histogram = metrics._get_histogram(metrics._telegram_latency, url.rsplit("/", 1)[-1])
+                started_at = perf_counter()
+                try:
+                    return self._request.post(url, *args, **kwargs)
+                finally:
+                    histogram.observe(perf_counter() - started_at)
+        bot._request = TimedRequest(bot.request)
+
+    def instrument_connection_class(self, connection_class):
+        metrics = self
+
+        class InstrumentedConnection(connection_class):
+
+            # Every command is packed once before being sent, also inside pipelines
+
+            def pack_command(self, *args):
+                metrics._count_redis_command(args[0])
+                return super().pack_command(*args)
+        return InstrumentedConnection
+
+    def _count_redis_command(self, command_name):
+        if (isinstance(command_name, bytes)):
+            command_name = command_name.decode()
+        command_name = str(command_name).split(" ")[0].upper()
+        with self._lock:
+            self._redis_commands[command_name] = self._redis_commands.get(command_name, 0) + 1
+        if (getattr(self._local, "redis_commands", None) is not None):
+            self._local.redis_commands += 1
+
+    def render_prometheus(self):
+        lines = []
+        self._render_histograms(lines, "foodpod_handler_duration_seconds",
+                                "Time spent in each dispatcher handler", "handler",
+                                self._handler_latency)
+        self._render_histograms(lines, "foodpod_db_method_duration_seconds",
+                                "Time spent in each database method", "method",
+                                self._db_latency)
+        self._render_histograms(lines, "foodpod_telegram_request_duration_seconds",
+                                "Time spent in each Telegram API call", "endpoint",
+                                self._telegram_latency)
+        self._render_histograms(lines, "foodpod_update_redis_commands",
+                                "Redis commands sent while handling an update", None,
+                                {None: self._update_redis_commands})
+        lines.append("# HELP foodpod_redis_commands_total Redis commands sent, by command")
+        lines.append("# TYPE foodpod_redis_commands_total counter")
+        with self._lock:
+            redis_commands = sorted(self._redis_commands.items())
+        for command_name, count in redis_commands:
+            lines.append('foodpod_redis_commands_total{{command="{}"}} {}'.format(command_name, count))
+        return "\n".join(lines) + "\n"
+
+    def _render_histograms(self, lines, metric_name, description, label_name, histograms):
+        lines.append("# HELP {} {}".format(metric_name, description))
+        lines.append("# TYPE {} histogram".format(metric_name))
+        with self._lock:
+            histograms = sorted(histograms.items(), key=lambda entry: str(entry[0]))
+        for label_value, histogram in histograms:
+            labels = ""
+            if (label_name is not None):
+                labels = '{}="{}",'.format(label_name, label_value)
+            snapshot = histogram.snapshot()
+            for upper_bound, cumulative_count in snapshot["buckets"]:
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                    metric_name, labels, "+Inf" if upper_bound == float("inf") else upper_bound,
+                    cumulative_count))
+            labels = labels.rstrip(",")
+            if (labels != ""):
+                labels = "{" + labels + "}"
+            lines.append("{}_sum{} {}".format(metric_name, labels, snapshot["sum"]))
+            lines.append("{}_count{} {}".format(metric_name, labels, snapshot["count"]))
+
+    def render_summary(self, top=8):
+        lines = ["📈 Handlers (calls, mean, p95):"]
+        lines.extend(self._summarize_latency(self._handler_latency, top))
+        lines.append("🗄 Database methods by total time:")
+        lines.extend(self._summarize_latency(self._db_latency, top))
+        lines.append("✉️ Telegram API calls:")
+        lines.extend(self._summarize_latency(self._telegram_latency, top))
+        update_commands = self._update_redis_commands.snapshot()
+        if (update_commands["count"] > 0):
+            lines.append("🔢 Redis commands per update: {:.1f} on average, p95 ≤ {}".format(
+                update_commands["sum"] / update_commands["count"],
+                self._update_redis_commands.get_quantile_bound(0.95)))
+        return "\n".join(lines)
+
+    def _summarize_latency(self, histograms, top):
+        with self._lock:
+            histograms = list(histograms.items())
+        snapshots = [(name, histogram, histogram.snapshot()) for name, histogram in histograms]
+        snapshots = [entry for entry in snapshots if entry[2]["count"] > 0]
+        snapshots.sort(key=lambda entry: entry[2]["sum"], reverse=True)
+        if (len(snapshots) == 0):
+            return ["  ~ none yet ~"]
+        return ["  {}: {}, {:.1f}ms, ≤ {}ms".format(
+                    name, snapshot["count"], snapshot["sum"] / snapshot["count"] * 1000,
+                    histogram.get_quantile_bound(0.95) * 1000)
+                for name, histogram, snapshot in snapshots[:top]]
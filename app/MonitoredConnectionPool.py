@@ -0,0 +1,47 @@
+import threading
+
+from time import monotonic
+from redis import BlockingConnectionPool
+
+
+class MonitoredConnectionPool(BlockingConnectionPool):
+
+    # A blocking pool which keeps track of how many connections are in use, and of how
+    # long the callers had to wait for one: a growing wait time means the workers are
+    # starved for connections, and the pool should be made larger
+
+    def __init__(self, **kwargs):
+        self._stats_lock = threading.Lock()
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        super().__init__(**kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        # The queue holds placeholders for the connections not created yet, so it is empty
+        # only when every connection is in use
+        must_wait = self.pool.empty()
+        requested_at = monotonic()
+        connection = super().get_connection(command_name, *keys, **options)
+        with self._stats_lock:
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            if (must_wait):
+                self._waits += 1
+                self._wait_seconds += monotonic() - requested_at
+        return connection
+
+    def release(self, connection):
+        with self._stats_lock:
+            self._in_use = max(self._in_use - 1, 0)
+        super().release(connection)
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {"max_connections": self.max_connections,
+                    "in_use": self._in_use,
+                    "peak_in_use": self._peak_in_use,
+                    "utilization": round(self._in_use / self.max_connections, 3),
+                    "waits": self._waits,
+                    "wait_seconds": round(self._wait_seconds, 3)}
@@ -0,0 +1,30 @@
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class StartupProfiler:
+
+    # Times each phase of the startup sequence, so that the cold start can be compared
+    # across releases and platforms
+
+    def __init__(self):
+        self._started_at = perf_counter()
+        self._phases = []
+
+    @contextmanager
+    def phase(self, name):
+        phase_started_at = perf_counter()
+        try:
+            yield
+        finally:
+            self._phases.append((name, perf_counter() - phase_started_at))
+
+    def get_elapsed(self):
+        return perf_counter() - self._started_at
+
+    def render(self):
+        lines = ["{:<20} {:>10}".format("phase", "ms")]
+        for name, elapsed in self._phases:
+            lines.append("{:<20} {:>10.1f}".format(name, elapsed * 1000))
+        lines.append("{:<20} {:>10.1f}".format("total", self.get_elapsed() * 1000))
+        return "\n".join(lines)
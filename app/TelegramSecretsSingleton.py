@@ -37,6 +37,11 @@ class TelegramSecretsSingleton:
                         self._auth_users_list.append(line.rstrip())
                 logging.debug("Constructor read {} value for 'auth_users_list': {}"
                               .format(type(self._auth_users_list), self._auth_users_list))
+                # The webhook secret token is optional: when missing, a random one is used
+                self._webhook_secret = None
+                if Path(_secrets_path + 'WEBHOOK_SECRET.secret').exists():
+                    with open(_secrets_path + 'WEBHOOK_SECRET.secret', 'r') as secret:
+                        self._webhook_secret = secret.read().rstrip()
             except FileNotFoundError as fnf:
                 logging.error("Unable to read the required secrets to contact Telegram's API: {}"
                               .format(fnf.filename))
@@ -48,6 +53,9 @@ class TelegramSecretsSingleton:
     def get_auth_users_list(self):
         return copy(self._auth_users_list)
 
+    def get_webhook_secret(self):
+        return copy(self._webhook_secret)
+
 
 class SecretsReadError(Exception):
     # Raised if the constructor fails to load the required secrets
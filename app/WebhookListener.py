@@ -0,0 +1,133 @@
+import hmac
+import json
+import logging
+import threading
+
+from queue import Queue, Full
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_UPDATE_SIZE = 1024 * 1024
+
+
+def get_update_chat_id(update_json):
+    # The chat an update belongs to, like Update.effective_chat, without parsing the whole
+    # update; the user stands for it in the updates without a chat, and 0 for neither
+    for update_field in update_json.values():
+        if (not isinstance(update_field, dict)):
+            continue
+        for message in (update_field, update_field.get("message")):
+            if (isinstance(message, dict) and isinstance(message.get("chat"), dict)):
+                return message["chat"].get("id", 0)
+        if (isinstance(update_field.get("from"), dict)):
+            return update_field["from"].get("id", 0)
+    return 0
+
+
+class WebhookListener:
+
+    def __init__(self, process_update, secret_token, listen="0.0.0.0", port=8443,
+                 url_path="/telegram", queue_size=100, workers=4, enqueue_timeout=5):
+        self._process_update = process_update
+        self._secret_token = secret_token
+        self._url_path = url_path
+        self._enqueue_timeout = enqueue_timeout
+        self._workers = workers
+        # Every chat is processed by the same worker, so its updates keep the order they
+        # arrived in, whatever the number of workers
+        self._update_queues = [Queue(maxsize=max(1, -(-queue_size // workers)))
+                               for _ in range(workers)]
+        self._worker_threads = []
+        self._server = ThreadingHTTPServer((listen, port), self._make_request_handler())
+        self._server.daemon_threads = True
+        self._server_thread = None
+
+    def get_port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        for worker_id in range(self._workers):
+            worker_thread = threading.Thread(target=self._work, args=(self._update_queues[worker_id],),
+                                             name="WebhookWorker-{}".format(worker_id), daemon=True)
+            worker_thread.start()
+            self._worker_threads.append(worker_thread)
+        self._server_thread = threading.Thread(target=self._server.serve_forever,
+                                               name="WebhookListener", daemon=True)
+        self._server_thread.start()
+        logging.info("Webhook listener bound to {}:{}{}"
+                     .format(self._server.server_address[0], self.get_port(), self._url_path))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        # Let the workers drain the updates accepted so far, then stop them
+        for update_queue in self._update_queues[:len(self._worker_threads)]:
+            update_queue.put(None)
+        for worker_thread in self._worker_threads:
+            worker_thread.join()
+        self._worker_threads = []
+
+    def _enqueue(self, update_json):
+        # When the workers fall behind, the request is refused and Telegram will retry later
+        update_queue = self._update_queues[hash(get_update_chat_id(update_json)) % self._workers]
+        try:
+            update_queue.put(update_json, timeout=self._enqueue_timeout)
+            return True
+        except Full:
+            logging.warning("Webhook update queue is full: refusing update {}"
+                            .format(update_json.get("update_id")))
+            return False
+
+    def _work(self, update_queue):
+        while True:
+            update_json = update_queue.get()
+            if update_json is None:
+                return
+            try:
+                self._process_update(update_json)
+            except Exception as e:
+                logging.error("Unable to process the webhook update {}: {}"
+                              .format(update_json.get("update_id"), e))
+
+    def _make_request_handler(self):
+        listener = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if (self.path != listener._url_path):
+                    self._reply(404)
+                    return
+                secret_token = self.headers.get(SECRET_TOKEN_HEADER, "")
+                if (not hmac.compare_digest(secret_token.encode(),
+                                            listener._secret_token.encode())):
+                    logging.warning("Webhook request from {} refused: wrong secret token"
+                                    .format(self.client_address[0]))
+                    self._reply(403)
+                    return
+                try:
+                    content_length = int(self.headers.get("Content-Length", 0))
+                except ValueError:
+                    content_length = 0
+                if (content_length <= 0 or content_length > MAX_UPDATE_SIZE):
+                    self._reply(400)
+                    return
+                try:
+                    update_json = json.loads(self.rfile.read(content_length))
+                except ValueError:
+                    self._reply(400)
+                    return
+                if (not isinstance(update_json, dict)):
+                    self._reply(400)
+                    return
+                self._reply(200 if listener._enqueue(update_json) else 503)
+
+            def _reply(self, status_code):
+                self.send_response(status_code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug("Webhook listener: " + format % args)
+
+        return WebhookRequestHandler
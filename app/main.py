@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
 import logging
+import redis
 
-from FoodPodBot import FoodPodBot as BOT
+from argparse import ArgumentParser
+from StartupProfiler import StartupProfiler
 from TelegramSecretsSingleton import TelegramSecretsSingleton as TELEGRAM_SECRETS
 from TelegramSecretsSingleton import SecretsReadError
 from DbConnectionSingleton import DbConnectionSingleton as DB_CONNECTION
 
+from os import environ
 from sys import exit
 
 logging.basicConfig(format='%(levelname)s | %(asctime)s | %(name)s | %(message)s',
@@ -15,13 +18,49 @@ logging.basicConfig(format='%(levelname)s | %(asctime)s | %(name)s | %(message)s
 
 # Main routine
 def main():
+    parser = ArgumentParser(description="Telegram Bot to keep track of food storages")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print how long each startup phase not writing to the database takes, "
+                        "then exit")
+    args = parser.parse_args()
+    profiler = StartupProfiler()
     try:
-        mySecrets = TELEGRAM_SECRETS()
-        myDbConn = DB_CONNECTION()
+        with profiler.phase("secrets"):
+            mySecrets = TELEGRAM_SECRETS()
+        with profiler.phase("database"):
+            myDbConn = DB_CONNECTION()
+            # Fail fast when Redis is unreachable, instead of on the first user action
+            myDbConn.warm_up(int(environ.get("REDIS_WARM_CONNECTIONS", 4)))
     except SecretsReadError:
         logging.error("Without providing secrets, the Bot will not run")
         exit(1)
-    myBot = BOT(mySecrets, myDbConn)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logging.error("Unable to connect to the database, the Bot will not run: {}".format(e))
+        exit(1)
+    # The profile only covers the phases which leave the data untouched
+    if (not args.profile_startup):
+        with profiler.phase("migrations"):
+            myDbConn.migrate_pod_registry()
+            myDbConn.migrate_expiry_index()
+            myDbConn.migrate_name_index()
+            myDbConn.migrate_notify_queue()
+            myDbConn.migrate_item_schema()
+            if (environ.get("REPAIR_ON_START", "false") == "true"):
+                myDbConn.repair_inventories()
+    with profiler.phase("bot imports"):
+        if (environ.get("BOT_ENGINE", "sync") == "asyncio"):
+            from AsyncFoodPodBot import AsyncFoodPodBot as BOT
+        else:
+            from FoodPodBot import FoodPodBot as BOT
+    with profiler.phase("bot setup"):
+        myBot = BOT(mySecrets, myDbConn)
+    with profiler.phase("telegram warm-up"):
+        myBot.warm_up()
+    if (args.profile_startup):
+        print(profiler.render())
+        myBot.halt()
+        return
+    logging.info("Startup completed in {:.0f} ms".format(profiler.get_elapsed() * 1000))
     try:
         myBot.run()
     except Exception as e:
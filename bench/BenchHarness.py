@@ -0,0 +1,192 @@
+import logging
+import threading
+import tracemalloc
+
+from datetime import timedelta
+from time import perf_counter, sleep
+from telegram import Update
+from RecordingBot import RecordingBot
+from RedisCommandCounter import RedisCommandCounter
+from CallbackCodec import ACTION_STORAGE, ACTION_ITEM, ACTION_MODIFY_ITEM, ACTION_DEL_STORAGE
+from CallbackCodec import ACTION_DEL_STORAGE_CONFIRM, ORIGIN_STORAGE
+
+
+class BenchHarness:
+
+    # Drives the FoodPodBot handlers with synthetic updates, measuring for every operation
+    # its latency, the Redis commands and round trips, the Telegram calls and the allocations
+
+    def __init__(self, bot, db, pods, storages, items):
+        self._bot = bot
+        self._db_connection = db
+        self._pods = ["-{}".format(1000000 + pod_id) for pod_id in range(pods)]
+        self._storages = ["storage{}".format(storage_id) for storage_id in range(storages)]
+        self._items = ["item{}".format(item_id) for item_id in range(items)]
+        self._recording_bot = RecordingBot()
+        self._bot._updater.bot = self._recording_bot
+        self._bot._dispatcher.bot = self._recording_bot
+        self._counter = RedisCommandCounter()
+        self._counter.install()
+        self._update_id = 0
+        self._samples = {}
+        self._trace_allocations = False
+
+    def seed(self):
+        current_date = self._db_connection.get_current_date()
+        for pod in self._pods:
+            self._db_connection.add_pod(pod)
+            for storage in reversed(self._storages):
+                self._db_connection.add_storage(pod, storage)
+                self._seed_storage(pod, storage, current_date)
+
+    def _seed_storage(self, pod, storage, current_date):
+        # A mix of items out of stock, gone bad, expiring shortly and fresh
+        for item_id, item in enumerate(self._items):
+            expiry = current_date + timedelta(days=(item_id % 15) - 5)
+            self._db_connection.set_item(pod, storage, item, item_id % 4, expiry.isoformat())
+
+    def _message_update(self, chatid, text):
+        self._update_id += 1
+        message = {"message_id": self._update_id, "date": 0, "text": text,
+                   "chat": {"id": int(chatid), "type": "private"},
+                   "from": {"id": 1, "is_bot": False, "first_name": "bench", "username": "bench"}}
+        if (text.startswith("/")):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return Update.de_json({"update_id": self._update_id, "message": message},
+                              self._recording_bot)
+
+    def _button_update(self, chatid, action, *args):
+        callback_data = self._bot._callback_codec.encode(action, *args)
+        self._update_id += 1
+        # Every button belongs to a message of its own, so that no edit is skipped as unchanged
+        callback_query = {"id": str(self._update_id), "chat_instance": "bench", "data": callback_data,
+                          "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+                          "message": {"message_id": self._update_id, "date": 0, "text": "bench",
+                                      "chat": {"id": int(chatid), "type": "private"}}}
+        return Update.de_json({"update_id": self._update_id, "callback_query": callback_query},
+                              self._recording_bot)
+
+    def _process(self, update):
+        return lambda: self._bot._dispatcher.process_update(update)
+
+    def _measure(self, operation, step):
+        if (operation is None):
+            step()
+            return
+        commands, round_trips = self._counter.read()
+        telegram_calls = len(self._recording_bot.calls)
+        if (self._trace_allocations):
+            tracemalloc.reset_peak()
+            allocated_before = tracemalloc.get_traced_memory()[0]
+        started_at = perf_counter()
+        step()
+        elapsed = perf_counter() - started_at
+        sample = self._samples.setdefault(operation, {"latency": [], "redis_commands": [],
+                                                      "redis_round_trips": [],
+                                                      "telegram_calls": [], "alloc_peak": []})
+        if (self._trace_allocations):
+            sample["alloc_peak"].append(tracemalloc.get_traced_memory()[1] - allocated_before)
+            return
+        new_commands, new_round_trips = self._counter.read()
+        sample["latency"].append(elapsed)
+        sample["redis_commands"].append(new_commands - commands)
+        sample["redis_round_trips"].append(new_round_trips - round_trips)
+        sample["telegram_calls"].append(len(self._recording_bot.calls) - telegram_calls)
+
+    def _browse_steps(self, iteration):
+        pod = self._pods[iteration % len(self._pods)]
+        storage = self._storages[iteration % len(self._storages)]
+        item = self._items[iteration % len(self._items)]
+        expiry = self._db_connection.get_current_date() + timedelta(days=iteration % 10)
+        return [("items", self._process(self._message_update(pod, "/items"))),
+                ("storage", self._process(self._button_update(pod, ACTION_STORAGE, storage))),
+                ("item", self._process(self._button_update(pod, ACTION_ITEM, storage, item,
+                                                           ORIGIN_STORAGE))),
+                ("modify_button", self._process(self._button_update(pod, ACTION_MODIFY_ITEM,
+                                                                    storage, item))),
+                ("modify_quantity", self._process(self._message_update(pod, str(iteration % 5)))),
+                ("modify_expiry", self._process(self._message_update(pod, expiry.isoformat())))]
+
+    def _check_steps(self, iteration):
+        pod = self._pods[iteration % len(self._pods)]
+        return [("check", self._process(self._message_update(pod, "/check")))]
+
+    def _notify_steps(self, iteration):
+        return [(None, self._schedule_notifications),
+                ("notify", lambda: self._bot._expiry_notifier.run(self._recording_bot))]
+
+    def _schedule_notifications(self):
+        # Every pod is due at once, as in the worst case of a catch-up after a downtime
+        for pod in self._pods:
+            self._db_connection.schedule_notification(pod, 0, replace=True)
+
+    def _del_storage_steps(self, iteration):
+        pod = self._pods[iteration % len(self._pods)]
+        storage = "bench_deleted"
+        current_date = self._db_connection.get_current_date()
+        return [(None, lambda: self._db_connection.add_storage(pod, storage)),
+                (None, lambda: self._seed_storage(pod, storage, current_date)),
+                (None, self._process(self._button_update(pod, ACTION_STORAGE, storage))),
+                (None, self._process(self._button_update(pod, ACTION_DEL_STORAGE, storage))),
+                ("del_storage", self._process(self._button_update(pod, ACTION_DEL_STORAGE_CONFIRM,
+                                                                  storage))),
+                (None, self._wait_storage_purge)]
+
+    def _wait_storage_purge(self):
+        # Large storages are deleted in the background: wait for it, so it is not
+        # accounted to the next operation
+        while (any(thread.name == "StoragePurge" for thread in threading.enumerate())):
+            sleep(0.01)
+
+    def run(self, scenarios, iterations, warmup, alloc_iterations):
+        scenario_steps = {"browse": self._browse_steps,
+                          "check": self._check_steps,
+                          "notify": self._notify_steps,
+                          "del_storage": self._del_storage_steps}
+        for scenario in scenarios:
+            logging.info("Running the '{}' scenario".format(scenario))
+            build_steps = scenario_steps[scenario]
+            for iteration in range(warmup):
+                for _, step in build_steps(iteration):
+                    step()
+            for iteration in range(iterations[scenario]):
+                for operation, step in build_steps(warmup + iteration):
+                    self._measure(operation, step)
+            # Tracing the allocations slows everything down: it runs apart from the timing
+            self._trace_allocations = True
+            tracemalloc.start()
+            for iteration in range(alloc_iterations):
+                for operation, step in build_steps(warmup + iterations[scenario] + iteration):
+                    self._measure(operation, step)
+            tracemalloc.stop()
+            self._trace_allocations = False
+        return self._summarize()
+
+    def _percentile(self, sorted_values, percent):
+        if (len(sorted_values) == 0):
+            return None
+        return sorted_values[min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))]
+
+    def _summarize(self):
+        results = {}
+        for operation, sample in self._samples.items():
+            latency = sorted(sample["latency"])
+            results[operation] = {
+                "count": len(latency),
+                "latency_ms": {"p50": round(self._percentile(latency, 50) * 1000, 3),
+                               "p90": round(self._percentile(latency, 90) * 1000, 3),
+                               "p99": round(self._percentile(latency, 99) * 1000, 3),
+                               "max": round(latency[-1] * 1000, 3),
+                               "mean": round(sum(latency) / len(latency) * 1000, 3)},
+                "redis_commands": round(sum(sample["redis_commands"]) / len(latency), 2),
+                "redis_round_trips": round(sum(sample["redis_round_trips"]) / len(latency), 2),
+                "max_redis_round_trips": max(sample["redis_round_trips"]),
+                "telegram_calls": round(sum(sample["telegram_calls"]) / len(latency), 2),
+                "alloc_peak_kib": None}
+            if (len(sample["alloc_peak"]) > 0):
+                results[operation]["alloc_peak_kib"] = round(
+                    sum(sample["alloc_peak"]) / len(sample["alloc_peak"]) / 1024, 1)
+        return results
+
+    def count_errors(self):
+        return self._recording_bot.count_errors()
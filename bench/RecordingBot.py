@@ -0,0 +1,26 @@
+from telegram import Bot
+
+BENCH_BOT_TOKEN = "123456:BENCHMARKbenchmarkBENCHMARKbench"
+
+
+class RecordingBot(Bot):
+
+    # Answers the Telegram API calls locally, recording them instead of reaching the network
+
+    def __init__(self):
+        super().__init__(BENCH_BOT_TOKEN)
+        self.__dict__["calls"] = []
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        self.calls.append((endpoint, dict(data or {})))
+        if (endpoint == "getMe"):
+            return {"id": 1, "is_bot": True, "first_name": "FoodPod", "username": "foodpod_bench_bot"}
+        if (endpoint in ("sendMessage", "editMessageText")):
+            return {"message_id": 1, "date": 0, "text": data.get("text", ""),
+                    "chat": {"id": int(data["chat_id"]), "type": "private"}}
+        return True
+
+    def count_errors(self):
+        # The bot's error handler reports the exceptions raised by the handlers to the users
+        return len([call for call in self.calls
+                    if call[0] == "sendMessage" and call[1].get("text", "").startswith("🚨")])
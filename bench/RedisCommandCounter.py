@@ -0,0 +1,46 @@
+import threading
+
+from redis import Redis
+from redis.client import Pipeline
+
+
+class RedisCommandCounter:
+
+    # Counts the commands sent to Redis, and the round trips needed to send them, by wrapping
+    # the redis-py client methods; pipelined commands count as a single round trip
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = 0
+        self.round_trips = 0
+
+    def install(self):
+        counter = self
+        execute_command = Redis.execute_command
+        immediate_execute_command = Pipeline.immediate_execute_command
+        execute_pipeline = Pipeline.execute
+
+        def counted_execute_command(client, *args, **options):
+            counter._count(1)
+            return execute_command(client, *args, **options)
+
+        def counted_immediate_execute_command(pipe, *args, **options):
+            counter._count(1)
+            return immediate_execute_command(pipe, *args, **options)
+
+        def counted_execute_pipeline(pipe, *args, **kwargs):
+            if (len(pipe.command_stack) > 0):
+                counter._count(len(pipe.command_stack))
+            return execute_pipeline(pipe, *args, **kwargs)
+        Redis.execute_command = counted_execute_command
+        Pipeline.immediate_execute_command = counted_immediate_execute_command
+        Pipeline.execute = counted_execute_pipeline
+
+    def _count(self, commands):
+        with self._lock:
+            self.commands += commands
+            self.round_trips += 1
+
+    def read(self):
+        with self._lock:
+            return self.commands, self.round_trips
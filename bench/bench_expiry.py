@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import sys
+
+from os import path
+from datetime import datetime, timedelta
+from timeit import repeat
+
+APP_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+logging.basicConfig(format='%(levelname)s | %(asctime)s | %(name)s | %(message)s',
+                    level=logging.ERROR)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure the per item cost of classifying the "
+                                                 "items by expiry date")
+    parser.add_argument("--items", type=int, default=10000, help="items in the batch")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=10, help="batches in every timed run")
+    return parser.parse_args()
+
+
+def classify_with_strptime(rows, current_date):
+    # How every item was parsed and classified when the expiry was saved as an ISO date
+    due_items_list = []
+    for item_name, (quantity, expiry) in rows:
+        item_dict = {"item_name": item_name, "storage": "bench", "quantity": int(quantity),
+                     "expiry": datetime.strptime(expiry, "%Y-%m-%d").date()}
+        days_expired_delta = (current_date - item_dict["expiry"]).days
+        if (item_dict["quantity"] > 0 and days_expired_delta >= -2):
+            item_dict["days_expired"] = int(days_expired_delta)
+            due_items_list.append(item_dict)
+    return sorted(due_items_list, key=lambda k: k["days_expired"], reverse=True)
+
+
+def classify(db, rows, current_day):
+    return db._select_due_items([db._parse_item_fields("bench", item_name, fields)
+                                 for item_name, fields in rows], current_day, -2)
+
+
+def measure(label, run, items, args):
+    best = min(repeat(run, repeat=args.repeat, number=args.number))
+    print("{:<28} {:>10.1f} ns/item".format(label, best / args.number / items * 1e9))
+    return best
+
+
+# Main routine
+def main():
+    args = parse_args()
+    from DbConnectionSingleton import DbConnectionSingleton
+    db = DbConnectionSingleton()
+    current_date = db.get_current_date()
+    current_day = db.get_current_day()
+    # The same mix of fresh, expiring, expired and out of stock items in both formats
+    expiry_dates = [current_date + timedelta(days=(item_id % 15) - 5) for item_id in range(args.items)]
+    iso_rows = [("item{}".format(item_id), (str(item_id % 4), expiry_date.isoformat()))
+                for item_id, expiry_date in enumerate(expiry_dates)]
+    day_rows = [(item_name, (quantity, str(db._date_to_day(expiry_date))))
+                for (item_name, (quantity, _)), expiry_date in zip(iso_rows, expiry_dates)]
+    if ([item_dict["item_name"] for item_dict in classify_with_strptime(iso_rows, current_date)] !=
+            [item_dict["item_name"] for item_dict in classify(db, day_rows, current_day)]):
+        logging.error("The two encodings classify the items differently")
+        sys.exit(1)
+    print("Classifying {} items by expiry date".format(args.items))
+    before = measure("ISO date with strptime", lambda: classify_with_strptime(iso_rows, current_date),
+                     args.items, args)
+    measure("ISO date, legacy read", lambda: classify(db, iso_rows, current_day), args.items, args)
+    after = measure("epoch day", lambda: classify(db, day_rows, current_day), args.items, args)
+    print("{:<28} {:>10.1f}x".format("speedup", before / after))
+
+
+# Run Main
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+
+from os import environ, path
+from datetime import datetime
+
+APP_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+logging.basicConfig(format='%(levelname)s | %(asctime)s | %(name)s | %(message)s',
+                    level=logging.INFO)
+
+SCENARIOS = ["browse", "check", "notify", "del_storage"]
+# Upper bound of the Redis round trips of a single operation, whatever the inventory size;
+# deleting a large storage may overlap with the first batch of its background purge
+ROUND_TRIP_BUDGETS = {"items": 1, "storage": 3, "item": 4, "modify_button": 2,
+                      "modify_quantity": 2, "modify_expiry": 3, "check": 1, "del_storage": 4}
+# An item is opened from the storage page just shown, so with the cache only the
+# conversation state is read and written
+CACHED_ROUND_TRIP_BUDGETS = dict(ROUND_TRIP_BUDGETS, item=2)
+
+
+class BenchSecrets:
+
+    def get_telegram_bot_token(self):
+        from RecordingBot import BENCH_BOT_TOKEN
+        return BENCH_BOT_TOKEN
+
+    def get_auth_users_list(self):
+        return []
+
+    def get_webhook_secret(self):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the FoodPod bot handlers")
+    parser.add_argument("--pods", type=int, default=10)
+    parser.add_argument("--storages", type=int, default=5, help="storages per pod")
+    parser.add_argument("--items", type=int, default=20, help="items per storage")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--notify-iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--alloc-iterations", type=int, default=10)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="comma separated list among: " + ", ".join(SCENARIOS))
+    parser.add_argument("--redis", choices=["fake", "local"], default="fake",
+                        help="in-memory fakeredis, or the server set by the REDIS_* variables")
+    parser.add_argument("--no-cache", action="store_true", help="disable the inventory cache")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    return parser.parse_args()
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def connect_db(backend):
+    from DbConnectionSingleton import DbConnectionSingleton
+    db = DbConnectionSingleton()
+    if (backend == "fake"):
+        try:
+            import fakeredis
+        except ImportError:
+            logging.error("The fake Redis backend needs the packages in bench/requirements.txt")
+            sys.exit(1)
+        db._db_instance = fakeredis.FakeRedis(decode_responses=True)
+        db._register_scripts()
+    else:
+        db._db_instance.flushdb()
+    return db
+
+
+def check_budgets(results, cache=True):
+    violations = []
+    budgets = CACHED_ROUND_TRIP_BUDGETS if (cache) else ROUND_TRIP_BUDGETS
+    for operation, budget in budgets.items():
+        if (operation in results and results[operation]["max_redis_round_trips"] > budget):
+            violations.append("{}: {} Redis round trips, expected at most {}"
+                              .format(operation, results[operation]["max_redis_round_trips"], budget))
+    return violations
+
+
+def compare(results, previous_path):
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+    print("\nCompared with {} ({})".format(previous_path, previous["meta"].get("commit")))
+    for operation, result in results.items():
+        if (operation not in previous["results"]):
+            continue
+        old_result = previous["results"][operation]
+        old_p50 = old_result["latency_ms"]["p50"]
+        change = (result["latency_ms"]["p50"] - old_p50) / old_p50 * 100 if old_p50 > 0 else 0
+        print("{:<16} p50 {:>9.3f} -> {:>9.3f} ms ({:+.1f}%)   commands {:>8} -> {:>8}"
+              .format(operation, old_p50, result["latency_ms"]["p50"], change,
+                      old_result["redis_commands"], result["redis_commands"]))
+
+
+def print_results(results):
+    print("\n{:<16} {:>6} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8} {:>10}".format(
+        "operation", "count", "p50 ms", "p90 ms", "p99 ms", "max ms", "cmds", "trips", "alloc KiB"))
+    for operation, result in results.items():
+        latency = result["latency_ms"]
+        print("{:<16} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>7} {:>8} {:>10}".format(
+            operation, result["count"], latency["p50"], latency["p90"], latency["p99"],
+            latency["max"], result["redis_commands"], result["redis_round_trips"],
+            result["alloc_peak_kib"] if result["alloc_peak_kib"] is not None else "-"))
+
+
+# Main routine
+def main():
+    args = parse_args()
+    # The notification pacing would only measure the sleeps
+    environ.setdefault("NOTIFY_GLOBAL_RATE", "1000000")
+    environ.setdefault("NOTIFY_CHAT_INTERVAL", "0")
+    if (args.no_cache):
+        environ["CACHE_MAX_BYTES"] = "0"
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario != ""]
+    for scenario in scenarios:
+        if (scenario not in SCENARIOS):
+            logging.error("Unknown scenario '{}'".format(scenario))
+            sys.exit(1)
+    from FoodPodBot import FoodPodBot
+    from BenchHarness import BenchHarness
+    db = connect_db(args.redis)
+    harness = BenchHarness(FoodPodBot(BenchSecrets(), db), db,
+                           args.pods, args.storages, args.items)
+    logging.info("Seeding {} pods with {} storages of {} items each"
+                 .format(args.pods, args.storages, args.items))
+    harness.seed()
+    iterations = {scenario: args.iterations for scenario in scenarios}
+    if ("notify" in iterations):
+        iterations["notify"] = args.notify_iterations
+    results = harness.run(scenarios, iterations, args.warmup, args.alloc_iterations)
+    violations = check_budgets(results, not args.no_cache)
+    report = {"meta": {"commit": get_commit(),
+                       "date": datetime.now().isoformat(timespec="seconds"),
+                       "python": platform.python_version(),
+                       "redis": args.redis,
+                       "cache": not args.no_cache,
+                       "pods": args.pods, "storages": args.storages, "items": args.items,
+                       "iterations": iterations, "warmup": args.warmup,
+                       "alloc_iterations": args.alloc_iterations},
+              "results": results,
+              "handler_errors": harness.count_errors(),
+              "budget_violations": violations}
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print_results(results)
+    if (args.compare is not None):
+        compare(results, args.compare)
+    logging.info("Results saved to {}".format(args.output))
+    if (report["handler_errors"] > 0):
+        logging.error("{} updates failed while running the benchmark".format(report["handler_errors"]))
+    for violation in violations:
+        logging.error("Round trip budget exceeded by {}".format(violation))
+    if (report["handler_errors"] > 0 or len(violations) > 0):
+        sys.exit(1)
+
+
+# Run Main
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+import redis
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "app"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "bench"))
+
+from DbConnectionSingleton import DbConnectionSingleton  # noqa: E402
+from RedisCommandCounter import RedisCommandCounter  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def redis_counter():
+    # The client methods are wrapped once, for all the tests
+    counter = RedisCommandCounter()
+    counter.install()
+    return counter
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # A new singleton for every test, on an empty in-memory Redis and without the cache
+    monkeypatch.setenv("CACHE_MAX_BYTES", "0")
+    monkeypatch.setattr(DbConnectionSingleton, "_DbConnectionSingleton__instance", None)
+    db = DbConnectionSingleton()
+    db._db_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                       server=fakeredis.FakeServer(), decode_responses=True)
+    db._db_instance = redis.Redis(connection_pool=db._db_pool)
+    db._register_scripts()
+    # The scripts are loaded as at startup, so that their first call is not counted apart
+    db.warm_up(1)
+    return db
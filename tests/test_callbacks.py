@@ -0,0 +1,25 @@
+from CallbackCodec import CallbackCodec, ACTION_ITEM, ORIGIN_STORAGE
+from KeyboardRenderer import KeyboardRenderer
+
+CHATID = "-1000001"
+STORAGE = "🥫" * 8 + " pantry"
+
+
+def test_keyboard_tokens_are_saved_at_once(db, redis_counter):
+    callback_codec = CallbackCodec(db)
+    renderer = KeyboardRenderer(callback_codec)
+    # The item buttons go over the limit, the ones of the storage do not
+    item_list = [{"item_name": "🍅" * 8 + " {}".format(item_id), "quantity": 1, "expiry": 0}
+                 for item_id in range(10)]
+    _, round_trips = redis_counter.read()
+    keyboard_markup = renderer.render_storage_items(STORAGE, item_list, 0)
+    assert redis_counter.read()[1] == round_trips
+    callbacks = callback_codec.pack(keyboard_markup)
+    db.save_callbacks(callbacks)
+    assert redis_counter.read()[1] == round_trips + 1
+    assert len(callbacks) == 10
+    buttons = [button for button_row in keyboard_markup.inline_keyboard for button in button_row]
+    assert all(len(button.callback_data.encode()) <= 64 for button in buttons)
+    assert callback_codec.decode(buttons[0].callback_data) == (
+        ACTION_ITEM, [STORAGE, "🍅" * 8 + " 0", ORIGIN_STORAGE])
+    assert 0 < db._db_instance.ttl("global:callback:" + buttons[0].callback_data) <= db._callback_ttl
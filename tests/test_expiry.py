@@ -0,0 +1,53 @@
+from datetime import date, timedelta
+
+CHATID = "-1000001"
+
+
+def seed_legacy_item(db, storage, item_name, quantity, expiry):
+    # Saved as by the versions before the epoch days, which did not zero pad the dates
+    db.add_pod(CHATID)
+    db.add_storage(CHATID, storage)
+    db._db_instance.lpush(CHATID + ":" + storage + ":item_list", item_name)
+    db._db_instance.hset(CHATID + ":" + storage + ":" + item_name,
+                         mapping={"Quantity": quantity, "Expire": expiry})
+
+
+def test_unpadded_date_is_saved_as_epoch_day(db):
+    db.add_pod(CHATID)
+    db.add_storage(CHATID, "fridge")
+    db.set_item(CHATID, "fridge", "milk", 2, "2024-1-5")
+    assert db.get_item_expiry(CHATID, "fridge", "milk") == date(2024, 1, 5)
+    assert db.get_item(CHATID, "fridge", "milk")["expiry"] == db._date_to_day(date(2024, 1, 5))
+
+
+def test_unpadded_legacy_date_is_read(db):
+    seed_legacy_item(db, "fridge", "milk", 2, "2024-1-5")
+    db.migrate_expiry_index()
+    expiry_day = db._date_to_day(date(2024, 1, 5))
+    assert db._db_instance.zscore(CHATID + ":expiry_index", "fridge@milk") == expiry_day
+    item_count, item_list = db.get_storage_page(CHATID, "fridge", 0, 10)
+    assert item_count == 1
+    assert item_list[0]["quantity"] == 2
+    assert item_list[0]["expiry"] == expiry_day
+    assert db.get_item_expiring_or_bad_page(CHATID, 0, 10)[0] == 1
+
+
+def test_repair_converts_unpadded_legacy_date(db):
+    seed_legacy_item(db, "fridge", "milk", 2, "2024-1-5")
+    repairs = db.repair_inventory(CHATID)
+    assert repairs["legacy_expiry"] == 1
+    assert repairs["broken_items"] == 0
+    assert db.get_item(CHATID, "fridge", "milk") == {
+        "item_name": "milk", "storage": "fridge", "quantity": 2,
+        "expiry": db._date_to_day(date(2024, 1, 5))}
+
+
+def test_set_item_reports_becoming_due(db):
+    db.add_pod(CHATID)
+    db.add_storage(CHATID, "fridge")
+    current_date = db.get_current_date()
+    assert not db.set_item(CHATID, "fridge", "milk", 0, current_date.isoformat())
+    assert db.set_item(CHATID, "fridge", "milk", 1, current_date.isoformat())
+    assert not db.set_item(CHATID, "fridge", "milk", 2, current_date.isoformat())
+    assert not db.set_item(CHATID, "fridge", "milk", 2, (current_date + timedelta(days=10)).isoformat())
+    assert db.set_item(CHATID, "fridge", "milk", 2, (current_date + timedelta(days=2)).isoformat())
@@ -0,0 +1,57 @@
+from time import monotonic, sleep
+
+from telegram.error import NetworkError
+
+from ExpiryNotifier import ExpiryNotifier, RateLimiter
+
+PODS = ["-1000001", "-1000002", "-1000003"]
+
+
+class PodQueue:
+
+    # Hands out the due pods as the notification queue does
+
+    def __init__(self, pods):
+        self._pods = pods
+
+    def iter_due_notifications(self, batch_size):
+        return iter(self._pods)
+
+
+class FlakyBot:
+
+    # Fails the first send to the given chat with a network error
+
+    def __init__(self, flaky_chatid):
+        self._flaky_chatid = flaky_chatid
+        self._failed = False
+        self.sent = []
+
+    def send_message(self, chat_id, **kwargs):
+        if (chat_id == self._flaky_chatid and not self._failed):
+            self._failed = True
+            raise NetworkError("connection reset")
+        self.sent.append(chat_id)
+
+
+def test_network_error_does_not_hold_back_other_pods(monkeypatch):
+    monkeypatch.setenv("NOTIFY_GLOBAL_RATE", "1000")
+    monkeypatch.setenv("NOTIFY_CHAT_INTERVAL", "0")
+    notifier = ExpiryNotifier(PodQueue(PODS), lambda pod: ("report", None))
+    bot = FlakyBot(PODS[0])
+    started_at = monotonic()
+    summary = notifier.run(bot)
+    assert (summary["sent"], summary["failed"]) == (3, 0)
+    # The failed pod is sent last, after its retry delay
+    assert sorted(bot.sent[:2]) == PODS[1:]
+    assert bot.sent[2] == PODS[0]
+    assert monotonic() - started_at >= 1
+
+
+def test_rate_limiter_forgets_past_chat_slots():
+    rate_limiter = RateLimiter(1000, 0.01)
+    for chatid in PODS:
+        rate_limiter.wait(chatid)
+    sleep(0.02)
+    rate_limiter.wait(PODS[0])
+    assert list(rate_limiter._next_chat_slot) == PODS[:1]
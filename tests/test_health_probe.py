@@ -0,0 +1,27 @@
+from HealthProbe import HealthProbe
+
+
+class StubDb:
+
+    def get_timestamp(self):
+        return 1760745600
+
+    def ping(self):
+        return True
+
+
+def test_clear_leaves_the_file_of_another_process(tmp_path):
+    probe_file = tmp_path / "foodpod.ready"
+    probe_file.write_text("1760745000")
+    # A bot profiling its startup halts without ever being ready
+    HealthProbe(StubDb(), probe_file).clear()
+    assert probe_file.read_text() == "1760745000"
+
+
+def test_clear_removes_its_own_file(tmp_path):
+    probe = HealthProbe(StubDb(), tmp_path / "foodpod.ready")
+    probe.mark_ready()
+    assert probe.renew()
+    probe.clear()
+    assert not (tmp_path / "foodpod.ready").exists()
+    assert not probe.renew()
@@ -0,0 +1,24 @@
+import io
+
+from datetime import date
+
+from InventoryFile import InventoryFile
+
+CHATID = "-1000001"
+CSV_ROWS = ("storage,item,quantity,expiry\n"
+            "fridge,milk,2,2024-1-5\n"
+            "fridge,eggs,6,2024-13-01\n"
+            "fridge,ham,x,2024-01-05\n"
+            "pantry,rice,1,\n")
+
+
+def test_invalid_rows_are_skipped(db):
+    db.add_pod(CHATID)
+    summary = {"skipped": 0, "errors": []}
+    counts = db.import_items(CHATID, InventoryFile(db).read(io.BytesIO(CSV_ROWS.encode()), "csv",
+                                                            summary))
+    assert counts == {"items": 2, "new_storages": 2}
+    assert summary["skipped"] == 2
+    assert [error.split(":")[0] for error in summary["errors"]] == ["line 3", "line 4"]
+    assert db.get_item_expiry(CHATID, "fridge", "milk") == date(2024, 1, 5)
+    assert db.get_item_quantity(CHATID, "pantry", "rice") == 1
@@ -0,0 +1,25 @@
+PODS = ["-1000001", "-1000002", "-1000003"]
+
+
+def test_repair_inventories_scans_the_keyspace_once(db, monkeypatch):
+    for pod in PODS:
+        db.add_pod(pod)
+        db.add_storage(pod, "fridge")
+        db.set_item(pod, "fridge", "milk", 1, "2024-01-05")
+        # Left by an interrupted write: a list entry without its hash, and the other way round
+        db._db_instance.lpush(pod + ":fridge:item_list", "eggs")
+        db._db_instance.hset(pod + ":fridge:ham", mapping={"Quantity": 1, "Expire": 0})
+    scan_iter = db._db_instance.scan_iter
+    scans = []
+
+    def counted_scan_iter(*args, **kwargs):
+        scans.append(kwargs.get("match"))
+        return scan_iter(*args, **kwargs)
+    monkeypatch.setattr(db._db_instance, "scan_iter", counted_scan_iter)
+    db.repair_inventories()
+    assert scans == [None]
+    for pod in PODS:
+        assert db.get_item(pod, "fridge", "eggs")["quantity"] == 0
+        assert not db._db_instance.exists(pod + ":fridge:ham")
+        assert db.get_item(pod, "fridge", "milk")["quantity"] == 1
+        assert sum(db.repair_inventory(pod).values()) == 0
@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+import pytest
+
+from InventoryCache import InventoryCache
+
+CHATID = "-1000001"
+STORAGES = ["fridge", "freezer", "pantry"]
+
+
+def seed(db, item_count):
+    # A mix of items out of stock, gone bad, expiring shortly and fresh in every storage
+    current_date = db.get_current_date()
+    db.add_pod(CHATID)
+    for storage in STORAGES:
+        db.add_storage(CHATID, storage)
+        for item_id in range(item_count):
+            expiry = current_date + timedelta(days=(item_id % 10) - 5)
+            db.set_item(CHATID, storage, "item{}".format(item_id), item_id % 3, expiry.isoformat())
+
+
+def count_round_trips(redis_counter, read):
+    _, round_trips = redis_counter.read()
+    read()
+    return redis_counter.read()[1] - round_trips
+
+
+READS = {
+    "pod_snapshot": lambda db: db.get_pod_snapshot(CHATID),
+    "expired_list": lambda db: db.get_item_expired_list(CHATID, STORAGES[0]),
+    "expiring_or_bad_page": lambda db: db.get_item_expiring_or_bad_page(CHATID, 0, 10),
+}
+
+
+@pytest.mark.parametrize("read", READS.values(), ids=READS.keys())
+def test_round_trips_do_not_depend_on_item_count(db, redis_counter, read):
+    round_trips = []
+    for item_count in [2, 40]:
+        db._db_instance.flushdb()
+        seed(db, item_count)
+        round_trips.append(count_round_trips(redis_counter, lambda: read(db)))
+    assert round_trips[0] == round_trips[1]
+
+
+def test_pod_snapshot_round_trips(db, redis_counter):
+    # The storage list, all the item lists, then all the item hashes
+    seed(db, 40)
+    assert count_round_trips(redis_counter, lambda: db.get_pod_snapshot(CHATID)) == 3
+    snapshot = db.get_pod_snapshot(CHATID)
+    assert sorted(snapshot) == sorted(STORAGES)
+    assert all(len(item_list) == 40 for item_list in snapshot.values())
+
+
+def test_item_view_is_served_from_the_cache(db, redis_counter, monkeypatch):
+    monkeypatch.delenv("CACHE_MAX_BYTES")
+    db._inventory_cache = InventoryCache()
+    seed(db, 40)
+    _, item_list = db.get_storage_page(CHATID, STORAGES[0], 0, 10)
+    item_name = item_list[-1]["item_name"]
+    # An item of the storage page just shown
+    assert count_round_trips(redis_counter, lambda: db.get_item(CHATID, STORAGES[0], item_name)) == 0
+    # An item out of it is read once
+    assert count_round_trips(redis_counter, lambda: db.get_item(CHATID, STORAGES[1], "item1")) == 1
+    assert count_round_trips(redis_counter, lambda: db.get_item(CHATID, STORAGES[1], "item1")) == 0
+    db.set_item(CHATID, STORAGES[1], "item1", 7, db.get_current_date().isoformat())
+    assert db.get_item(CHATID, STORAGES[1], "item1")["quantity"] == 7
+
+
+def test_moved_items_leave_nothing_to_repair(db):
+    seed(db, 10)
+    expiry = db.get_item(CHATID, STORAGES[0], "item2")["expiry"]
+    db.move_item(CHATID, STORAGES[0], "item2", STORAGES[0], "Item two")
+    db.move_item(CHATID, STORAGES[0], "Item two", STORAGES[1], "item2 moved")
+    assert db.get_storage_page(CHATID, STORAGES[0], 0, 20)[0] == 9
+    item_dict = db.get_item(CHATID, STORAGES[1], "item2 moved")
+    assert (item_dict["quantity"], item_dict["expiry"]) == (2, expiry)
+    assert sorted((found["storage"], found["item_name"]) for found in db.find_items(CHATID, "item2", 5)[1]) == \
+        [(STORAGES[1], "item2"), (STORAGES[1], "item2 moved"), (STORAGES[2], "item2")]
+    # It went bad, so the expiry index must follow it
+    assert (STORAGES[1], "item2 moved") in [(found["storage"], found["item_name"]) for found in
+                                            db.get_item_expiring_or_bad_page(CHATID, 0, 100)[1]]
+    with pytest.raises(Exception):
+        db.move_item(CHATID, STORAGES[1], "item2 moved", STORAGES[2], "item3")
+    assert sum(db.repair_inventory(CHATID).values()) == 0
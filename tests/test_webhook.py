@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from WebhookListener import WebhookListener, SECRET_TOKEN_HEADER, get_update_chat_id
+
+SECRET_TOKEN = "s3cret-token"
+# As recorded from a /start command sent to the bot
+UPDATE = {"update_id": 815001,
+          "message": {"message_id": 12, "date": 1760745600, "text": "/start",
+                      "chat": {"id": -1000001, "type": "group", "title": "Home"},
+                      "from": {"id": 4242, "is_bot": False, "first_name": "Alex"},
+                      "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+
+
+class StubDispatcher:
+
+    # Records the updates it is handed, holding the worker until it is released
+
+    def __init__(self, blocked=False):
+        self.updates = []
+        self.received = threading.Semaphore(0)
+        self.release = threading.Event()
+        if (not blocked):
+            self.release.set()
+
+    def process_update(self, update_json):
+        # The updates of the first chat are slower to process
+        if (get_update_chat_id(update_json) == UPDATE["message"]["chat"]["id"]):
+            time.sleep(0.01)
+        self.updates.append(update_json)
+        self.received.release()
+        self.release.wait()
+
+
+@pytest.fixture
+def start_listener():
+    listeners = []
+
+    def start(dispatcher, **kwargs):
+        listener = WebhookListener(dispatcher.process_update, SECRET_TOKEN, listen="127.0.0.1",
+                                   port=0, **kwargs)
+        listener.start()
+        listeners.append((listener, dispatcher))
+        return listener
+    yield start
+    for listener, dispatcher in listeners:
+        dispatcher.release.set()
+        listener.stop()
+
+
+def post(listener, update_json, secret_token=SECRET_TOKEN):
+    request = urllib.request.Request("http://127.0.0.1:{}/telegram".format(listener.get_port()),
+                                     data=json.dumps(update_json).encode(),
+                                     headers={"Content-Type": "application/json"})
+    if (secret_token is not None):
+        request.add_header(SECRET_TOKEN_HEADER, secret_token)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+@pytest.mark.parametrize("secret_token", ["wrong-token", None], ids=["wrong", "missing"])
+def test_refuses_a_wrong_secret_token(start_listener, secret_token):
+    dispatcher = StubDispatcher()
+    listener = start_listener(dispatcher)
+    assert post(listener, UPDATE, secret_token) == 403
+    listener.stop()
+    assert dispatcher.updates == []
+
+
+def test_hands_the_update_to_the_dispatcher(start_listener):
+    dispatcher = StubDispatcher()
+    listener = start_listener(dispatcher)
+    assert post(listener, UPDATE) == 200
+    assert dispatcher.received.acquire(timeout=5)
+    assert dispatcher.updates == [UPDATE]
+
+
+def test_refuses_updates_when_the_queue_is_full(start_listener):
+    dispatcher = StubDispatcher(blocked=True)
+    listener = start_listener(dispatcher, queue_size=1, workers=1, enqueue_timeout=0.1)
+    # The first update holds the worker, the second one fills the queue
+    assert post(listener, dict(UPDATE, update_id=1)) == 200
+    assert dispatcher.received.acquire(timeout=5)
+    assert post(listener, dict(UPDATE, update_id=2)) == 200
+    assert post(listener, dict(UPDATE, update_id=3)) == 503
+    dispatcher.release.set()
+    listener.stop()
+    assert [update_json["update_id"] for update_json in dispatcher.updates] == [1, 2]
+
+
+def callback_update(update_id, chat_id):
+    return {"update_id": update_id,
+            "callback_query": {"id": str(update_id), "data": "s:fridge", "chat_instance": "1",
+                               "from": {"id": 4242, "is_bot": False, "first_name": "Alex"},
+                               "message": dict(UPDATE["message"], chat={"id": chat_id, "type": "group"})}}
+
+
+def test_keeps_the_order_of_the_updates_of_a_chat(start_listener):
+    dispatcher = StubDispatcher()
+    listener = start_listener(dispatcher, workers=4)
+    chat_ids = [UPDATE["message"]["chat"]["id"], -1000002, -1000003]
+    for update_id in range(30):
+        assert post(listener, callback_update(update_id, chat_ids[update_id % 3])) == 200
+    listener.stop()
+    assert len(dispatcher.updates) == 30
+    for chat_id in chat_ids:
+        update_ids = [update_json["update_id"] for update_json in dispatcher.updates
+                      if get_update_chat_id(update_json) == chat_id]
+        assert update_ids == sorted(update_ids)